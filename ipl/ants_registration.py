@@ -25,6 +25,8 @@ import argparse
 
 # local stuff
 import minc_tools
+import minc_registration_store
+import minc_grid
 
 
 # hack to make it work on Python 3
@@ -44,6 +46,7 @@ else:
     basestring = basestring
 
 
+@minc_registration_store.memoize(outputs=lambda a: {'xfm': a['output_xfm']})
 def ants_linear_register(
     source,
     target,
@@ -88,15 +91,15 @@ def ants_linear_register(
               source_lr=tmp.cache(s_base+'_'+str(downsample)+'.mnc')
               target_lr=tmp.cache(t_base+'_'+str(downsample)+'.mnc')
               
-              minc.resample_smooth(source,source_lr,unistep=downsample)
-              minc.resample_smooth(target,target_lr,unistep=downsample)
+              source_lr=minc.downsample(source,downsample,source_lr)
+              target_lr=minc.downsample(target,downsample,target_lr)
               
               if source_mask is not None:
                   source_mask_lr=tmp.cache(s_base+'_mask_'+str(downsample)+'.mnc')
-                  minc.resample_labels(source_mask,source_mask_lr,unistep=downsample,datatype='byte')
+                  source_mask_lr=minc.downsample(source_mask,downsample,source_mask_lr,labels=True)
               if target_mask is not None:
-                  target_mask_lr=tmp.cache(s_base+'_mask_'+str(downsample)+'.mnc')
-                  minc.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
+                  target_mask_lr=tmp.cache(t_base+'_mask_'+str(downsample)+'.mnc')
+                  target_mask_lr=minc.downsample(target_mask,downsample,target_mask_lr,labels=True)
           
           iterations=parameters.get('affine-iterations','10000x10000x10000x10000x10000')
           
@@ -126,12 +129,12 @@ def ants_linear_register(
               source_lr=tmp.cache(s_base+'_'+str(downsample)+'.mnc')
               target_lr=tmp.cache(t_base+'_'+str(downsample)+'.mnc')
 
-              minc.resample_smooth(source,source_lr,unistep=downsample)
-              minc.resample_smooth(target,target_lr,unistep=downsample)
+              source_lr=minc.downsample(source,downsample,source_lr)
+              target_lr=minc.downsample(target,downsample,target_lr)
 
               if target_mask is not None:
-                  target_mask_lr=tmp.cache(s_base+'_mask_'+str(downsample)+'.mnc')
-                  minc.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
+                  target_mask_lr=tmp.cache(t_base+'_mask_'+str(downsample)+'.mnc')
+                  target_mask_lr=minc.downsample(target_mask,downsample,target_mask_lr,labels=True)
 
 
           cmd.extend(['-m','{}[{},{},{}]'.format('CC',source_lr,target_lr,cost_function_par)])
@@ -168,6 +171,8 @@ def ants_linear_register(
         
         
 
+@minc_registration_store.memoize(outputs=lambda a: {'xfm': a['output_xfm']})
+@minc_grid.compact_outputs(outputs=lambda a: [a['output_xfm']])
 def non_linear_register_ants(
     source, target, output_xfm,
     target_mask=None,
@@ -213,12 +218,12 @@ def non_linear_register_ants(
             source_lr=tmp.cache(s_base+'_'+str(downsample)+'.mnc')
             target_lr=tmp.cache(t_base+'_'+str(downsample)+'.mnc')
 
-            minc.resample_smooth(source,source_lr,unistep=downsample)
-            minc.resample_smooth(target,target_lr,unistep=downsample)
+            source_lr=minc.downsample(source,downsample,source_lr)
+            target_lr=minc.downsample(target,downsample,target_lr)
 
             if target_mask is not None:
-                target_mask_lr=tmp.cache(s_base+'_mask_'+str(downsample)+'.mnc')
-                minc.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
+                target_mask_lr=tmp.cache(t_base+'_mask_'+str(downsample)+'.mnc')
+                target_mask_lr=minc.downsample(target_mask,downsample,target_mask_lr,labels=True)
 
 
         cmd.extend(['-m','{}[{},{},{}]'.format(cost_function,source_lr,target_lr,cost_function_par)])
@@ -243,6 +248,9 @@ def non_linear_register_ants(
         minc.command(cmd, inputs=inputs, outputs=outputs)
 
 
+@minc_registration_store.memoize(outputs=lambda a: {'xfm':     a['output_xfm'],
+                                                  'inverse': a['output_xfm'].rsplit('.xfm', 1)[0] + '_inverse.xfm'})
+@minc_grid.compact_outputs(outputs=lambda a: [a['output_xfm'], a['output_xfm'].rsplit('.xfm', 1)[0] + '_inverse.xfm'])
 def non_linear_register_ants2(
     source, target, output_xfm,
     target_mask=None,
@@ -380,6 +388,8 @@ def non_linear_register_ants2(
         
         minc.command(cmd, inputs=inputs, outputs=outputs)
 
+@minc_registration_store.memoize(outputs=lambda a: {'xfm':     a['output_xfm'],
+                                                  'inverse': a['output_xfm'].rsplit('.xfm', 1)[0] + '_inverse.xfm'})
 def linear_register_ants2(
     source, target, output_xfm,
     target_mask= None,
@@ -390,8 +400,8 @@ def linear_register_ants2(
     close      = False,
     verbose=0
     ):
-    """perform linear registration using ANTs"""
-    #TODO:implement close
+    """perform linear registration using ANTs,
+    close - initialization is close to the solution, skip the coarsest levels"""
     
     
     with minc_tools.mincTools(verbose=verbose) as minc:
@@ -410,6 +420,8 @@ def linear_register_ants2(
             if not 'shrink' in parameters: parameters['shrink'] = {}
 
         levels=parameters.get('levels',3)
+        if close:
+            levels=min(levels,2)
         prog=''
         shrink=''
         blur=''
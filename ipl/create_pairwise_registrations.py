@@ -8,6 +8,36 @@ import json
 from iplMincTools import mincTools,mincError
 from scoop import futures, shared
 
+def evaluate_map(minc, i, j, mri1, mri2, mask1, mask2, seg1, seg2, output_base, baa=False):
+    """resample subject j into space of subject i using output_base_map.xfm
+    and write similarity measures into output_base_similarity.txt"""
+    # resample mris
+    minc.resample_smooth(mri2,minc.tmp('mri2.mnc'),transform=output_base+'_map.xfm',invert_transform=True)
+    # resample segs
+    minc.resample_labels(seg2,minc.tmp('seg2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
+    minc.resample_labels(mask2,minc.tmp('mask2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
+    # calculate CC, MI
+    # independent measurements, run them concurrently
+    (cc, nmi, ncc, msq) = [ f.result() for f in 
+        [ minc.submit(minc.similarity, mri1, minc.tmp('mri2.mnc'), ref_mask=mask1, sample_mask=minc.tmp('mask2.mnc'), method=m) 
+            for m in ('cc', 'nmi', 'ncc', 'msq') ] ]
+    # calculate label overlap
+    gtc = minc.label_similarity(seg1,minc.tmp('seg2.mnc'),method='gtc')
+
+    # write out result
+    with open(output_base+'_similarity.txt','w') as f:
+        f.write("{},{},{},{},{},{},{}\n".format(i,j,cc,ncc,nmi,msq,gtc))
+    return output_base
+
+
+def generate_xfm_inverse(i , j, forward_base, mri1, mri2, mask1, mask2, seg1, seg2, output_base,step=2,baa=False):
+    """map of subject i to subject j from already computed map of j to i,
+    used for symmetric methods instead of running registration again"""
+    with mincTools(verbose=2) as minc:
+        minc.xfm_normalize(forward_base+'_map.xfm',mri1,output_base+'_map.xfm',step=step,invert=True)
+        return evaluate_map(minc, i, j, mri1, mri2, mask1, mask2, seg1, seg2, output_base, baa=baa)
+
+
 def generate_xfm_model(i , j, xfm1, xfm2, mri1, mri2, mask1, mask2, seg1, seg2, output_base,step=2,baa=False):
     with mincTools(verbose=2) as minc:
         # all xfms are mapping subject to common space, so to map one subject to another it will be xfm1 * xfm2^1
@@ -17,44 +47,14 @@ def generate_xfm_model(i , j, xfm1, xfm2, mri1, mri2, mask1, mask2, seg1, seg2,
         # normalize xfms
         minc.xfm_normalize(minc.tmp('xfm1_dot_xfm2_inv.xfm'),mri1,output_base+'_map.xfm',step=step)
 
-        # resample mris
-        minc.resample_smooth(mri2,minc.tmp('mri2.mnc'),transform=output_base+'_map.xfm',invert_transform=True)
-        # resample segs
-        minc.resample_labels(seg2,minc.tmp('seg2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        minc.resample_labels(mask2,minc.tmp('mask2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        # calculate CC, MI
-        cc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='cc')
-        nmi = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='nmi')
-        ncc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='ncc')
-        msq = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='msq')
-        # calculate label overlap
-        gtc = minc.label_similarity(seg1,minc.tmp('seg2.mnc'),method='gtc')
-
-        # write out result
-        with open(output_base+'_similarity.txt','w') as f:
-            f.write("{},{},{},{},{},{},{}\n".format(i,j,cc,ncc,nmi,msq,gtc))
+        return evaluate_map(minc, i, j, mri1, mri2, mask1, mask2, seg1, seg2, output_base, baa=baa)
 
 def generate_xfm_direct_minctracc(i , j, mri1, mri2, mask1, mask2, seg1, seg2, output_base,step=2,baa=False):
     with mincTools(verbose=2) as minc:
         # normalize xfms
         minc.non_linear_register_full(mri1,mri2,output_base+'_map.xfm',level=step,source_mask=mask1,target_mask=mask2)
 
-        # resample mris
-        minc.resample_smooth(mri2,minc.tmp('mri2.mnc'),transform=output_base+'_map.xfm',invert_transform=True)
-        # resample segs
-        minc.resample_labels(seg2,minc.tmp('seg2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        minc.resample_labels(mask2,minc.tmp('mask2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        # calculate CC, MI
-        cc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='cc')
-        nmi = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='nmi')
-        ncc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='ncc')
-        msq = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='msq')
-        # calculate label overlap
-        gtc = minc.label_similarity(seg1,minc.tmp('seg2.mnc'),method='gtc')
-
-        # write out result
-        with open(output_base+'_similarity.txt','w') as f:
-            f.write("{},{},{},{},{},{},{}\n".format(i,j,cc,ncc,nmi,msq,gtc))
+        return evaluate_map(minc, i, j, mri1, mri2, mask1, mask2, seg1, seg2, output_base, baa=baa)
 
 
 def generate_xfm_direct_ANTS_CC(i , j, mri1, mri2, mask1, mask2, seg1, seg2, output_base,baa=False,step=2):
@@ -65,22 +65,7 @@ def generate_xfm_direct_ANTS_CC(i , j, mri1, mri2, mask1, mask2, seg1, seg2, out
         minc.non_linear_register_ants(mri1,mri2,minc.tmp('transform.xfm'),target_mask=mask2,parameters=param_cc)
         minc.xfm_normalize(minc.tmp('transform.xfm'),mri1,output_base+'_map.xfm',step=step)
         
-        # resample mris
-        minc.resample_smooth(mri2,minc.tmp('mri2.mnc'),transform=output_base+'_map.xfm',invert_transform=True)
-        # resample segs
-        minc.resample_labels(seg2,minc.tmp('seg2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        minc.resample_labels(mask2,minc.tmp('mask2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        # calculate CC, MI
-        cc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='cc')
-        nmi = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='nmi')
-        ncc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='ncc')
-        msq = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='msq')
-        # calculate label overlap
-        gtc = minc.label_similarity(seg1,minc.tmp('seg2.mnc'),method='gtc')
-
-        # write out result
-        with open(output_base+'_similarity.txt','w') as f:
-            f.write("{},{},{},{},{},{},{}\n".format(i,j,cc,ncc,nmi,msq,gtc))
+        return evaluate_map(minc, i, j, mri1, mri2, mask1, mask2, seg1, seg2, output_base, baa=baa)
 
 
 def generate_xfm_direct_ANTS_MI(i , j, mri1, mri2, mask1, mask2, seg1, seg2, output_base,baa=False,step=2):
@@ -91,22 +76,7 @@ def generate_xfm_direct_ANTS_MI(i , j, mri1, mri2, mask1, mask2, seg1, seg2, out
         minc.non_linear_register_ants(mri1,mri2,minc.tmp('transform.xfm'),target_mask=mask2,parameters=param_mi)
         minc.xfm_normalize(minc.tmp('transform.xfm'),mri1,output_base+'_map.xfm',step=step)
         
-        # resample mris
-        minc.resample_smooth(mri2,minc.tmp('mri2.mnc'),transform=output_base+'_map.xfm',invert_transform=True)
-        # resample segs
-        minc.resample_labels(seg2,minc.tmp('seg2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        minc.resample_labels(mask2,minc.tmp('mask2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        # calculate CC, MI
-        cc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='cc')
-        nmi = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='nmi')
-        ncc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='ncc')
-        msq = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='msq')
-        # calculate label overlap
-        gtc = minc.label_similarity(seg1,minc.tmp('seg2.mnc'),method='gtc')
-
-        # write out result
-        with open(output_base+'_similarity.txt','w') as f:
-            f.write("{},{},{},{},{},{},{}\n".format(i,j,cc,ncc,nmi,msq,gtc))
+        return evaluate_map(minc, i, j, mri1, mri2, mask1, mask2, seg1, seg2, output_base, baa=baa)
             
 def generate_xfm_direct_elastix_cc(i , j, mri1, mri2, mask1, mask2, seg1, seg2, output_base,baa=False,step=2):
     with mincTools(verbose=2) as minc:
@@ -166,22 +136,7 @@ def generate_xfm_direct_elastix_cc(i , j, mri1, mri2, mask1, mask2, seg1, seg2,
         minc.register_elastix(mri1,mri2,output_xfm=minc.tmp('transform.xfm'),source_mask=mask1,target_mask=mask2,parameters=param_cc)
         minc.xfm_normalize(minc.tmp('transform.xfm'),mri1,output_base+'_map.xfm',step=step)
 
-	# resample mris
-        minc.resample_smooth(mri2,minc.tmp('mri2.mnc'),transform=output_base+'_map.xfm',invert_transform=True)  
-        # resample segs
-        minc.resample_labels(seg2,minc.tmp('seg2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        minc.resample_labels(mask2,minc.tmp('mask2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        # calculate CC, MI
-        cc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='cc')
-        nmi = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='nmi')
-        ncc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='ncc')
-        msq = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='msq')
-        # calculate label overlap
-        gtc = minc.label_similarity(seg1,minc.tmp('seg2.mnc'),method='gtc')
-
-        # write out result
-        with open(output_base+'_similarity.txt','w') as f:
-            f.write("{},{},{},{},{},{},{}\n".format(i,j,cc,ncc,nmi,msq,gtc))
+        return evaluate_map(minc, i, j, mri1, mri2, mask1, mask2, seg1, seg2, output_base, baa=baa)
 
 
 def generate_xfm_direct_elastix_mi(i , j, mri1, mri2, mask1, mask2, seg1, seg2, output_base,baa=False,step=2):
@@ -242,22 +197,48 @@ def generate_xfm_direct_elastix_mi(i , j, mri1, mri2, mask1, mask2, seg1, seg2,
         minc.register_elastix(mri1,mri2,output_xfm=minc.tmp('transform.xfm'),source_mask=mask1,target_mask=mask2,parameters=param_mi)
         minc.xfm_normalize(minc.tmp('transform.xfm'),mri1,output_base+'_map.xfm',step=step)
         
-        # resample mris
-        minc.resample_smooth(mri2,minc.tmp('mri2.mnc'),transform=output_base+'_map.xfm',invert_transform=True)
-        # resample segs
-        minc.resample_labels(seg2,minc.tmp('seg2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        minc.resample_labels(mask2,minc.tmp('mask2.mnc'),transform=output_base+'_map.xfm',invert_transform=True,baa=baa)
-        # calculate CC, MI
-        cc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='cc')
-        nmi = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='nmi')
-        ncc = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='ncc')
-        msq = minc.similarity(mri1,minc.tmp('mri2.mnc'),ref_mask=mask1,sample_mask=minc.tmp('mask2.mnc'),method='msq')
-        # calculate label overlap
-        gtc = minc.label_similarity(seg1,minc.tmp('seg2.mnc'),method='gtc')
-
-        # write out result
-        with open(output_base+'_similarity.txt','w') as f:
-            f.write("{},{},{},{},{},{},{}\n".format(i,j,cc,ncc,nmi,msq,gtc))
+        return evaluate_map(minc, i, j, mri1, mri2, mask1, mask2, seg1, seg2, output_base, baa=baa)
+
+
+class pairwise_manifest(object):
+    """Completed pairs of the pairwise registration matrix
+
+    Subjects keep their index when new ones are added, so that only
+    new rows and columns of the matrix have to be computed.
+    """
+    def __init__(self, path):
+        self.path=path
+        self.subjects=[]
+        self.done={}
+        if os.path.exists(path):
+            with open(path,'r') as f:
+                m=json.load(f)
+            self.subjects=m['subjects']
+            self.done={k:set(tuple(p) for p in v) for (k,v) in m['done'].items()}
+
+    def index(self, subject):
+        """index of the subject, new subjects are appended"""
+        if subject not in self.subjects:
+            self.subjects.append(subject)
+        return self.subjects.index(subject)
+
+    def is_done(self, method, i, k, output_base):
+        if (i,k) in self.done.get(method,set()):
+            return True
+        # completed by a run that didn't save the manifest
+        if os.path.exists(output_base+'_similarity.txt'):
+            self.add(method, i, k)
+            return True
+        return False
+
+    def add(self, method, i, k):
+        self.done.setdefault(method,set()).add((i,k))
+
+    def save(self):
+        with open(self.path+'.tmp','w') as f:
+            json.dump({'subjects': self.subjects,
+                       'done': {k:sorted(list(p) for p in v) for (k,v) in self.done.items()}},f)
+        os.rename(self.path+'.tmp',self.path)
 
 
 if __name__ == '__main__':
@@ -282,55 +263,61 @@ if __name__ == '__main__':
     print(repr(mri))
     print(repr(mask))
     print(repr(seg))
-    rr=[]
-    
-    # generate uniform file names!
-    for (i,j) in enumerate(model_results['xfm']):
-        for (k,t) in enumerate(model_results['xfm']):
-            if i!=k:
-                if not os.path.exists(output+os.sep+'A_{:02d}_{:02d}_map.xfm'.format(i,k) ) :
-                    rr.append( futures.submit( generate_xfm_model,i,k,
-                                j['xfm'],t['xfm'],
-                                mri[i],mri[k],
-                                mask[i],mask[k],
-                                seg[i],seg[k],
-                                output+os.sep+'A_{:02d}_{:02d}'.format(i,k) ) )
-                            
-                if not os.path.exists(output+os.sep+'B_{:02d}_{:02d}_map.xfm'.format(i,k) ) :
-                    rr.append( futures.submit( generate_xfm_direct_minctracc,i,k,
-                                mri[i],mri[k],
-                                mask[i],mask[k],
-                                seg[i],seg[k],
-                                output+os.sep+'B_{:02d}_{:02d}'.format(i,k),
-                                step=2) )
-
-                if not os.path.exists(output+os.sep+'C_{:02d}_{:02d}_map.xfm'.format(i,k) ) :
-                    rr.append( futures.submit( generate_xfm_direct_ANTS_CC,i,k,
-                                mri[i],mri[k],
-                                mask[i],mask[k],
-                                seg[i],seg[k],
-                                output+os.sep+'C_{:02d}_{:02d}'.format(i,k) ) )
-
-                if not os.path.exists( output+os.sep+'D_{:02d}_{:02d}_map.xfm'.format(i,k) ) :
-                    rr.append( futures.submit( generate_xfm_direct_ANTS_MI,i,k,
-                                mri[i],mri[k],
-                                mask[i],mask[k],
-                                seg[i],seg[k],
-                                output+os.sep+'D_{:02d}_{:02d}'.format(i,k) ) )
-                            
-                if not os.path.exists( output+os.sep+'E_{:02d}_{:02d}_map.xfm'.format(i,k) ) :
-                    rr.append( futures.submit( generate_xfm_direct_elastix_cc,i,k,
-                                mri[i],mri[k],
-                                mask[i],mask[k],
-                                seg[i],seg[k],
-                                output+os.sep+'E_{:02d}_{:02d}'.format(i,k) ) )
-
-                if not os.path.exists( output+os.sep+'F_{:02d}_{:02d}_map.xfm'.format(i,k) ) :
-                    rr.append( futures.submit( generate_xfm_direct_elastix_mi,i,k,
-                                mri[i],mri[k],
-                                mask[i],mask[k],
-                                seg[i],seg[k],
-                                output+os.sep+'F_{:02d}_{:02d}'.format(i,k) ) )
-                
-    futures.wait(rr, return_when=futures.ALL_COMPLETED)
+    manifest=pairwise_manifest(output+os.sep+'manifest.json')
+    idx=[manifest.index(m) for m in mri]
+
+    # method prefix, function, arguments, symmetric - map of k to i is inverse of map of i to k
+    # A only composes model transforms, it is exact and fast in both directions
+    methods=[ ('A', generate_xfm_model,            {'step':step_size}, False ),
+              ('B', generate_xfm_direct_minctracc, {'step':2},         False ),
+              ('C', generate_xfm_direct_ANTS_CC,   {},                 True  ),
+              ('D', generate_xfm_direct_ANTS_MI,   {},                 True  ),
+              ('E', generate_xfm_direct_elastix_cc,{},                 False ),
+              ('F', generate_xfm_direct_elastix_mi,{},                 False ) ]
+
+    def base(method, i, k):
+        return output+os.sep+'{}_{:02d}_{:02d}'.format(method,i,k)
+
+    # first run registrations, then derive inverse maps for symmetric methods
+    for inverse in (False, True):
+        rr=[]
+        for (p,i) in enumerate(idx):
+            for (q,k) in enumerate(idx):
+                if i==k:
+                    continue
+                for (method, fun, args, symmetric) in methods:
+                    if manifest.is_done(method, i, k, base(method, i, k)):
+                        continue
+                    if symmetric and i>k:
+                        # forward map could have failed
+                        if inverse and manifest.is_done(method, k, i, base(method, k, i)):
+                            rr.append( ( method, i, k, futures.submit( generate_xfm_inverse, i, k,
+                                        base(method, k, i),
+                                        mri[p],mri[q],
+                                        mask[p],mask[q],
+                                        seg[p],seg[q],
+                                        base(method, i, k),
+                                        step=step_size ) ) )
+                    elif not inverse:
+                        if method=='A':
+                            rr.append( ( method, i, k, futures.submit( fun, i, k,
+                                        model_results['xfm'][p]['xfm'],model_results['xfm'][q]['xfm'],
+                                        mri[p],mri[q],
+                                        mask[p],mask[q],
+                                        seg[p],seg[q],
+                                        base(method, i, k), **args ) ) )
+                        else:
+                            rr.append( ( method, i, k, futures.submit( fun, i, k,
+                                        mri[p],mri[q],
+                                        mask[p],mask[q],
+                                        seg[p],seg[q],
+                                        base(method, i, k), **args ) ) )
+
+        futures.wait([r[3] for r in rr], return_when=futures.ALL_COMPLETED)
+        for (method, i, k, r) in rr:
+            if r.exception() is None:
+                manifest.add(method, i, k)
+            else:
+                print("Failed {} {} {}:{}".format(method, i, k, repr(r.exception())))
+        manifest.save()
 # kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
@@ -22,6 +22,8 @@ import math
 
 # local stuff
 import minc_tools
+import minc_registration_store
+import minc_grid
 
 
 # hack to make it work on Python 3
@@ -40,6 +42,9 @@ else:
     bytes = str
     basestring = basestring
 
+@minc_registration_store.memoize(outputs=lambda a: {'velocity': a['output_velocity'],
+                                                  'xfm':      a['output_xfm']})
+@minc_grid.compact_outputs(outputs=lambda a: [a['output_xfm']])
 def non_linear_register_ldd(
     source, target,
     output_velocity,
@@ -83,15 +88,12 @@ def non_linear_register_ldd(
             source_lr=minc.tmp(s_base+'_'+str(downsample)+'.mnc')
             target_lr=minc.tmp(t_base+'_'+str(downsample)+'.mnc')
 
-            minc.resample_smooth(source,source_lr,unistep=downsample)
-            minc.resample_smooth(target,target_lr,unistep=downsample)
+            source_lr=minc.downsample(source,downsample,source_lr)
+            target_lr=minc.downsample(target,downsample,target_lr)
 
             if target_mask is not None:
-                target_mask_lr=minc.tmp(s_base+'_mask_'+str(downsample)+'.mnc')
-                minc.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
-            if target_mask is not None:
-                target_mask_lr=minc.tmp(s_base+'_mask_'+str(downsample)+'.mnc')
-                minc.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
+                target_mask_lr=minc.tmp(t_base+'_mask_'+str(downsample)+'.mnc')
+                target_mask_lr=minc.downsample(target_mask,downsample,target_mask_lr,labels=True)
 
 
         prog=''
@@ -174,6 +176,8 @@ def non_linear_register_ldd(
         minc.command(cmd, inputs=inputs, outputs=outputs)
         # todo add dependency for masks
 
+@minc_registration_store.memoize(outputs=lambda a: {'xfm': a['output_xfm']})
+@minc_grid.compact_outputs(outputs=lambda a: [a['output_xfm']])
 def non_linear_register_dd(
     source,
     target,
@@ -215,15 +219,12 @@ def non_linear_register_dd(
             source_lr=minc.tmp(s_base+'_'+str(downsample)+'.mnc')
             target_lr=minc.tmp(t_base+'_'+str(downsample)+'.mnc')
 
-            minc.resample_smooth(source,source_lr,unistep=downsample)
-            minc.resample_smooth(target,target_lr,unistep=downsample)
+            source_lr=minc.downsample(source,downsample,source_lr)
+            target_lr=minc.downsample(target,downsample,target_lr)
 
             if target_mask is not None:
-                target_mask_lr=minc.tmp(s_base+'_mask_'+str(downsample)+'.mnc')
-                minc.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
-            if target_mask is not None:
-                target_mask_lr=minc.tmp(s_base+'_mask_'+str(downsample)+'.mnc')
-                minc.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
+                target_mask_lr=minc.tmp(t_base+'_mask_'+str(downsample)+'.mnc')
+                target_mask_lr=minc.downsample(target_mask,downsample,target_mask_lr,labels=True)
             
         prog=''
 
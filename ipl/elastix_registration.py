@@ -25,6 +25,8 @@ import argparse
 
 # local stuff
 import minc_tools
+import minc_registration_store
+import minc_grid
 
 
 __lin_template="""
@@ -252,6 +254,7 @@ def lin_xfm_to_elastix(xfm,elastix_par):
 def nl_elastix_to_xfm(elastix_par, xfm, downsample_grid=None, nl=True ):
     """Convert elastix transformation file into minc XFM file"""
     with minc_tools.mincTools() as minc:
+        # overridden by the share of the node thread budget, see minc_async
         threads=os.environ.get('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',1)
         cmd=['transformix', '-tp',  elastix_par, '-out',  minc.tempdir,'-xfm', xfm, '-q', '-threads', str(threads)]
         
@@ -303,6 +306,10 @@ def gen_config_lin(parameters,output_txt,template=__lin_template,def_iterations=
         if 'exact_metric_spacing' in parameters: p.write("(ExactMetricSampleGridSpacing {})\n".format(parameters['exact_metric_spacing']))
 
 
+@minc_registration_store.memoize(outputs=lambda a: {'par': a['output_par'],
+                                                  'xfm': a['output_xfm'],
+                                                  'log': a['output_log']})
+@minc_grid.compact_outputs(outputs=lambda a: [a['output_xfm']])
 def register_elastix( 
                     source, target, 
                     output_par = None,
@@ -421,6 +428,7 @@ def register_elastix(
                                 outputs=outputs )):
             return
         
+        # overridden by the share of the node thread budget, see minc_async
         threads=os.environ.get('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',1)
         
         if parameters is None:
@@ -440,16 +448,16 @@ def register_elastix(
                 source_lr=tmp.cache(s_base+'_'+str(downsample)+'.mnc')
                 target_lr=tmp.cache(t_base+'_'+str(downsample)+'.mnc')
 
-                minc.resample_smooth(source,source_lr,unistep=downsample)
-                minc.resample_smooth(target,target_lr,unistep=downsample)
+                source_lr=minc.downsample(source,downsample,source_lr)
+                target_lr=minc.downsample(target,downsample,target_lr)
 
                 if source_mask is not None:
                     source_mask_lr=tmp.cache(s_base+'_mask_'+str(downsample)+'.mnc')
-                    minc.resample_labels(source_mask,source_mask_lr,unistep=downsample,datatype='byte')
+                    source_mask_lr=minc.downsample(source_mask,downsample,source_mask_lr,labels=True)
 
                 if target_mask is not None:
-                    target_mask_lr=tmp.cache(s_base+'_mask_'+str(downsample)+'.mnc')
-                    minc.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
+                    target_mask_lr=tmp.cache(t_base+'_mask_'+str(downsample)+'.mnc')
+                    target_mask_lr=minc.downsample(target_mask,downsample,target_mask_lr,labels=True)
             
             _iterations=1
             
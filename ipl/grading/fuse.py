@@ -174,6 +174,8 @@ def fusion_grading( input_scan,
     # should we use ANTs
     library_preselect=        parameters.get('library_preselect', 10)
     library_preselect_step=   parameters.get('library_preselect_step', None)
+    # compare library only inside the local model mask
+    library_preselect_mask=   parameters.get('library_preselect_mask', False)
     library_preselect_method= parameters.get('library_preselect_method', 'MI')
     
 
@@ -476,6 +478,7 @@ def fusion_grading( input_scan,
                                        number=library_preselect,
                                        use_nl=library_nl_samples_avail,
                                        step=library_preselect_step,
+                                       mask=local_model.mask if library_preselect_mask else None,
                                        lib_add_n=library_modalities,
                                        groups=groups) 
             if segment_symmetric:
@@ -487,6 +490,7 @@ def fusion_grading( input_scan,
                                              use_nl=library_nl_samples_avail,
                                              flip=True,
                                              step=library_preselect_step,
+                                             mask=local_model.mask if library_preselect_mask else None,
                                              lib_add_n=library_modalities,
                                              groups=groups)
         else:
@@ -497,6 +501,7 @@ def fusion_grading( input_scan,
                                        number=library_preselect,
                                        use_nl=False,
                                        step=library_preselect_step,
+                                       mask=local_model.mask if library_preselect_mask else None,
                                        lib_add_n=library_modalities,
                                        groups=groups)
             if segment_symmetric:
@@ -506,6 +511,7 @@ def fusion_grading( input_scan,
                                              number=library_preselect,
                                              use_nl=False,flip=True,
                                              step=library_preselect_step,
+                                             mask=local_model.mask if library_preselect_mask else None,
                                              lib_add_n=library_modalities,
                                              groups=groups)
 
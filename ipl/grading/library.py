@@ -10,6 +10,8 @@ import os
 import sys
 import traceback
 
+from ipl.minc_header import index_files,load_index
+
 def save_library_info(library_description, output,name='library.json'):
     """Save library information into directory, using predfined file structure
     Arguments:
@@ -51,6 +53,11 @@ def save_library_info(library_description, output,name='library.json'):
 
         with open(output+os.sep+name,'w') as f:
             json.dump(tmp_library_description,f,indent=1)
+
+        # headers of the library files, loaded with the library
+        files=[t for i in library_description['library'] for t in i if isinstance(t,basestring)]
+        files.extend([library_description.get(i,None) for i in ['model','model_mask','local_model','local_model_mask']])
+        index_files(output+os.sep+'headers.json', files, prefix=output)
     except :
         print "Error saving library information into:{} {}".format(output,sys.exc_info()[0])
         traceback.print_exc(file=sys.stderr)
@@ -70,6 +77,7 @@ def load_library_info(prefix, name='library.json'):
             library_description=json.load(f)
 
         library_description['prefix']=prefix
+        load_index(prefix+os.sep+'headers.json')
 
         for i in ['local_model','local_model_mask', 'local_model_flip',
                  'local_model_mask_flip','local_model_seg']:
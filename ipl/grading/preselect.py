@@ -14,6 +14,7 @@ import json
 
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
+from ipl.minc_preselect import library_similarity,PreselectError
 
 # scoop parallel execution
 from scoop import futures, shared
@@ -35,7 +36,8 @@ def preselect(sample,
               flip=False,
               step=None,
               lib_add_n=0,
-              groups=None):
+              groups=None,
+              engine=None):
     '''calculate requested similarity function and return top number of elements from the library'''
     results=[]
     column=2 # skip over grading and group
@@ -43,14 +45,37 @@ def preselect(sample,
     # TODO: use multiple modalities for preselection?
     if use_nl:
         column=6+lib_add_n
+
+    if engine is None:
+        engine=os.environ.get('IPL_CALC_ENGINE',None)
+
+    cost=None
+    if engine=='numpy':
+        # compare with all library entries at once
+        try:
+            cost=library_similarity(sample.scan_f if flip else sample.scan,
+                                    [j[column] for j in library],
+                                    mask=mask, method=method, step=step)
+        except PreselectError as e:
+            print("Can't run in-process:{}".format(str(e)))
+
+    if cost is None:
+        if step is None:
+            # figure out step size once for all library entries, 
+            # minctracc works extremely slow when step size is smaller then file step size
+            info_sample=mincTools.mincinfo( sample.scan )
+            step= max( abs( info_sample['xspace'].step ) ,
+                       abs( info_sample['yspace'].step ) ,
+                       abs( info_sample['zspace'].step ) )
         
-    for (i,j) in enumerate(library):
-        results.append( futures.submit(
-            calculate_similarity, sample, MriDataset(scan=j[column]), method=method, mask=mask, flip=flip, step=step
-            ) )
-    futures.wait(results, return_when=futures.ALL_COMPLETED)
+        for (i,j) in enumerate(library):
+            results.append( futures.submit(
+                calculate_similarity, sample, MriDataset(scan=j[column]), method=method, mask=mask, flip=flip, step=step
+                ) )
+        futures.wait(results, return_when=futures.ALL_COMPLETED)
+        cost=[j.result() for j in results]
 
-    val=[ (j.result(), int(library[i][0]), library[i] ) for (i,j) in enumerate(results)]
+    val=[ (j, int(library[i][0]), library[i] ) for (i,j) in enumerate(cost)]
     
     if groups is None:
       val_sorted=sorted(val, key=lambda s: s[0] )
@@ -76,9 +101,6 @@ def calculate_similarity(sample1, sample2,
             if flip:
                 scan=sample1.scan_f
                 
-            # figure out step size, minctracc works extremely slow when step size is smaller then file step size
-            info_sample1=m.mincinfo( sample1.scan )
-            
             cmds=[ 'minctracc', scan, sample2.scan, '-identity' ]
             
             if method=='MI':
@@ -87,6 +109,8 @@ def calculate_similarity(sample1, sample2,
                 cmds.append( '-xcorr' )
 
             if step is None:
+                # figure out step size, minctracc works extremely slow when step size is smaller then file step size
+                info_sample1=m.mincinfo( sample1.scan )
                 step= max( abs( info_sample1['xspace'].step ) ,
                            abs( info_sample1['yspace'].step ) ,
                            abs( info_sample1['zspace'].step ) )
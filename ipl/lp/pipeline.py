@@ -108,6 +108,7 @@ def standard_pipeline(info,
             t1w_scan         = info['t1w']
             add_scans        = info.get('add', None)
             init_t1w_lin_xfm = info.get('init_t1w_lin_xfm', None)
+            init_t1w_nl_xfm  = info.get('init_t1w_nl_xfm', None)
             manual           = options.get('manual',None)
             
 
@@ -601,7 +602,8 @@ def standard_pipeline(info,
                 # perform non-linear registration
                 if run_nl: 
                     nl_registration(t1w_tal, model_t1w, nl_xfm, 
-                                parameters=options.get('nl_reg',{}))
+                                parameters=options.get('nl_reg',{}),
+                                init_xfm=init_t1w_nl_xfm)
                     iter_summary["nl_xfm"]=nl_xfm
                 
                 # run tissue classification
@@ -36,12 +36,14 @@ def lin_registration(scan, model, out_xfm, init_xfm=None, parameters={},corr_xfm
         resample       = parameters.get('resample',  False)
         objective      = parameters.get('objective','-xcorr')
         use_model_mask = parameters.get('use_model_mask',False)
+        warm_start     = parameters.get('warm_start',None)
         
         print("Running lin_registration with parameters:{}".format(repr(parameters)))
         
         _init_xfm=None
         _in_scan       = scan.scan
         _in_mask       = scan.mask
+        _warm          = False
         
         _in_model      = model.scan
         _in_model_mask = model.mask
@@ -49,6 +51,14 @@ def lin_registration(scan, model, out_xfm, init_xfm=None, parameters={},corr_xfm
         
         if init_xfm is not None:
             _init_xfm=init_xfm.xfm
+            
+            if warm_start is not None and not close:
+                # skip coarse levels if initialization is good enough
+                if warm_start is True:
+                    warm_start=ipl.registration.warm_start_similarity
+                _warm=ipl.registration.init_similarity(scan.scan, model.scan, init_xfm.xfm, 
+                                                       target_mask=model.mask)>=warm_start
+                close=_warm
 
         if corr_xfm is not None:
             # apply distortion correction before linear registration, 
@@ -114,6 +124,15 @@ def lin_registration(scan, model, out_xfm, init_xfm=None, parameters={},corr_xfm
                 
             if log is not None:
                 output_log=log.fname
+            
+            if _warm:
+                # drop the coarsest resolution
+                _options=options if options is not None else {}
+                _resolutions=_options.get('resolutions',3)
+                _pyramid=_options.get('pyramid','8 8 8  4 4 4  2 2 2').split()
+                if _resolutions>1:
+                    options=dict(_options, resolutions=_resolutions-1,
+                                 pyramid=' '.join(_pyramid[len(_pyramid)//_resolutions:]))
                 
             ipl.elastix_registration.register_elastix(
                 _in_scan,
@@ -151,7 +170,8 @@ def lin_registration(scan, model, out_xfm, init_xfm=None, parameters={},corr_xfm
                 init_xfm=_init_xfm,
                 objective=objective,
                 downsample=downsample,
-                conf=options,
+                conf=ipl.registration.warm_start_conf(options if options is not None else 'bestlinreg') if _warm else options,
+                close=close,
                 parameters=lin_mode
                 )
         
@@ -277,6 +297,8 @@ def nl_registration(scan, model, out_xfm, init_xfm=None, parameters={}):
     downsample=parameters.get('downsample',None)
     level=parameters.get('level',2)
     start=parameters.get('start_level',32)
+    warm_start=parameters.get('warm_start',None)
+    warm_start_level=parameters.get('warm_start_level',8)
 
     with mincTools() as m:
         
@@ -286,6 +308,15 @@ def nl_registration(scan, model, out_xfm, init_xfm=None, parameters={}):
         _init_xfm=None
         if init_xfm is not None:
             _init_xfm=init_xfm.xfm
+            
+            if warm_start is not None:
+                # skip coarse levels if initialization is good enough
+                if warm_start is True:
+                    warm_start=ipl.registration.warm_start_similarity
+                if ipl.registration.init_similarity(scan.scan, model.scan, init_xfm.xfm, 
+                                                    target_mask=model.mask)>=warm_start:
+                    start=max(level,min(start,warm_start_level))
+                    print("nl_registration: warm start at {}".format(start))
         
         if nl_mode=='ants':
             ipl.ants_registration.non_linear_register_ants2(
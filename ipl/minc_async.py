@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# Background execution of minc tools with a node-wide concurrency governor
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import fcntl
+import resource
+import tempfile
+import threading
+import multiprocessing
+import concurrent.futures
+
+# rough memory use of tools in Mb, for 1mm brain volumes
+tool_memory = {
+    'minctracc':             1000,
+    'itk_resample':          1000,
+    'mincresample':          500,
+    'itk_similarity':        500,
+    'volume_gtc_similarity': 300,
+    'minccalc':              500,
+    'mincmath':              500,
+    'fast_blur':             500,
+    'N4BiasFieldCorrection': 2000,
+    'antsRegistration':      4000,
+    'elastix':               3000,
+    'itk_minc_nonlocal_filter': 2000,
+}
+default_tool_memory = 500
+
+
+def memory_estimate(cmds):
+    """estimated memory use of a command in Mb"""
+    if isinstance(cmds, list) and len(cmds) > 0:
+        tool = os.path.basename(str(cmds[0]))
+    else:
+        tool = str(cmds).split(' ', 1)[0]
+    return tool_memory.get(tool, default_tool_memory)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class governor(object):
+    """Node-wide limit on number and memory of concurrently running commands,
+    shared by all processes using the same ledger file.
+
+    cores  -- number of slots, default IPL_GOVERNOR_CORES or number of cores
+    memory -- memory budget in Mb, default IPL_GOVERNOR_MEMORY or physical memory
+    ledger -- ledger file, default IPL_GOVERNOR_LEDGER or one per user in TMPDIR
+    """
+
+    def __init__(self, cores=None, memory=None, ledger=None):
+        if cores is None:
+            cores = int(os.environ.get('IPL_GOVERNOR_CORES', multiprocessing.cpu_count()))
+        if memory is None:
+            if os.environ.get('IPL_GOVERNOR_MEMORY', None):
+                memory = float(os.environ['IPL_GOVERNOR_MEMORY'])
+            else:
+                memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024.0 * 1024.0)
+        if ledger is None:
+            ledger = os.environ.get('IPL_GOVERNOR_LEDGER',
+                                    os.path.join(tempfile.gettempdir(), 'ipl_governor_{}.json'.format(os.getuid())))
+        self.cores  = cores
+        self.memory = memory
+        self.ledger = ledger
+        self._count = 0
+        self._lock  = threading.Lock()
+
+    def _update(self, fun):
+        """atomically read, modify and write the ledger"""
+        with open(self.ledger, 'a+') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                txt = f.read()
+                entries = json.loads(txt) if len(txt) > 0 else {}
+                # forget about commands of processes that died
+                entries = {k: v for (k, v) in entries.items() if _pid_alive(v[0])}
+                result = fun(entries)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(entries))
+                f.flush()
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return result
+
+    def acquire(self, memory=0, poll=0.2):
+        """wait for a free slot with enough memory, return token"""
+        with self._lock:
+            self._count += 1
+            token = '{}_{}_{}'.format(os.getpid(), threading.current_thread().ident, self._count)
+
+        def _try(entries):
+            used = sum(v[1] for v in entries.values())
+            # always let a single command run, even if it is over the memory budget
+            if len(entries) == 0 or (len(entries) < self.cores and used + memory <= self.memory):
+                entries[token] = [os.getpid(), memory]
+                return True
+            return False
+
+        while not self._update(_try):
+            time.sleep(poll)
+        return token
+
+    def release(self, token):
+        def _remove(entries):
+            entries.pop(token, None)
+        self._update(_remove)
+
+
+# tools using all cores of the node unless told otherwise,
+# tool -> command line option setting number of threads (None - environment only)
+threaded_tools = {
+    'antsRegistration':          None,
+    'antsApplyTransforms':       None,
+    'N4BiasFieldCorrection':     None,
+    'elastix':                   '-threads',
+    'transformix':               '-threads',
+}
+
+
+class thread_budget(object):
+    """Node-wide division of cores between concurrently running multithreaded tools,
+    shared by all processes using the same ledger file.
+
+    Each tool gets a fair share of cores for the number of tools running,
+    but not more than the cores left free by the others.
+
+    cores  -- number of cores, default IPL_THREAD_CORES or number of cores
+    jobs   -- expected number of concurrent tools, i.e number of scoop workers,
+              default IPL_THREAD_JOBS, or number of scoop workers if running
+              under scoop, or 1
+    ledger -- ledger file, default IPL_THREAD_LEDGER or one per user in TMPDIR
+    """
+
+    def __init__(self, cores=None, jobs=None, ledger=None):
+        if cores is None:
+            cores = int(os.environ.get('IPL_THREAD_CORES', multiprocessing.cpu_count()))
+        if jobs is None:
+            jobs = int(os.environ.get('IPL_THREAD_JOBS', scoop_workers()))
+        if ledger is None:
+            ledger = os.environ.get('IPL_THREAD_LEDGER',
+                                    os.path.join(tempfile.gettempdir(), 'ipl_threads_{}.json'.format(os.getuid())))
+        self.cores  = cores
+        self.jobs   = jobs
+        self._ledger = governor(cores=cores, memory=0, ledger=ledger)
+        self._lock  = threading.Lock()
+        self._count = 0
+        self._stats = {}
+
+    def acquire(self):
+        """reserve cores for a tool, return (token, number of threads)"""
+        with self._lock:
+            self._count += 1
+            token = '{}_{}_{}'.format(os.getpid(), threading.current_thread().ident, self._count)
+
+        def _share(entries):
+            allocated = sum(v[1] for v in entries.values())
+            share = max(1, self.cores // max(self.jobs, len(entries) + 1))
+            threads = max(1, min(share, self.cores - allocated))
+            entries[token] = [os.getpid(), threads]
+            return threads
+
+        return (token, self._ledger._update(_share))
+
+    def release(self, token):
+        self._ledger.release(token)
+
+    def record(self, tool, threads, wall, cpu):
+        """account achieved parallel efficiency of a tool"""
+        with self._lock:
+            s = self._stats.setdefault(tool, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'thread_time': 0.0})
+            s['calls']       += 1
+            s['wall']        += wall
+            s['cpu']         += cpu
+            s['thread_time'] += wall * threads
+
+    def stats(self):
+        """return per tool statistics, efficiency is cpu time over wall time times threads"""
+        with self._lock:
+            return {k: dict(v, efficiency=v['cpu'] / v['thread_time'] if v['thread_time'] > 0 else 0.0)
+                    for (k, v) in self._stats.items()}
+
+
+def scoop_workers():
+    """number of scoop workers, 1 if not running under scoop"""
+    try:
+        import scoop
+        if getattr(scoop, 'IS_RUNNING', False):
+            return max(1, int(getattr(scoop, 'SIZE', 1)))
+    except ImportError:
+        pass
+    return 1
+
+
+def threads_enabled():
+    """thread budget is used unless number of ITK threads is set explicitly,
+    or it is disabled with IPL_THREAD_BUDGET=0"""
+    return 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS' not in os.environ and \
+           os.environ.get('IPL_THREAD_BUDGET', '1') != '0'
+
+
+_governor = None
+_thread_budget = None
+_local = threading.local()
+
+
+def get_governor():
+    global _governor
+    if _governor is None:
+        _governor = governor()
+    return _governor
+
+
+def get_thread_budget():
+    global _thread_budget
+    if _thread_budget is None:
+        _thread_budget = thread_budget()
+    return _thread_budget
+
+
+def _tool(cmds):
+    if isinstance(cmds, list) and len(cmds) > 0:
+        return os.path.basename(str(cmds[0]))
+    return None
+
+
+def governed():
+    """commands run by submit() are limited by the governor,
+    synchronous callers only with IPL_GOVERNOR=1"""
+    return getattr(_local, 'governed', False) or os.environ.get('IPL_GOVERNOR', '0') != '0'
+
+
+class slot(object):
+    """Hold a governor slot while running a command;
+    multithreaded tools also get their share of the thread budget,
+    use cmds and env attributes to start the command,
+    set process attribute to the minc_trace.Popen object of the command,
+    to measure efficiency of the tool itself"""
+
+    def __init__(self, cmds):
+        self.cmds = cmds
+        self.env = None
+        self.threads = None
+        self.token = None
+        self.thread_token = None
+        self.process = None
+
+    def __enter__(self):
+        if governed():
+            self.token = get_governor().acquire(memory_estimate(self.cmds))
+        tool = _tool(self.cmds)
+        if tool in threaded_tools and threads_enabled():
+            (self.thread_token, self.threads) = get_thread_budget().acquire()
+            self.env = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(self.threads))
+            option = threaded_tools[tool]
+            if option is not None:
+                cmds = [str(i) for i in self.cmds]
+                if option in cmds[:-1]:
+                    cmds[cmds.index(option) + 1] = str(self.threads)
+                else:
+                    cmds.extend([option, str(self.threads)])
+                self.cmds = cmds
+            self._start = time.time()
+            self._usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.thread_token is not None:
+            usage = getattr(self.process, 'rusage', None)
+            if usage is not None:
+                cpu = usage.ru_utime + usage.ru_stime
+            else:
+                # other children running concurrently are included
+                usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+                cpu = usage.ru_utime - self._usage.ru_utime + \
+                      usage.ru_stime - self._usage.ru_stime
+            get_thread_budget().record(_tool(self.cmds), self.threads, time.time() - self._start, cpu)
+            get_thread_budget().release(self.thread_token)
+        if self.token is not None:
+            get_governor().release(self.token)
+        return False
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """thread pool running submitted functions, one thread per governor slot"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, get_governor().cores))
+        return _pool
+
+
+def _run(fun, args, kwargs):
+    _local.governed = True
+    return fun(*args, **kwargs)
+
+
+class command_future(object):
+    """Result of a function running in background"""
+
+    def __init__(self, fun, args, kwargs):
+        if getattr(_local, 'governed', False):
+            # already in the pool, waiting for another pool thread could deadlock
+            self._future = concurrent.futures.Future()
+            try:
+                self._future.set_result(fun(*args, **kwargs))
+            except Exception as e:
+                self._future.set_exception(e)
+        else:
+            self._future = get_pool().submit(_run, fun, args, kwargs)
+
+    def done(self):
+        return self._future.done()
+
+    def wait(self):
+        """wait for completion, ignoring result"""
+        concurrent.futures.wait([self._future])
+
+    def result(self):
+        """wait for completion, return result or raise exception of the function,
+        with its original traceback"""
+        try:
+            return self._future.result()
+        except Exception as e:
+            print("Exception in background command:{}".format(repr(e)), file=sys.stderr)
+            raise
+
+
+def submit(fun, *args, **kwargs):
+    """run fun(*args, **kwargs) in background, in a pool of as many threads
+    as governor slots, all commands it executes through mincTools are limited
+    by the node-wide governor
+
+    returns future, use result() to get the return value
+    """
+    return command_future(fun, args, kwargs)
+
+
+def wait(futures):
+    """wait for all futures, return list of results
+    raises exception of the first failed function after all are finished"""
+    for f in futures:
+        f.wait()
+    return [f.result() for f in futures]
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# Content-addressed cache of command results
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import hashlib
+import json
+import fcntl
+import time
+import re
+
+# Linux ioctl to clone file extents (copy-on-write copy), see ioctl_ficlone(2)
+_FICLONE = 0x40049409
+
+# memoized content hashes, keyed by (path, size, mtime)
+_content_hashes = {}
+
+
+def content_hash(path):
+    """sha1 of the file contents, memoized by path, size and modification time"""
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_size, st.st_mtime)
+    try:
+        return _content_hashes[key]
+    except KeyError:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _content_hashes[key] = h.hexdigest()
+        return _content_hashes[key]
+
+
+def file_hash(path):
+    """content hash of a file, for transformations also including
+    the displacement volumes they reference"""
+    if not path.endswith('.xfm'):
+        return content_hash(path)
+    h = hashlib.sha1(content_hash(path).encode())
+    for g in _grid_files(path):
+        h.update(content_hash(g).encode())
+    return h.hexdigest()
+
+
+def _clone_file(src, dst, link='reflink'):
+    """materialize src as dst using reflink or hardlink, copy if neither works"""
+    if link == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    elif link == 'reflink':
+        try:
+            with open(src, 'rb') as s:
+                with open(dst, 'wb') as d:
+                    fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+            shutil.copystat(src, dst)
+            return
+        except (IOError, OSError):
+            if os.path.exists(dst):
+                os.unlink(dst)
+    shutil.copy2(src, dst)
+
+
+def _grid_files(xfm):
+    """displacement volumes referenced by a transformation file"""
+    with open(xfm, 'r') as f:
+        text = f.read()
+    return [os.path.join(os.path.dirname(os.path.abspath(xfm)), i)
+            for i in re.findall(r'Displacement_Volume\s*=\s*([^;\s]+)\s*;', text)]
+
+
+def _restore_xfm(src, dst, grids, link='reflink'):
+    """materialize cached transformation with its displacement volumes,
+    renamed after dst"""
+    with open(src, 'r') as f:
+        text = f.read()
+    _base = dst.rsplit('.xfm', 1)[0]
+    for (k, g) in enumerate(grids):
+        _grid = '{}_grid_{}.mnc'.format(_base, k)
+        if os.path.exists(_grid):
+            os.unlink(_grid)
+        _clone_file('{}_grid_{}'.format(src, k), _grid, link=link)
+        text = re.sub(r'(Displacement_Volume\s*=\s*){}(\s*;)'.format(re.escape(g)),
+                      r'\g<1>{}\g<2>'.format(os.path.basename(_grid)), text)
+    with open(dst, 'w') as f:
+        f.write(text)
+
+
+class result_cache(object):
+    """Cache of command outputs keyed by command line and contents of the input files
+
+    cache_dir -- location of the cache, can be shared between runs and work directories
+    max_size  -- size budget in bytes, least recently used entries are evicted
+    link      -- how to materialize hits: 'reflink' (default), 'hardlink' or 'copy'
+                 if reflink or hardlink is not supported a copy is made
+                 NOTE: hardlinked outputs share storage with the cache,
+                 they must not be modified in place
+    """
+
+    def __init__(self, cache_dir, max_size=None, link='reflink', verbose=0):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size  = max_size
+        self.link      = link
+        self.verbose   = verbose
+        self.hits      = 0
+        self.misses    = 0
+        self.stores    = 0
+        self.evictions = 0
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # created by another process
+                pass
+
+    def key(self, cmds, inputs=None, outputs=None):
+        """calculate cache key for a command,
+        return None if the command can't be cached"""
+        if not isinstance(cmds, list) or not outputs:
+            return None
+        if not isinstance(outputs, list):
+            outputs = [outputs]
+        if inputs is None:
+            inputs = []
+        elif not isinstance(inputs, list):
+            inputs = [inputs]
+
+        # normalize outputs to placeholders, so that the key doesn't depend on the work directory
+        _outputs = [os.path.abspath(o) for o in outputs]
+        norm = []
+        for a in cmds:
+            a = str(a)
+            if os.path.abspath(a) in _outputs:
+                norm.append('@out{}'.format(_outputs.index(os.path.abspath(a))))
+            elif os.path.isfile(a):
+                # any existing file on the command line is identified by contents
+                norm.append('@file:' + file_hash(a))
+            else:
+                for (i, o) in enumerate(outputs):
+                    a = a.replace(o, '@out{}'.format(i))
+                norm.append(a)
+        h = hashlib.sha1()
+        h.update(json.dumps(norm).encode())
+        for i in inputs:
+            h.update(file_hash(i).encode())
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key[0:2], key)
+
+    def fetch(self, key, outputs):
+        """materialize cached outputs, return True on a hit
+        displacement volumes of cached transformations are restored next to them"""
+        if not isinstance(outputs, list):
+            outputs = [outputs]
+        entry = self._entry(key)
+        try:
+            grids = {}
+            if os.path.exists(os.path.join(entry, 'grids.json')):
+                with open(os.path.join(entry, 'grids.json'), 'r') as f:
+                    grids = json.load(f)
+            for (i, o) in enumerate(outputs):
+                if os.path.exists(o):
+                    os.unlink(o)
+                if str(i) in grids:
+                    _restore_xfm(os.path.join(entry, 'out_{}'.format(i)), o, grids[str(i)], link=self.link)
+                else:
+                    _clone_file(os.path.join(entry, 'out_{}'.format(i)), o, link=self.link)
+            # mark entry as recently used
+            os.utime(entry, None)
+        except (IOError, OSError):
+            # missing or evicted entry
+            for o in outputs:
+                if os.path.exists(o):
+                    os.unlink(o)
+            self.misses += 1
+            return False
+        self.hits += 1
+        if self.verbose > 0:
+            print("Cache hit:{} -> {}".format(key, repr(outputs)))
+        return True
+
+    def store(self, key, outputs, cmds=None, info=None):
+        """store outputs of a successfully finished command,
+        info -- additional json-serializable entries for info.json"""
+        if not isinstance(outputs, list):
+            outputs = [outputs]
+        if not all(os.path.isfile(o) for o in outputs):
+            return
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        if not os.path.exists(os.path.dirname(entry)):
+            try:
+                os.makedirs(os.path.dirname(entry))
+            except OSError:
+                pass
+        _tmp = tempfile.mkdtemp(prefix='.tmp_', dir=os.path.dirname(entry))
+        try:
+            grids = {}
+            for (i, o) in enumerate(outputs):
+                _clone_file(o, os.path.join(_tmp, 'out_{}'.format(i)), link=self.link)
+                # non-linear transformations reference displacement volumes
+                if o.endswith('.xfm'):
+                    _grids = _grid_files(o)
+                    for (k, g) in enumerate(_grids):
+                        _clone_file(g, os.path.join(_tmp, 'out_{}_grid_{}'.format(i, k)), link=self.link)
+                    if _grids:
+                        grids[i] = [os.path.basename(g) for g in _grids]
+            if grids:
+                with open(os.path.join(_tmp, 'grids.json'), 'w') as f:
+                    json.dump(grids, f)
+            _info = {'cmd': cmds, 'outputs': outputs, 'time': time.time()}
+            if info is not None:
+                _info.update(info)
+            with open(os.path.join(_tmp, 'info.json'), 'w') as f:
+                json.dump(_info, f)
+            os.rename(_tmp, entry)
+            self.stores += 1
+        except OSError:
+            # another process stored the same entry
+            pass
+        finally:
+            if os.path.exists(_tmp):
+                shutil.rmtree(_tmp)
+        if self.max_size is not None:
+            self.evict()
+
+    def size(self):
+        """return list of (last use time, size, entry) for all entries"""
+        entries = []
+        for d in os.listdir(self.cache_dir):
+            _d = os.path.join(self.cache_dir, d)
+            if not os.path.isdir(_d):
+                continue
+            for e in os.listdir(_d):
+                if e.startswith('.tmp_'):
+                    continue
+                _e = os.path.join(_d, e)
+                try:
+                    _size = sum(os.path.getsize(os.path.join(_e, f)) for f in os.listdir(_e))
+                    entries.append((os.path.getmtime(_e), _size, _e))
+                except OSError:
+                    pass
+        return entries
+
+    def evict(self, max_size=None):
+        """remove least recently used entries until the cache fits into max_size"""
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return
+        with open(os.path.join(self.cache_dir, '.lock'), 'a') as lock:
+            fcntl.lockf(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                entries = sorted(self.size())
+                total = sum(i[1] for i in entries)
+                for (_, _size, _e) in entries:
+                    if total <= max_size:
+                        break
+                    shutil.rmtree(_e, ignore_errors=True)
+                    total -= _size
+                    self.evictions += 1
+            finally:
+                fcntl.lockf(lock.fileno(), fcntl.LOCK_UN)
+
+    def stats(self):
+        """return hit/miss counters"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'stores': self.stores, 'evictions': self.evictions}
+
+
+_cache = None
+
+
+def setup_cache(cache_dir, max_size=None, link='reflink', verbose=0):
+    """enable result cache for all commands run through mincTools.command"""
+    global _cache
+    if cache_dir is None:
+        _cache = None
+    else:
+        _cache = result_cache(cache_dir, max_size=max_size, link=link, verbose=verbose)
+    return _cache
+
+
+def get_cache():
+    """return active result cache or None,
+    cache can be enabled with setup_cache or environment variables:
+    IPL_RESULT_CACHE - cache directory
+    IPL_RESULT_CACHE_SIZE - size budget in Gb
+    IPL_RESULT_CACHE_LINK - reflink, hardlink or copy
+    """
+    global _cache
+    if _cache is None and os.environ.get('IPL_RESULT_CACHE', None):
+        _size = os.environ.get('IPL_RESULT_CACHE_SIZE', None)
+        if _size is not None:
+            _size = int(float(_size) * 1024 ** 3)
+        setup_cache(os.environ['IPL_RESULT_CACHE'], max_size=_size,
+                    link=os.environ.get('IPL_RESULT_CACHE_LINK', 'reflink'))
+    return _cache
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
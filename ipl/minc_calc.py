@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# In-process implementation of the subset of minccalc/mincmath we use
+
+from __future__ import print_function
+
+import os
+import sys
+import re
+import operator
+
+import minc_header
+
+try:
+    import numpy as np
+    from minc2_simple import minc2_file
+    HAVE_NUMPY_MINC = True
+except ImportError:
+    HAVE_NUMPY_MINC = False
+
+
+class CalcError(ValueError):
+    """Expression can't be handled in-process, caller should use minc tools"""
+    pass
+
+
+_token_re = re.compile(r'''
+    \s*(?:
+      (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?) |
+      (?P<name>[A-Za-z_][A-Za-z_0-9]*) |
+      (?P<op>&&|\|\||==|!=|<=|>=|[-+*/^<>!?:(),\[\]])
+    )''', re.VERBOSE)
+
+
+def _tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.rstrip().rstrip(';')
+    while pos < len(expression):
+        m = _token_re.match(expression, pos)
+        if m is None or m.end() == pos:
+            if expression[pos:].strip() == '':
+                break
+            raise CalcError("Unsupported token at:{}".format(expression[pos:]))
+        pos = m.end()
+        for kind in ('number', 'name', 'op'):
+            if m.group(kind) is not None:
+                tokens.append((kind, m.group(kind)))
+                break
+    return tokens
+
+
+def _as_bool(x):
+    return np.not_equal(x, 0.0)
+
+
+def _as_float(x):
+    return np.asarray(x, dtype=np.float64)
+
+
+def _clamp(x, lo, hi):
+    return np.minimum(np.maximum(x, lo), hi)
+
+
+# functions of minccalc we know how to vectorize, name -> (number of args, implementation)
+_functions = {
+    'abs':   (1, np.abs),
+    'exp':   (1, np.exp),
+    'log':   (1, np.log),
+    'sqrt':  (1, np.sqrt),
+    'clamp': (3, _clamp),
+}
+
+_binary = {
+    '+':  operator.add,
+    '-':  operator.sub,
+    '*':  operator.mul,
+    '/':  operator.truediv,
+    '<':  lambda a, b: _as_float(np.less(a, b)),
+    '<=': lambda a, b: _as_float(np.less_equal(a, b)),
+    '>':  lambda a, b: _as_float(np.greater(a, b)),
+    '>=': lambda a, b: _as_float(np.greater_equal(a, b)),
+    '==': lambda a, b: _as_float(np.equal(a, b)),
+    '!=': lambda a, b: _as_float(np.not_equal(a, b)),
+    '&&': lambda a, b: _as_float(np.logical_and(_as_bool(a), _as_bool(b))),
+    '||': lambda a, b: _as_float(np.logical_or(_as_bool(a), _as_bool(b))),
+}
+
+# binary operator precedence, same as in minccalc grammar (higher binds tighter)
+_precedence = [
+    ('||',),
+    ('&&',),
+    ('==', '!='),
+    ('<', '<=', '>', '>='),
+    ('+', '-'),
+    ('*', '/'),
+]
+
+
+class _Parser(object):
+    """Recursive descent parser, produces a tree of closures f(A)"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.max_input = -1
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def take(self, value=None):
+        tok = self.peek()
+        if tok[0] is None or (value is not None and tok[1] != value):
+            raise CalcError("Expected {} got {}".format(repr(value), repr(tok[1])))
+        self.pos += 1
+        return tok
+
+    def parse(self):
+        node = self.ternary()
+        if self.pos != len(self.tokens):
+            raise CalcError("Unexpected token:{}".format(self.peek()[1]))
+        return node
+
+    def ternary(self):
+        cond = self.binary(0)
+        if self.peek()[1] == '?':
+            self.take('?')
+            a = self.ternary()
+            self.take(':')
+            b = self.ternary()
+            return lambda A: np.where(_as_bool(cond(A)), a(A), b(A))
+        return cond
+
+    def binary(self, level):
+        if level >= len(_precedence):
+            return self.unary()
+        node = self.binary(level + 1)
+        while self.peek()[0] == 'op' and self.peek()[1] in _precedence[level]:
+            op = _binary[self.take()[1]]
+            rhs = self.binary(level + 1)
+            node = (lambda f, l, r: lambda A: f(l(A), r(A)))(op, node, rhs)
+        return node
+
+    def power(self):
+        base = self.primary()
+        if self.peek()[1] == '^':
+            self.take('^')
+            exponent = self.unary()  # right associative
+            return lambda A: np.power(base(A), exponent(A))
+        return base
+
+    def unary(self):
+        tok = self.peek()
+        if tok[1] == '-':
+            self.take()
+            arg = self.unary()
+            return lambda A: -arg(A)
+        if tok[1] == '+':
+            self.take()
+            return self.unary()
+        if tok[1] == '!':
+            self.take()
+            arg = self.unary()
+            return lambda A: _as_float(np.logical_not(_as_bool(arg(A))))
+        return self.power()
+
+    def primary(self):
+        (kind, value) = self.take()
+        if kind == 'number':
+            const = float(value)
+            return lambda A: const
+        if kind == 'op' and value == '(':
+            node = self.ternary()
+            self.take(')')
+            return node
+        if kind == 'name' and value == 'A' and self.peek()[1] == '[':
+            self.take('[')
+            (kind, idx) = self.take()
+            if kind != 'number' or not re.match(r'^\d+$', idx):
+                raise CalcError("Non-constant volume index:{}".format(idx))
+            self.take(']')
+            idx = int(idx)
+            self.max_input = max(self.max_input, idx)
+            return lambda A: A[idx]
+        if kind == 'name' and value in _functions:
+            (nargs, fun) = _functions[value]
+            self.take('(')
+            args = [self.ternary()]
+            while self.peek()[1] == ',':
+                self.take(',')
+                args.append(self.ternary())
+            self.take(')')
+            if len(args) != nargs:
+                raise CalcError("Function {} expects {} arguments".format(value, nargs))
+            return lambda A: fun(*[a(A) for a in args])
+        raise CalcError("Unsupported expression element:{}".format(value))
+
+
+def compile_expression(expression):
+    """Compile minccalc expression into a function of a list of numpy arrays
+
+    Returns a tuple (function, number of inputs referenced),
+    raises CalcError if expression uses unsupported constructs
+    """
+    p = _Parser(_tokenize(expression))
+    return (p.parse(), p.max_input + 1)
+
+
+# mincmath operations, name -> function of a list of arrays
+_math_operations = {
+    'add':  lambda A: sum(A[1:], A[0]),
+    'sub':  lambda A: A[0] - A[1],
+    'mult': lambda A: _reduce(np.multiply, A),
+    'div':  lambda A: A[0] / A[1],
+    'max':  lambda A: _reduce(np.maximum, A),
+    'min':  lambda A: _reduce(np.minimum, A),
+    'abs':  lambda A: np.abs(A[0]),
+    'sqrt': lambda A: np.sqrt(A[0]),
+    'exp':  lambda A: np.exp(A[0]),
+    'log':  lambda A: np.log(A[0]),
+}
+
+
+def _reduce(fun, A):
+    out = A[0]
+    for i in A[1:]:
+        out = fun(out, i)
+    return out
+
+
+def _datatype(datatype, default):
+    """convert minc tools datatype option into minc2_simple type"""
+    if datatype is None:
+        return default
+    _types = {
+        'byte':   minc2_file.MINC2_UBYTE,
+        'short':  minc2_file.MINC2_SHORT,
+        'int':    minc2_file.MINC2_INT,
+        'long':   minc2_file.MINC2_INT,
+        'float':  minc2_file.MINC2_FLOAT,
+        'double': minc2_file.MINC2_DOUBLE,
+    }
+    try:
+        return _types[datatype.lstrip('-')]
+    except KeyError:
+        raise CalcError("Unsupported datatype:{}".format(datatype))
+
+
+def _integer_type(t):
+    return t in (minc2_file.MINC2_BYTE,  minc2_file.MINC2_UBYTE,
+                 minc2_file.MINC2_SHORT, minc2_file.MINC2_USHORT,
+                 minc2_file.MINC2_INT,   minc2_file.MINC2_UINT)
+
+
+def _evaluate(fun, inputs, output, datatype=None, labels=False):
+    """load inputs, apply fun and save output using header of the first input"""
+    if not HAVE_NUMPY_MINC:
+        raise CalcError("numpy or minc2_simple is not available")
+
+    volumes = []
+    ref = None
+    try:
+        for i in inputs:
+            f = minc2_file(i)
+            f.setup_standard_order()
+            volumes.append(f.load_complete_volume(minc2_file.MINC2_DOUBLE))
+            # header of the first input is used for the output
+            if ref is None:
+                ref = f
+            else:
+                f.close()
+            if volumes[-1].shape != volumes[0].shape:
+                raise CalcError("Input volumes have different dimensions")
+
+        with np.errstate(all='ignore'):
+            result = fun(volumes)
+        result = np.broadcast_to(_as_float(result), volumes[0].shape)
+
+        store_type = _datatype(datatype, ref.data_type)
+        if labels:
+            # same as minccalc -labels, otherwise real values are scaled
+            # into the range of integer types by minc2_simple
+            result = np.rint(np.nan_to_num(result))
+
+        out = minc2_file()
+        out.define(ref.store_dims(), store_type, minc2_file.MINC2_DOUBLE)
+        out.create(output)
+        out.copy_metadata(ref)
+        out.setup_standard_order()
+        out.save_complete_volume(np.ascontiguousarray(result))
+        out.close()
+    finally:
+        if ref is not None:
+            ref.close()
+
+
+def calc(inputs, expression, output, datatype=None, labels=False):
+    """in-process equivalent of: minccalc -copy_header -express expression inputs output
+
+    raises CalcError if the expression or the inputs can't be handled
+    """
+    (fun, n_inputs) = compile_expression(expression)
+    if n_inputs > len(inputs):
+        raise CalcError("Expression {} references more than {} inputs".format(expression, len(inputs)))
+    _evaluate(fun, inputs, output, datatype=datatype, labels=labels)
+
+
+def math(inputs, operation, output, datatype=None):
+    """in-process equivalent of: mincmath -copy_header -operation inputs output
+
+    raises CalcError if the operation or the inputs can't be handled
+    """
+    try:
+        fun = _math_operations[operation]
+    except KeyError:
+        raise CalcError("Unsupported mincmath operation:{}".format(operation))
+    _evaluate(fun, inputs, output, datatype=datatype)
+
+def _load(path):
+    f = minc2_file(path)
+    f.setup_standard_order()
+    data = f.load_complete_volume(minc2_file.MINC2_DOUBLE)
+    f.close()
+    return data
+
+
+def _read_label_defs(label_defs):
+    """label id -> name from a list of pairs, dict or csv file"""
+    if isinstance(label_defs, list):
+        return {int(i[0]): str(i[1]) for i in label_defs}
+    elif isinstance(label_defs, dict):
+        return {int(i): str(j) for (i, j) in label_defs.items()}
+    defs = {}
+    with open(label_defs, 'r') as f:
+        for l in f:
+            l = l.strip()
+            if len(l) > 0 and not l.startswith('#'):
+                (i, _, j) = l.partition(',')
+                try:
+                    defs[int(i)] = j.strip()
+                except ValueError:
+                    # header line
+                    pass
+    return defs
+
+
+def _segment_median(labels, values, n):
+    """median of values for each label 0..n-1, using sorted segment reduction"""
+    order = np.lexsort((values, labels))
+    _values = values[order]
+    counts = np.bincount(labels, minlength=n)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    present = counts > 0
+    lo = starts + np.maximum(counts - 1, 0) // 2
+    hi = starts + counts // 2
+    med = np.zeros(n)
+    med[present] = (_values[lo[present]] + _values[np.minimum(hi, len(_values) - 1)[present]]) / 2.0
+    return med
+
+
+def label_stats(input, bg=False, label_defs=None, volume=None, median=False, mask=None):
+    """in-process equivalent of itk_label_stats
+
+    returns rows: label_id (or name), volume, mx, my, mz, [mean/median]
+    raises CalcError if the inputs can't be handled
+    """
+    if not HAVE_NUMPY_MINC:
+        raise CalcError("numpy or minc2_simple is not available")
+
+    labels = np.rint(_load(input)).astype(np.int64)
+    if labels.ndim != 3:
+        raise CalcError("Only 3D label volumes are supported")
+    if labels.min() < 0:
+        raise CalcError("Negative labels are not supported")
+
+    hdr = minc_header.read_header(input)['dims']
+    # numpy array in standard order is indexed z,y,x
+    axes = ['zspace', 'yspace', 'xspace']
+
+    sel = None
+    if mask is not None:
+        sel = (_load(mask) > 0.5).ravel()
+    if not bg:
+        sel = (labels.ravel() > 0) if sel is None else sel & (labels.ravel() > 0)
+
+    _labels = labels.ravel() if sel is None else labels.ravel()[sel]
+    n = int(_labels.max()) + 1 if _labels.size > 0 else 1
+    counts = np.bincount(_labels, minlength=n)
+    present = counts > 0
+    _counts = np.maximum(counts, 1)
+
+    voxel_volume = 1.0
+    world = np.zeros((n, 3))
+    for (a, name) in enumerate(axes):
+        (_, start, step, dir_cos) = hdr[name]
+        voxel_volume *= abs(step)
+        idx = np.broadcast_to(np.arange(labels.shape[a], dtype=np.float64).reshape(
+            [-1 if k == a else 1 for k in range(3)]), labels.shape).ravel()
+        if sel is not None:
+            idx = idx[sel]
+        c = start + step * np.bincount(_labels, weights=idx, minlength=n) / _counts
+        world += np.outer(c, dir_cos)
+
+    values = None
+    if volume is not None:
+        _values = _load(volume).ravel()
+        if _values.size != labels.size:
+            raise CalcError("Label and intensity volumes have different dimensions")
+        if sel is not None:
+            _values = _values[sel]
+        if median:
+            values = _segment_median(_labels, _values, n)
+        else:
+            values = np.bincount(_labels, weights=_values, minlength=n) / _counts
+
+    names = _read_label_defs(label_defs) if label_defs is not None else None
+    out = []
+    for l in np.nonzero(present)[0]:
+        row = [names.get(int(l), str(l)) if names is not None else int(l),
+               float(counts[l] * voxel_volume),
+               float(world[l, 0]), float(world[l, 1]), float(world[l, 2])]
+        if values is not None:
+            row.append(float(values[l]))
+        out.append(row)
+    return out
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# Pluggable job submission: SGE, local process pool and batched array jobs
+
+from __future__ import print_function
+
+import os
+import sys
+import re
+import shlex
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import argparse
+import atexit
+
+
+class ExecutorError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+
+    def __str__(self):
+        return "ExecutorError({})".format(repr(self.value))
+
+
+def job_script(comm):
+    """bash script running lines of comm"""
+    return "#!/bin/bash\nhostname\n" + "\n".join(comm) + "\n"
+
+
+class executor(object):
+    """Interface of all job submission backends
+
+    submit() - queue a job, given as a list of shell lines, returns job name
+               that can be used in depends of later jobs
+    flush()  - make sure all queued jobs are submitted
+    wait()   - wait for all jobs, only meaningful for local backends
+    """
+
+    def submit(self, comm, name=None, slots=1, logfile=None, depends=None, tasks=None):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+    def wait(self):
+        self.flush()
+        return {}
+
+
+class sge_executor(executor):
+    """Submit jobs with qsub
+
+    pe       -- parallel environment, used when job requires more then one slot
+    queue    -- SGE queue
+    qsub     -- qsub command, default IPL_QSUB or qsub,
+                can point to a local stand-in, i.e "python -m ipl.minc_executor"
+    resources -- list of resource requests, i.e ['h_vmem=6G']
+    """
+
+    def __init__(self, pe=None, queue=None, qsub=None, resources=None, verbose=1):
+        if qsub is None:
+            qsub = os.environ.get('IPL_QSUB', 'qsub')
+        self.qsub      = shlex.split(qsub) if not isinstance(qsub, list) else qsub
+        self.pe        = pe
+        self.queue     = queue
+        self.resources = resources if resources is not None else []
+        self.verbose   = verbose
+
+    def submit(self, comm, name=None, slots=1, logfile=None, depends=None, tasks=None):
+        if not name:
+            name = comm[0].split(' ', 1)[0]
+
+        qsub_comm = self.qsub + ['-cwd', '-N', name, '-j', 'y', '-V']
+        for r in self.resources:
+            qsub_comm.extend(['-l', r])
+        if self.pe is not None:
+            qsub_comm.extend(['-pe', self.pe, str(slots)])
+        path = ''
+        if logfile is not None:
+            path = os.path.abspath(logfile)
+            qsub_comm.extend(['-o', path])
+        if depends:
+            if isinstance(depends, list):
+                depends = ','.join(depends)
+            qsub_comm.extend(['-hold_jid', depends])
+        if self.queue is not None:
+            qsub_comm.extend(['-q', self.queue])
+        if tasks is not None:
+            qsub_comm.extend(['-t', '1-{}'.format(tasks)])
+
+        if self.verbose > 0:
+            print(' - Name    ' + name)
+            if self.pe is not None:
+                print(' - PE      ' + self.pe)
+                print(' - PESLOTS ' + str(slots))
+            if self.queue is not None:
+                print(' - Queue   ' + self.queue)
+            if tasks is not None:
+                print(' - Tasks   ' + str(tasks))
+            print(' - Cmd     ' + ' '.join(comm))
+            print(' - logfile ' + path)
+
+        p = subprocess.Popen(qsub_comm,
+                stdin=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        p.communicate(job_script(comm).encode())
+        if p.wait() != 0:
+            raise ExecutorError("Failed to submit job {}".format(name))
+        return name
+
+
+class local_executor(executor):
+    """Run jobs on the local node, limiting total number of slots in use
+
+    cores -- number of slots, default IPL_EXECUTOR_CORES or number of cores
+    """
+
+    def __init__(self, cores=None, verbose=1):
+        if cores is None:
+            cores = int(os.environ.get('IPL_EXECUTOR_CORES', multiprocessing.cpu_count()))
+        self.cores   = cores
+        self.verbose = verbose
+        self._free   = cores
+        self._cond   = threading.Condition()
+        self._jobs   = {}
+        self._status = {}
+        self._count  = 0
+
+    def _run(self, comm, name, slots, logfile, depends, tasks):
+        failed = False
+        for d in depends:
+            self._jobs[d].join()
+            if self._status.get(d, 0) != 0:
+                failed = True
+        if failed:
+            print("Job {} not started, dependency failed".format(name), file=sys.stderr)
+            self._status[name] = -1
+            return
+        # never wait for more slots then we have
+        slots = min(slots, self.cores)
+
+        _script = tempfile.NamedTemporaryFile(mode='w', suffix='.sh', delete=False)
+        _script.write(job_script(comm))
+        _script.close()
+        status = 0
+        try:
+            for t in range(1, (tasks or 1) + 1):
+                with self._cond:
+                    while self._free < slots:
+                        self._cond.wait()
+                    self._free -= slots
+                try:
+                    env = dict(os.environ)
+                    env['IPL_EXECUTOR_SLOTS'] = str(slots)
+                    if tasks is not None:
+                        env['SGE_TASK_ID'] = str(t)
+                    if logfile is not None:
+                        with open(logfile, 'a') as log:
+                            r = subprocess.call(['bash', _script.name], env=env,
+                                                stdout=log, stderr=subprocess.STDOUT)
+                    else:
+                        r = subprocess.call(['bash', _script.name], env=env)
+                    if r != 0:
+                        status = r
+                finally:
+                    with self._cond:
+                        self._free += slots
+                        self._cond.notify_all()
+        finally:
+            os.unlink(_script.name)
+        self._status[name] = status
+        if status != 0:
+            print("Job {} failed:{}".format(name, status), file=sys.stderr)
+
+    def submit(self, comm, name=None, slots=1, logfile=None, depends=None, tasks=None):
+        if not name:
+            name = comm[0].split(' ', 1)[0]
+        # job names are not unique, keep them apart internally
+        self._count += 1
+        _name = '{}.{}'.format(name, self._count) if name in self._jobs else name
+        if depends is None:
+            depends = []
+        elif not isinstance(depends, list):
+            depends = depends.split(',')
+        _depends = [d for d in depends if d in self._jobs]
+        if self.verbose > 0:
+            print(' - Name    ' + _name)
+            print(' - Slots   ' + str(slots))
+            print(' - Cmd     ' + ' '.join(comm))
+        t = threading.Thread(target=self._run, args=(comm, _name, slots, logfile, _depends, tasks))
+        t.daemon = True
+        self._jobs[_name] = t
+        t.start()
+        return _name
+
+    def wait(self):
+        """wait for all jobs, return dict of failed jobs with their exit codes"""
+        for t in list(self._jobs.values()):
+            t.join()
+        return {k: v for (k, v) in self._status.items() if v != 0}
+
+
+class batch_executor(executor):
+    """Pack many small jobs into array jobs of another backend
+
+    backend -- executor used to submit array jobs
+    batch   -- number of jobs run one after another by a single array task
+    prefix  -- prefix for array job names
+
+    Jobs are queued until flush(), then jobs whose dependencies are all
+    submitted already are grouped into one array job, held on the array jobs
+    containing their dependencies.
+    """
+
+    def __init__(self, backend, batch=10, prefix='batch', verbose=1):
+        self.backend  = backend
+        self.batch    = batch
+        self.prefix   = prefix
+        self.verbose  = verbose
+        self._pending = []
+        # job name -> name of array job it belongs to
+        self._arrays  = {}
+        self._count   = 0
+
+    def submit(self, comm, name=None, slots=1, logfile=None, depends=None, tasks=None):
+        if tasks is not None:
+            raise ExecutorError("Array jobs can't be batched")
+        if not name:
+            name = comm[0].split(' ', 1)[0]
+        if depends is None:
+            depends = []
+        elif not isinstance(depends, list):
+            depends = depends.split(',')
+        self._pending.append({'comm': comm, 'name': name, 'slots': slots,
+                              'logfile': logfile, 'depends': depends})
+        return name
+
+    def _task(self, jobs):
+        """lines running all jobs of a single array task one after another"""
+        lines = []
+        for j in jobs:
+            if j['logfile'] is not None:
+                lines.append('(')
+                lines.extend(j['comm'])
+                lines.append(') >> {} 2>&1'.format(shlex_quote(os.path.abspath(j['logfile']))))
+            else:
+                lines.append('(')
+                lines.extend(j['comm'])
+                lines.append(')')
+        return lines
+
+    def flush(self):
+        pending = self._pending
+        self._pending = []
+        _names = set(j['name'] for j in pending)
+        while len(pending) > 0:
+            # jobs which don't depend on anything still pending
+            ready   = [j for j in pending if not any(d in _names for d in j['depends'])]
+            pending = [j for j in pending if any(d in _names for d in j['depends'])]
+            if len(ready) == 0:
+                raise ExecutorError("Circular dependencies between jobs:{}".format(
+                    ','.join(j['name'] for j in pending)))
+            self._count += 1
+            array = '{}_{}'.format(self.prefix, self._count)
+            chunks = [ready[i:i + self.batch] for i in range(0, len(ready), self.batch)]
+            comm = ['case $SGE_TASK_ID in']
+            for (i, c) in enumerate(chunks):
+                comm.append('{})'.format(i + 1))
+                comm.extend(self._task(c))
+                comm.append(';;')
+            comm.append('esac')
+            depends = sorted(set(self._arrays[d] for j in ready for d in j['depends']
+                                 if d in self._arrays))
+            if self.verbose > 0:
+                print(' - Batch   {} : {}'.format(array, ','.join(j['name'] for j in ready)))
+            self.backend.submit(comm, name=array,
+                                slots=max(j['slots'] for j in ready),
+                                depends=depends if depends else None,
+                                tasks=len(chunks))
+            for j in ready:
+                self._arrays[j['name']] = array
+            _names -= set(j['name'] for j in ready)
+
+    def wait(self):
+        self.flush()
+        return self.backend.wait()
+
+
+def shlex_quote(s):
+    """quote string for shell"""
+    if re.match(r'^[\w@%+=:,./-]+$', s):
+        return s
+    return "'" + s.replace("'", "'\"'\"'") + "'"
+
+
+# executors shared by all submissions of this process, keyed by (kind, pe, queue)
+_executors = {}
+
+
+def _create_executor(kind, pe, queue, cores, batch, resources):
+    if kind == 'sge':
+        return sge_executor(pe=pe, queue=queue, resources=resources)
+    elif kind == 'local':
+        return local_executor(cores=cores)
+    elif kind == 'batch':
+        if batch is None:
+            batch = int(os.environ.get('IPL_EXECUTOR_BATCH', 10))
+        backend = _create_executor(os.environ.get('IPL_EXECUTOR_BACKEND', 'sge'),
+                                   pe, queue, cores, None, resources)
+        return batch_executor(backend, batch=batch)
+    else:
+        raise ExecutorError("Unknown executor:{}".format(kind))
+
+
+def get_executor(kind=None, pe=None, queue=None, cores=None, batch=None, resources=None):
+    """return executor, shared between calls with the same parameters
+
+    kind  -- sge, local or batch, default IPL_EXECUTOR or sge
+    batch -- number of jobs per array task for batch executor,
+             default IPL_EXECUTOR_BATCH or 10,
+             array jobs are submitted to IPL_EXECUTOR_BACKEND (sge or local)
+
+    local jobs are waited for and batched jobs are submitted
+    when the process exits, or use shutdown()
+    """
+    if kind is None:
+        kind = os.environ.get('IPL_EXECUTOR', 'sge')
+    k = (kind, pe, queue, cores, batch, tuple(resources or []))
+    if k not in _executors:
+        _executors[k] = _create_executor(kind, pe, queue, cores, batch, resources)
+    return _executors[k]
+
+
+def shutdown():
+    """submit all queued jobs and wait for local ones,
+    return dict of failed jobs with their exit codes"""
+    failed = {}
+    for e in _executors.values():
+        failed.update(e.wait())
+    _executors.clear()
+    return failed
+
+atexit.register(shutdown)
+
+
+def parse_qsub_options():
+    parser = argparse.ArgumentParser(description='Local stand-in for qsub: runs job script immediately')
+    parser.add_argument('-N', dest='name', default=None)
+    parser.add_argument('-o', dest='output', default=None)
+    parser.add_argument('-t', dest='tasks', default=None)
+    parser.add_argument('-pe', dest='pe', nargs=2, default=None)
+    parser.add_argument('-hold_jid', dest='hold_jid', default=None)
+    parser.add_argument('-q', dest='queue', default=None)
+    parser.add_argument('-l', dest='resources', action='append', default=[])
+    parser.add_argument('-j', dest='join', default=None)
+    parser.add_argument('-cwd', action='store_true', default=False)
+    parser.add_argument('-V', action='store_true', default=False)
+    parser.add_argument('script', nargs='?', default=None)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    # behave like qsub, executing jobs synchronously in submission order,
+    # so dependencies are always satisfied
+    options = parse_qsub_options()
+    if options.script is not None:
+        with open(options.script, 'r') as f:
+            script = f.read()
+    else:
+        script = sys.stdin.read()
+    tasks = [None]
+    if options.tasks is not None:
+        (first, _, last) = options.tasks.partition('-')
+        tasks = range(int(first), int(last or first) + 1)
+    out = open(options.output, 'a') if options.output is not None else sys.stdout
+    status = 0
+    for t in tasks:
+        env = dict(os.environ)
+        if t is not None:
+            env['SGE_TASK_ID'] = str(t)
+        if options.pe is not None:
+            env['NSLOTS'] = options.pe[1]
+        p = subprocess.Popen(['bash'], stdin=subprocess.PIPE, stdout=out, stderr=subprocess.STDOUT, env=env)
+        p.communicate(script.encode())
+        status = status or p.wait()
+    print('Your job {} ("{}") has been submitted'.format(os.getpid(), options.name), file=sys.stderr)
+    sys.exit(status)
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
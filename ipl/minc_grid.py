@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# Compact storage of displacement grids of non-linear transformations
+
+from __future__ import print_function
+
+import os
+import sys
+import math
+import inspect
+import threading
+import functools
+
+import minc_calc
+import minc_header
+import minc_xfm
+import minc_resample
+
+try:
+    import numpy as np
+    import scipy.ndimage
+    from minc2_simple import minc2_file
+    HAVE_NUMPY_MINC = True
+except ImportError:
+    HAVE_NUMPY_MINC = False
+
+
+class GridError(ValueError):
+    """Grid can't be compacted in-process, caller should use minc tools"""
+    pass
+
+
+class grid_storage(object):
+    """Storage mode of displacement grids produced by non-linear registration
+
+    Grids are resampled to a coarser step and optionally stored as 16 bit
+    integers with real value scaling, transformation files are not changed.
+    Minc tools and in-process resampling interpolate displacements, so
+    compacted grids are consumed without any conversion.
+
+    step      -- grid step in mm, finer grids are resampled, None - keep step
+    datatype  -- storage type of the grid, i.e 'short', None - keep type
+    max_error -- maximum displacement error in mm allowed for compacting,
+                 grids exceeding it are kept as is, None - don't check
+    """
+
+    def __init__(self, step=None, datatype=None, max_error=None, verbose=0):
+        self.step      = float(step) if step is not None else None
+        self.datatype  = datatype
+        self.max_error = float(max_error) if max_error is not None else None
+        self.verbose   = verbose
+
+    def _sampling(self, path):
+        """return new (length, start, step) for spatial dimensions,
+        or None if the grid is already coarse enough"""
+        dims = minc_header.read_header(path)['dims']
+        out = {}
+        coarser = False
+        for name in ('xspace', 'yspace', 'zspace'):
+            (length, start, step, _) = dims[name]
+            factor = 1.0
+            if self.step is not None and abs(step) < self.step and length > 1:
+                factor = self.step / abs(step)
+                coarser = True
+            out[name] = (int(math.ceil((length - 1) / factor - 1e-6)) + 1, start, step * factor, factor)
+        return out if coarser else None
+
+    def compact_grid(self, path, tmp):
+        """write compacted grid into tmp, return maximum displacement error
+        raises GridError if it can't be done in-process"""
+        if not HAVE_NUMPY_MINC:
+            raise GridError("numpy, scipy or minc2_simple is not available")
+        sampling = self._sampling(path)
+
+        f = minc2_file(path)
+        f.setup_standard_order()
+        data = f.load_complete_volume(minc2_file.MINC2_DOUBLE)
+        if data.ndim != 4 or data.shape[3] != 3:
+            f.close()
+            raise GridError("Unsupported displacement volume:{}".format(path))
+        dims = f.store_dims()
+
+        if sampling is not None:
+            _ids = {minc2_file.MINC2_DIM_X: 'xspace',
+                    minc2_file.MINC2_DIM_Y: 'yspace',
+                    minc2_file.MINC2_DIM_Z: 'zspace'}
+            for d in dims:
+                if d.id in _ids:
+                    (d.length, d.start, d.step, _) = sampling[_ids[d.id]]
+            # new grid nodes in voxel indices of the original grid, numpy order
+            (z, y, x) = np.mgrid[0:sampling['zspace'][0], 0:sampling['yspace'][0], 0:sampling['xspace'][0]]
+            idx = np.array([z.ravel() * sampling['zspace'][3],
+                            y.ravel() * sampling['yspace'][3],
+                            x.ravel() * sampling['xspace'][3]])
+            shape = z.shape
+            data = np.stack([scipy.ndimage.map_coordinates(data[..., i], idx, order=1, mode='nearest').reshape(shape)
+                             for i in range(3)], axis=3)
+        try:
+            store_type = minc_calc._datatype(self.datatype, minc2_file.MINC2_FLOAT)
+        except ValueError as e:
+            f.close()
+            raise GridError(str(e))
+
+        out = minc2_file()
+        out.define(dims, store_type, minc2_file.MINC2_DOUBLE)
+        out.create(tmp)
+        out.copy_metadata(f)
+        out.setup_standard_order()
+        out.save_complete_volume(np.ascontiguousarray(data))
+        out.close()
+        f.close()
+        return self.error(path, tmp)
+
+    def error(self, original, compact):
+        """maximum distance between displacements of the original grid
+        and of the compact grid interpolated at the original grid nodes"""
+        (v2w, shape) = minc_resample._voxel_to_world(original)
+        a = minc_resample._grid(original)
+        b = minc_resample._grid(compact)
+        (nz, ny, nx) = shape
+        (y, x) = np.mgrid[0:ny, 0:nx]
+        err = 0.0
+        for z in range(nz):
+            idx = np.empty((ny * nx, 3))
+            idx[:, 0] = x.ravel()
+            idx[:, 1] = y.ravel()
+            idx[:, 2] = z
+            points = minc_resample._affine(v2w, idx)
+            d = np.sqrt(((a.displacement(points) - b.displacement(points)) ** 2).sum(axis=1))
+            err = max(err, float(d.max()))
+        return err
+
+    def _compact_grid_tools(self, path, tmp):
+        """compact grid with mincresample"""
+        sampling = self._sampling(path)
+        cmd = ['mincresample', path, tmp, '-trilinear', '-q']
+        if sampling is not None:
+            cmd.extend(['-step'] + [str(sampling[i][2]) for i in ('xspace', 'yspace', 'zspace')])
+            cmd.extend(['-nelements'] + [str(sampling[i][0]) for i in ('xspace', 'yspace', 'zspace')])
+        else:
+            cmd.append('-use_input_sampling')
+        if self.datatype is not None:
+            cmd.append('-' + self.datatype.lstrip('-'))
+        # registration modules using this one are imported by minc_tools
+        import minc_tools
+        with minc_tools.mincTools(verbose=self.verbose) as minc:
+            minc.command(cmd, inputs=[path], outputs=[tmp], verbose=self.verbose)
+
+    def compact(self, xfm):
+        """compact all grids of the transformation in place,
+        return list of grids that were compacted"""
+        done = []
+        for (_type, value, _) in minc_xfm.read_xfm(xfm):
+            if _type != 'Grid_Transform' or value is None or not os.path.exists(value):
+                continue
+            if self._sampling(value) is None and self.datatype is None:
+                continue
+            tmp = os.path.join(os.path.dirname(value), '.tmp_{}_{}_{}'.format(
+                os.getpid(), threading.current_thread().ident, os.path.basename(value)))
+            try:
+                try:
+                    err = self.compact_grid(value, tmp)
+                except GridError as e:
+                    if self.max_error is not None:
+                        # error can't be checked
+                        if self.verbose > 0:
+                            print("Can't compact grid:{} {}".format(value, str(e)))
+                        continue
+                    err = None
+                    self._compact_grid_tools(value, tmp)
+                if self.max_error is not None and err > self.max_error:
+                    if self.verbose > 0:
+                        print("Grid error {} above {}, keeping:{}".format(err, self.max_error, value))
+                    continue
+                os.rename(tmp, value)
+                minc_header.invalidate(value)
+                done.append(value)
+                if self.verbose > 0:
+                    print("Compacted grid:{} error:{}".format(value, err))
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+        return done
+
+
+def compact_outputs(outputs):
+    """decorator, compact grids of transformations produced by registration function
+
+    outputs -- function of the dict of call arguments returning list of output
+               transformation files, files existing before the call are not changed
+    """
+    def decorator(fun):
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            storage = get_grid_storage()
+            if storage is None:
+                return fun(*args, **kwargs)
+            _outputs = [o for o in outputs(inspect.getcallargs(fun, *args, **kwargs))
+                        if o is not None and not os.path.exists(o)]
+            result = fun(*args, **kwargs)
+            for o in _outputs:
+                if os.path.exists(o):
+                    storage.compact(o)
+            return result
+        # let other decorators see the original arguments
+        wrapper.__wrapped__ = fun
+        return wrapper
+    return decorator
+
+
+_storage = None
+
+
+def setup_grid_storage(step=None, datatype=None, max_error=None, verbose=0):
+    """enable compact storage of grids produced by registration functions"""
+    global _storage
+    if step is None and datatype is None:
+        _storage = None
+    else:
+        _storage = grid_storage(step=step, datatype=datatype, max_error=max_error, verbose=verbose)
+    return _storage
+
+
+def get_grid_storage():
+    """return active grid storage mode or None,
+    it can be enabled with setup_grid_storage or environment variables:
+    IPL_GRID_STEP - grid step in mm
+    IPL_GRID_DATATYPE - storage type, i.e short
+    IPL_GRID_MAX_ERROR - maximum displacement error in mm
+    """
+    global _storage
+    if _storage is None and (os.environ.get('IPL_GRID_STEP', None) or os.environ.get('IPL_GRID_DATATYPE', None)):
+        setup_grid_storage(step=os.environ.get('IPL_GRID_STEP', None) or None,
+                           datatype=os.environ.get('IPL_GRID_DATATYPE', None) or None,
+                           max_error=os.environ.get('IPL_GRID_MAX_ERROR', None) or None)
+    return _storage
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# Cached access to MINC file headers
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import subprocess
+import collections
+
+try:
+    from minc2_simple import minc2_file
+    HAVE_MINC2_SIMPLE = True
+except ImportError:
+    HAVE_MINC2_SIMPLE = False
+
+
+dimension = collections.namedtuple('dimension', ['length', 'start', 'step', 'direction_cosines'])
+
+_default_dir_cos = {
+    'xspace': [1.0, 0.0, 0.0],
+    'yspace': [0.0, 1.0, 0.0],
+    'zspace': [0.0, 0.0, 1.0],
+}
+
+# parsed headers, keyed by (realpath, size, mtime)
+_headers = {}
+# attributes read with mincinfo, keyed by (realpath, size, mtime, attribute)
+_attributes = {}
+
+
+def _key(path):
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_size, st.st_mtime)
+
+
+def _read_header_minc2(path):
+    """read dimension information using minc2_simple"""
+    _dim_names = {
+        minc2_file.MINC2_DIM_X:    'xspace',
+        minc2_file.MINC2_DIM_Y:    'yspace',
+        minc2_file.MINC2_DIM_Z:    'zspace',
+        minc2_file.MINC2_DIM_TIME: 'time',
+        minc2_file.MINC2_DIM_VEC:  'vector_dimension',
+    }
+    f = minc2_file(path)
+    # minc2_simple lists dimensions fastest varying first, mincinfo - slowest first
+    dims = list(reversed(f.store_dims()))
+    order = []
+    info = {}
+    for d in dims:
+        name = _dim_names[d.id]
+        order.append(name)
+        if d.have_dir_cos:
+            dir_cos = [d.dir_cos[0], d.dir_cos[1], d.dir_cos[2]]
+        else:
+            dir_cos = _default_dir_cos.get(name, None)
+        info[name] = [d.length, d.start, d.step, dir_cos]
+    f.close()
+    return {'dimorder': order, 'dims': info}
+
+
+def _read_header_mincinfo(path):
+    """read dimension information using mincinfo"""
+    # TODO: make this robust to errors!
+    _image_dims = subprocess.Popen(['mincinfo', '-vardims', 'image', path],
+                         stdout=subprocess.PIPE).communicate()[0].decode().rstrip('\n').rstrip(' ').split(' ')
+
+    _req = ['mincinfo']
+    for i in _image_dims:
+        _req.extend(['-dimlength', i,
+                     '-attvalue', '{}:start'.format(i),
+                     '-attvalue', '{}:step'.format(i),
+                     '-attvalue', '{}:direction_cosines'.format(i)])
+    _req.append(path)
+    _info = subprocess.Popen(_req,
+                         stdout=subprocess.PIPE).communicate()[0].decode().rstrip('\n').rstrip(' ').split("\n")
+    info = {}
+    for i, j in enumerate(_image_dims):
+        info[j] = [int(_info[i*4]),
+                   float(_info[i*4+1]),
+                   float(_info[i*4+2]),
+                   [float(k) for k in _info[i*4+3].rstrip(' ').split(' ')]]
+    return {'dimorder': _image_dims, 'dims': info}
+
+
+def read_header(path):
+    """return dimension order and dimension information of a minc file,
+    parsed once per file version"""
+    k = _key(path)
+    try:
+        return _headers[k]
+    except KeyError:
+        if HAVE_MINC2_SIMPLE:
+            _headers[k] = _read_header_minc2(path)
+        else:
+            _headers[k] = _read_header_mincinfo(path)
+        return _headers[k]
+
+
+def invalidate(path):
+    """forget everything known about the file, i.e after modifying header in place"""
+    _real = os.path.realpath(path)
+    for k in [k for k in _headers if k[0] == _real]:
+        del _headers[k]
+    for k in [k for k in _attributes if k[0] == _real]:
+        del _attributes[k]
+
+
+def dimorder(path):
+    """dimension order, slowest varying first, same as mincinfo -vardims image"""
+    return list(read_header(path)['dimorder'])
+
+
+def mincinfo(path):
+    """dict with dimension entries, same as mincTools.mincinfo"""
+    return {i: dimension(length=j[0], start=j[1], step=j[2], direction_cosines=j[3])
+            for (i, j) in read_header(path)['dims'].items()}
+
+
+def attribute(path, attribute):
+    """value of an attribute as string, same as mincinfo -attvalue"""
+    (var, _, att) = attribute.partition(':')
+    hdr = read_header(path)
+    if att in ('start', 'step') and var in hdr['dims']:
+        # mincinfo prints double attributes with %.20g
+        return '{:.20g}'.format(float(hdr['dims'][var][1 if att == 'start' else 2]))
+
+    k = _key(path) + (attribute,)
+    try:
+        return _attributes[k]
+    except KeyError:
+        i = subprocess.Popen(['mincinfo', '-attvalue', attribute, path],
+                             stdout=subprocess.PIPE).communicate()
+        _attributes[k] = i[0].decode().rstrip('\n').rstrip(' ')
+        return _attributes[k]
+
+
+def load_index(fname):
+    """load persistent header index, entries for modified files are ignored"""
+    if not os.path.exists(fname):
+        return
+    try:
+        with open(fname, 'r') as f:
+            for (path, size, mtime, hdr) in json.load(f):
+                _headers[(path, size, mtime)] = hdr
+    except (IOError, OSError, ValueError) as e:
+        print("Can't load header index:{} {}".format(fname, str(e)))
+
+
+def save_index(fname, prefix=None):
+    """save header index, optionally only for files under prefix"""
+    _prefix = os.path.realpath(prefix) if prefix is not None else None
+    entries = [[k[0], k[1], k[2], v] for (k, v) in _headers.items()
+               if _prefix is None or k[0].startswith(_prefix)]
+    _tmp = fname + '.tmp{}'.format(os.getpid())
+    with open(_tmp, 'w') as f:
+        json.dump(entries, f)
+    os.rename(_tmp, fname)
+
+
+def index_files(fname, files, prefix=None):
+    """read headers of minc files and save them into persistent index,
+    i.e. one per library, to be loaded with load_index"""
+    for i in files:
+        if i is None or not (i.endswith('.mnc') or i.endswith('.mnc.gz')):
+            continue
+        try:
+            read_header(i)
+        except (IOError, OSError, KeyError, ValueError, IndexError):
+            pass
+    save_index(fname, prefix=prefix)
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# In-process library preselection using a stack of downsampled library scans
+# and an embedding index for large libraries
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import math
+import hashlib
+import threading
+
+import minc_header
+
+try:
+    import numpy as np
+    from minc2_simple import minc2_file
+    HAVE_NUMPY_MINC = True
+except ImportError:
+    HAVE_NUMPY_MINC = False
+
+try:
+    import scipy.spatial
+    HAVE_SCIPY_SPATIAL = True
+except ImportError:
+    HAVE_SCIPY_SPATIAL = False
+
+
+class PreselectError(ValueError):
+    """Preselection can't be done in-process, caller should use minctracc"""
+    pass
+
+
+# number of library entries compared at once, limits memory
+chunk_entries = 16
+# number of intensity bins used for mutual information
+nmi_bins = 32
+
+# stacks loaded by this process, keyed by stack key
+_stacks = {}
+
+
+def _load(path):
+    f = minc2_file(path)
+    f.setup_standard_order()
+    data = f.load_complete_volume(minc2_file.MINC2_FLOAT)
+    f.close()
+    if data.ndim != 3:
+        raise PreselectError("Only 3D volumes are supported:{}".format(path))
+    return data
+
+
+def _steps(path):
+    """voxel sizes in numpy order (z,y,x)"""
+    dims = minc_header.read_header(path)['dims']
+    return [abs(dims[i][2]) for i in ('zspace', 'yspace', 'xspace')]
+
+
+def _factor(path, step):
+    """downsampling factor for each dimension giving step in mm,
+    default index_step"""
+    steps = _steps(path)
+    if step is None:
+        step = index_step
+    return [max(1, int(round(float(step) / s))) for s in steps]
+
+
+def downsample(data, factor):
+    """average blocks of factor voxels, partial blocks at the end are dropped"""
+    if all(f == 1 for f in factor):
+        return data.astype(np.float32)
+    shape = [s // f for (s, f) in zip(data.shape, factor)]
+    data = data[0:shape[0] * factor[0], 0:shape[1] * factor[1], 0:shape[2] * factor[2]]
+    return data.reshape(shape[0], factor[0], shape[1], factor[1], shape[2], factor[2]).\
+        mean(axis=(1, 3, 5)).astype(np.float32)
+
+
+class library_stack(object):
+    """Library scans downsampled and stacked into one float32 array
+
+    All scans have to be sampled on the same grid, i.e library in the
+    model space. The stack is kept in RAM of each process, unless stack_dir
+    or IPL_PRESELECT_DIR is set, then it is kept in a memory mapped file
+    there and reused by all processes using the same library.
+
+    scans     -- list of library scans
+    step      -- sampling step in mm, default index_step
+    stack_dir -- directory for the memory mapped stacks, default IPL_PRESELECT_DIR,
+                 '' - keep stack in memory
+    """
+
+    def __init__(self, scans, step=None, stack_dir=None):
+        if not HAVE_NUMPY_MINC:
+            raise PreselectError("numpy or minc2_simple is not available")
+        if len(scans) == 0:
+            raise PreselectError("Empty library")
+        self.factor = _factor(scans[0], step)
+        self.scans = list(scans)
+
+        h = hashlib.sha1()
+        for i in self.scans:
+            st = os.stat(i)
+            h.update(json.dumps([os.path.realpath(i), st.st_size, st.st_mtime]).encode())
+        h.update(json.dumps(self.factor).encode())
+        self.key = h.hexdigest()
+
+        if stack_dir is None:
+            stack_dir = os.environ.get('IPL_PRESELECT_DIR', None)
+        self.stack_dir = stack_dir
+        self.stack = None
+
+    def load(self):
+        """build or map the stack"""
+        if self.stack_dir:
+            self.stack = self._mapped(self.stack_dir)
+        else:
+            data = [downsample(_load(i), self.factor) for i in self.scans]
+            if any(d.shape != data[0].shape for d in data):
+                raise PreselectError("Library scans are sampled differently")
+            self.stack = np.stack(data)
+        return self
+
+    def _mapped(self, stack_dir):
+        path = os.path.join(stack_dir, self.key + '.npy')
+        if not os.path.exists(path):
+            if not os.path.exists(stack_dir):
+                try:
+                    os.makedirs(stack_dir)
+                except OSError:
+                    pass
+            first = downsample(_load(self.scans[0]), self.factor)
+            tmp = os.path.join(stack_dir, '.tmp_{}_{}_{}.npy'.format(os.getpid(), threading.current_thread().ident, self.key))
+            try:
+                out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+                                                shape=(len(self.scans),) + first.shape)
+                out[0] = first
+                for (i, s) in enumerate(self.scans[1:]):
+                    data = downsample(_load(s), self.factor)
+                    if data.shape != first.shape:
+                        raise PreselectError("Library scans are sampled differently:{}".format(s))
+                    out[i + 1] = data
+                out.flush()
+                del out
+                # another process could have built the same stack, either one is fine
+                os.rename(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+        return np.load(path, mmap_mode='r')
+
+    def sample(self, path):
+        """load volume downsampled like the library"""
+        data = downsample(_load(path), self.factor)
+        if data.shape != self.stack.shape[1:]:
+            raise PreselectError("Sample is sampled differently from the library:{}".format(path))
+        return data
+
+    def similarity(self, scan, mask=None, method='MI'):
+        """cost of matching scan to each library entry, lower is better,
+        same ordering as the objective function of minctracc:
+        -NMI for 'MI', 1-correlation otherwise"""
+        x = self.sample(scan)
+        if mask is not None:
+            m = self.sample(mask) > 0.5
+        else:
+            m = np.ones(x.shape, dtype=bool)
+        idx = np.flatnonzero(m)
+        if idx.size == 0:
+            raise PreselectError("Empty mask:{}".format(mask))
+        x = x.ravel()[idx].astype(np.float64)
+        flat = self.stack.reshape(self.stack.shape[0], -1)
+
+        cost = np.empty(self.stack.shape[0])
+        for c in range(0, self.stack.shape[0], chunk_entries):
+            Y = np.asarray(flat[c:c + chunk_entries][:, idx], dtype=np.float64)
+            if method == 'MI':
+                cost[c:c + Y.shape[0]] = -_nmi(x, Y)
+            else:
+                cost[c:c + Y.shape[0]] = 1.0 - _cc(x, Y)
+        return cost
+
+
+def _cc(x, Y):
+    """correlation coefficient of x with each row of Y"""
+    x = x - x.mean()
+    Y = Y - Y.mean(axis=1)[:, None]
+    norm = np.sqrt((Y * Y).sum(axis=1)) * math.sqrt(np.dot(x, x))
+    with np.errstate(all='ignore'):
+        return np.nan_to_num(np.dot(Y, x) / norm)
+
+
+def _bin(v, bins):
+    """intensity bin of each value, v is 1D or rows of 2D array"""
+    lo = v.min(axis=-1)
+    hi = v.max(axis=-1)
+    scale = np.where(hi > lo, bins / np.where(hi > lo, hi - lo, 1.0), 0.0)
+    if v.ndim == 2:
+        (lo, scale) = (lo[:, None], scale[:, None])
+    return np.clip(((v - lo) * scale).astype(np.int64), 0, bins - 1)
+
+
+def _entropy(p, axis):
+    with np.errstate(all='ignore'):
+        return -np.where(p > 0, p * np.log(p), 0.0).sum(axis=axis)
+
+
+def _nmi(x, Y, bins=None):
+    """normalized mutual information (H(x)+H(y))/H(x,y) of x with each row of Y,
+    all joint histograms are computed with a single bincount"""
+    if bins is None:
+        bins = nmi_bins
+    n = Y.shape[0]
+    xb = _bin(x, bins)
+    yb = _bin(Y, bins)
+    joint = np.bincount((np.arange(n)[:, None] * (bins * bins) + xb[None, :] * bins + yb).ravel(),
+                        minlength=n * bins * bins).reshape(n, bins, bins).astype(np.float64)
+    joint /= x.size
+    hx = _entropy(joint.sum(axis=2), 1)
+    hy = _entropy(joint.sum(axis=1), 1)
+    hxy = _entropy(joint.reshape(n, -1), 1)
+    with np.errstate(all='ignore'):
+        return np.where(hxy > 0, (hx + hy) / hxy, 0.0)
+
+
+def get_stack(scans, step=None, keep=True):
+    """return stack for the library scans, loaded once per process,
+    keep=False - build a temporary in-memory stack, i.e for a short list"""
+    try:
+        if not keep:
+            return library_stack(scans, step=step, stack_dir='').load()
+        stack = library_stack(scans, step=step)
+        if stack.key not in _stacks:
+            _stacks[stack.key] = stack.load()
+        return _stacks[stack.key]
+    except (IOError, OSError) as e:
+        raise PreselectError(str(e))
+
+
+def library_similarity(scan, scans, mask=None, method='MI', step=None, keep=True):
+    """cost of matching scan to each of the library scans, lower is better"""
+    return get_stack(scans, step=step, keep=keep).similarity(scan, mask=mask, method=method)
+
+
+# default number of dimensions of the library embedding
+index_dims = 32
+# default sampling step of the library embedding, in mm
+index_step = 4.0
+# number of library entries used to estimate principal components
+index_pca_samples = 256
+# size of the short list compared exactly, in multiples of the requested number
+shortlist_factor = 4
+
+# indexes loaded by this process, keyed by file name
+_indexes = {}
+
+
+def _normalize(v):
+    """zero mean, unit variance"""
+    v = v.astype(np.float32)
+    v -= v.mean()
+    sd = v.std()
+    if sd > 0:
+        v /= sd
+    return v
+
+
+class library_index(object):
+    """Low dimensional embedding of the library scans for approximate
+    nearest neighbour preselection
+
+    Scans are downsampled, masked and intensity normalized, then projected
+    on the principal components of the library, or on random directions.
+    Euclidean distance between embeddings approximates the distance between
+    normalized scans, nearest entries are found with a k-d tree when
+    scipy is available, so that only a short list has to be compared
+    exactly.
+    """
+
+    def __init__(self, path):
+        if not HAVE_NUMPY_MINC:
+            raise PreselectError("numpy or minc2_simple is not available")
+        with np.load(path) as f:
+            self.factor     = [int(i) for i in f['factor']]
+            self.shape      = tuple(int(i) for i in f['shape'])
+            self.idx        = f['idx']
+            self.mean       = f['mean']
+            self.components = f['components']
+            self.embedding  = f['embedding']
+            scans           = [str(i) for i in f['scans']]
+        prefix = os.path.dirname(path)
+        # scans are stored relative to the index location, like in library.json
+        self.rows = {os.path.normpath(os.path.join(prefix, s)): i for (i, s) in enumerate(scans)}
+        self.tree = None
+        if HAVE_SCIPY_SPATIAL:
+            self.tree = scipy.spatial.cKDTree(self.embedding)
+
+    def embed(self, scan):
+        """embedding of the scan"""
+        data = downsample(_load(scan), self.factor)
+        if data.shape != self.shape:
+            raise PreselectError("Sample is sampled differently from the index:{}".format(scan))
+        return _embed(data, self.idx, self.mean, self.components)
+
+    def positions(self, scans):
+        """dict index row -> position in the list of scans, for scans in the index"""
+        pos = {}
+        for (i, s) in enumerate(scans):
+            r = self.rows.get(os.path.normpath(s), None)
+            if r is not None:
+                pos[r] = i
+        return pos
+
+    def query(self, scan, number, rows=None):
+        """return up to number index rows nearest to the scan, closest first
+        rows -- rows allowed to be returned, default all"""
+        x = self.embed(scan)
+        n = self.embedding.shape[0]
+        # enough neighbours to have number of allowed rows among them
+        k = min(n, number + (n - len(rows) if rows is not None else 0))
+        if self.tree is not None:
+            (_, nearest) = self.tree.query(x, k=k)
+            nearest = np.atleast_1d(nearest)
+        else:
+            d = ((self.embedding - x[None, :]) ** 2).sum(axis=1)
+            nearest = np.argsort(d)[0:k]
+        out = [int(r) for r in nearest if rows is None or int(r) in rows]
+        return out[0:number]
+
+
+def _embed(data, idx, mean, components):
+    return np.dot(components, _normalize(data.ravel()[idx]) - mean)
+
+
+def build_index(scans, output, mask=None, step=None, dims=None, method='pca', seed=0, verbose=0):
+    """build embedding index of the library scans and save it into output (.npz)
+    scans are stored relative to the directory of the output, i.e library
+
+    scans  -- library scans, sampled on the same grid
+    mask   -- mask of the area used for embedding
+    step   -- sampling step in mm, default index_step
+    dims   -- number of dimensions, default index_dims
+    method -- 'pca' or 'random' projections
+    """
+    if not HAVE_NUMPY_MINC:
+        raise PreselectError("numpy or minc2_simple is not available")
+    if len(scans) == 0:
+        raise PreselectError("Empty library")
+    if dims is None:
+        dims = index_dims
+    factor = _factor(scans[0], step)
+
+    first = downsample(_load(scans[0]), factor)
+    if mask is not None:
+        idx = np.flatnonzero(downsample(_load(mask), factor) > 0.5)
+    else:
+        idx = np.arange(first.size)
+    if idx.size == 0:
+        raise PreselectError("Empty mask:{}".format(mask))
+
+    def _features(s):
+        data = downsample(_load(s), factor)
+        if data.shape != first.shape:
+            raise PreselectError("Library scans are sampled differently:{}".format(s))
+        return _normalize(data.ravel()[idx])
+
+    if method == 'pca':
+        sel = np.unique(np.linspace(0, len(scans) - 1, min(len(scans), index_pca_samples)).astype(int))
+        X = np.stack([_features(scans[i]) for i in sel])
+        mean = X.mean(axis=0)
+        X -= mean[None, :]
+        (_, _, vt) = np.linalg.svd(X, full_matrices=False)
+        components = vt[0:dims]
+        del X
+    elif method == 'random':
+        rng = np.random.RandomState(seed)
+        mean = np.zeros(idx.size, dtype=np.float32)
+        components = (rng.standard_normal((dims, idx.size)) / math.sqrt(dims)).astype(np.float32)
+    else:
+        raise PreselectError("Unsupported index method:{}".format(method))
+
+    embedding = np.empty((len(scans), components.shape[0]), dtype=np.float32)
+    for (i, s) in enumerate(scans):
+        embedding[i] = np.dot(components, _features(s) - mean)
+        if verbose > 0 and (i + 1) % 100 == 0:
+            print("Embedded {} of {}".format(i + 1, len(scans)))
+
+    prefix = os.path.dirname(output)
+    tmp = os.path.join(prefix, '.tmp_{}_{}_{}'.format(os.getpid(), threading.current_thread().ident, os.path.basename(output)))
+    if not tmp.endswith('.npz'):
+        tmp += '.npz'
+    try:
+        np.savez(tmp,
+                 factor=np.array(factor),
+                 shape=np.array(first.shape),
+                 idx=idx,
+                 mean=mean.astype(np.float32),
+                 components=components.astype(np.float32),
+                 embedding=embedding,
+                 scans=np.array([os.path.relpath(s, prefix) for s in scans]))
+        os.rename(tmp, output)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    _indexes.pop(output, None)
+    return output
+
+
+def get_index(path):
+    """return index, loaded once per process"""
+    try:
+        key = (path, os.stat(path).st_mtime)
+        if _indexes.get(path, (None, None))[0] != key:
+            _indexes[path] = (key, library_index(path))
+        return _indexes[path][1]
+    except (IOError, OSError, KeyError) as e:
+        raise PreselectError(str(e))
+
+
+def index_candidates(scan, scans, indexes, number):
+    """positions of the library scans that should be compared exactly:
+    number nearest neighbours of the scan found with the index covering
+    most of the scans, and scans that are not in the index
+
+    indexes -- list of index files
+    """
+    best = None
+    for p in indexes:
+        index = get_index(p)
+        pos = index.positions(scans)
+        if best is None or len(pos) > len(best[1]):
+            best = (index, pos)
+    if best is None or len(best[1]) == 0:
+        raise PreselectError("Library is not covered by any index")
+    (index, pos) = best
+    selected = [pos[r] for r in index.query(scan, number, rows=pos)]
+    covered = set(pos.values())
+    selected.extend(i for i in range(len(scans)) if i not in covered)
+    return selected
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# Persistent store of blurred and downsampled volumes used by registration
+
+from __future__ import print_function
+
+import os
+import sys
+import hashlib
+import fcntl
+import json
+import threading
+
+import minc_cache
+
+
+class pyramid_store(object):
+    """Blurred and downsampled versions of registration inputs,
+    shared between subjects and runs
+
+    Entries are keyed by contents of the original file, blurring kernel,
+    type of blurring and downsampling step, so i.e the model pyramid
+    is computed only once per cohort.
+
+    store_dir -- location of the store, can be shared between processes
+    """
+
+    def __init__(self, store_dir, verbose=0):
+        self.store_dir = os.path.abspath(store_dir)
+        self.verbose   = verbose
+        self.hits      = 0
+        self.misses    = 0
+        if not os.path.exists(self.store_dir):
+            try:
+                os.makedirs(self.store_dir)
+            except OSError:
+                # created by another process
+                pass
+
+    def key(self, input, fwhm, blur='blur', downsample=None):
+        h = hashlib.sha1()
+        h.update(json.dumps([minc_cache.content_hash(input), float(fwhm), blur,
+                             float(downsample) if downsample is not None else None]).encode())
+        return h.hexdigest()
+
+    def _fill(self, key, produce, description=''):
+        """return name of the entry, calling produce(output) to create it if needed"""
+        _dir = os.path.join(self.store_dir, key[0:2])
+        entry = os.path.join(_dir, key + '.mnc')
+
+        if os.path.exists(entry):
+            self.hits += 1
+            return entry
+
+        if not os.path.exists(_dir):
+            try:
+                os.makedirs(_dir)
+            except OSError:
+                pass
+        # only one process (or thread) computes the entry, others wait for it
+        with open(entry + '.lock', 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(entry):
+                    self.misses += 1
+                    _tmp = os.path.join(_dir, '.tmp_{}_{}_{}.mnc'.format(os.getpid(), threading.current_thread().ident, key))
+                    try:
+                        produce(_tmp)
+                        os.rename(_tmp, entry)
+                    finally:
+                        if os.path.exists(_tmp):
+                            os.unlink(_tmp)
+                    if self.verbose > 0:
+                        print("Pyramid:{} -> {}".format(description, entry))
+                else:
+                    self.hits += 1
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        return entry
+
+    def blurred(self, minc, input, fwhm, blur='blur', downsample=None, source=None):
+        """return name of the blurred input, computing it if needed
+
+        minc       -- mincTools instance used to run the blurring
+        input      -- original file, used for the key
+        downsample -- step of the downsampled version of the input
+        source     -- file actually blurred, i.e downsampled input, default input
+        """
+        if source is None:
+            source = input
+        return self._fill(self.key(input, fwhm, blur=blur, downsample=downsample),
+                          lambda out: minc.blur(source, out, gmag=(blur == 'dxyz'), fwhm=fwhm),
+                          '{} {} {}'.format(input, blur, fwhm))
+
+    def downsampled(self, minc, input, step, labels=False):
+        """return name of the input resampled to step, computing it if needed
+
+        labels -- input is a label or mask volume
+        """
+        h = hashlib.sha1()
+        h.update(json.dumps([minc_cache.content_hash(input), 'labels' if labels else 'smooth',
+                             float(step)]).encode())
+        if labels:
+            produce = lambda out: minc.resample_labels(input, out, unistep=step, datatype='byte')
+        else:
+            produce = lambda out: minc.resample_smooth(input, out, unistep=step)
+        return self._fill(h.hexdigest(), produce, '{} {}mm'.format(input, step))
+
+    def precompute(self, minc, scans, masks=None, steps=(2, 3, 4)):
+        """build downsampled variants of reference scans and masks,
+        i.e once per library"""
+        for step in steps:
+            for i in scans:
+                self.downsampled(minc, i, step)
+            for i in (masks or []):
+                if i is not None:
+                    self.downsampled(minc, i, step, labels=True)
+
+    def stats(self):
+        """return hit/miss counters"""
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+_pyramid = None
+
+
+def setup_pyramid(store_dir, verbose=0):
+    """enable pyramid store for registration functions"""
+    global _pyramid
+    if store_dir is None:
+        _pyramid = None
+    else:
+        _pyramid = pyramid_store(store_dir, verbose=verbose)
+    return _pyramid
+
+
+def get_pyramid():
+    """return active pyramid store or None,
+    store can be enabled with setup_pyramid or IPL_PYRAMID_DIR environment variable
+    """
+    global _pyramid
+    if _pyramid is None and os.environ.get('IPL_PYRAMID_DIR', None):
+        setup_pyramid(os.environ['IPL_PYRAMID_DIR'])
+    return _pyramid
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# Store of registration results shared between runs and work directories
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import hashlib
+import inspect
+import functools
+
+import minc_cache
+
+# arguments that don't change the result of a registration
+ignored_arguments = ('work_dir', 'checkpoint_dir', 'verbose', 'debug', 'cleanup')
+
+
+def _normalize(value):
+    """convert registration argument into a json-serializable value,
+    files are identified by their contents"""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, dict):
+        return [[str(k), _normalize(v)] for (k, v) in sorted(value.items(), key=lambda i: str(i[0]))
+                if v is not None and v != {}]
+    if isinstance(value, (list, tuple)):
+        return [_normalize(i) for i in value]
+    value = str(value)
+    if os.path.isfile(value):
+        return '@file:' + minc_cache.file_hash(value)
+    return value
+
+
+def arguments_hash(method, arguments):
+    """hash of the method name and dict of arguments, files are identified by contents"""
+    h = hashlib.sha1()
+    h.update(json.dumps([method, _normalize(arguments)]).encode())
+    return h.hexdigest()
+
+
+class registration_store(minc_cache.result_cache):
+    """Registration results keyed by the registration method, contents of
+    the source, target, masks and initial transformation, and all other
+    parameters, so that the same registration is computed only once across
+    cross-validation folds, parameter sweeps and re-runs
+
+    cache_dir -- location of the store
+    max_size  -- size budget in bytes, least recently used entries are evicted
+    """
+
+    def registration_key(self, method, arguments):
+        """calculate key from the method name and dict of arguments,
+        outputs should be removed from the arguments"""
+        return arguments_hash(method, arguments)
+
+    def fetch_outputs(self, key, outputs):
+        """restore stored outputs, return (True, result) on a hit
+        outputs -- dict role -> file name"""
+        try:
+            with open(os.path.join(self._entry(key), 'info.json'), 'r') as f:
+                info = json.load(f)
+            roles = info['roles']
+            if any(outputs.get(r, None) is None for r in roles):
+                # stored for a call with different outputs requested
+                self.misses += 1
+                return (False, None)
+        except (IOError, OSError, ValueError, KeyError):
+            self.misses += 1
+            return (False, None)
+        if not self.fetch(key, [outputs[r] for r in roles]):
+            return (False, None)
+        if info.get('result_role', None) is not None:
+            return (True, outputs[info['result_role']])
+        return (True, info.get('result', None))
+
+    def store_outputs(self, key, outputs, result=None, method=None):
+        """store outputs that were produced
+        outputs -- dict role -> file name, missing files are skipped
+        result  -- return value of the registration function"""
+        roles = sorted(r for (r, o) in outputs.items() if o is not None and os.path.isfile(o))
+        info = {'roles': roles}
+        _result_role = [r for r in roles if outputs[r] == result]
+        if result is not None and len(_result_role) > 0:
+            info['result_role'] = _result_role[0]
+        else:
+            try:
+                json.dumps(result)
+                info['result'] = result
+            except (TypeError, ValueError):
+                pass
+        self.store(key, [outputs[r] for r in roles], cmds=method, info=info)
+
+
+def memoize(outputs):
+    """decorator, make registration function use the registration store
+
+    outputs -- function of the dict of call arguments returning dict role -> output file,
+               the store is not used if all of them already exist
+
+    @memoize(outputs=lambda a: {'xfm': a['output_xfm']})
+    def linear_register(source, target, output_xfm, ...):
+    """
+    def decorator(fun):
+        method = '{}.{}'.format(fun.__module__, fun.__name__)
+
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            store = get_registration_store()
+            if store is None:
+                return fun(*args, **kwargs)
+            arguments = inspect.getcallargs(getattr(fun, '__wrapped__', fun), *args, **kwargs)
+            _outputs = outputs(arguments)
+            _requested = [o for o in _outputs.values() if o is not None]
+            if len(_requested) > 0 and all(os.path.exists(o) for o in _requested):
+                return fun(*args, **kwargs)
+            _arguments = {k: v for (k, v) in arguments.items()
+                          if k not in ignored_arguments and not (isinstance(v, str) and v in _requested)}
+            key = store.registration_key(method, _arguments)
+            (hit, result) = store.fetch_outputs(key, _outputs)
+            if hit:
+                if store.verbose > 0:
+                    print("Registration store hit:{} {}".format(method, repr(_requested)))
+                return result
+            result = fun(*args, **kwargs)
+            store.store_outputs(key, _outputs, result=result, method=method)
+            return result
+        return wrapper
+    return decorator
+
+
+_store = None
+
+
+def setup_registration_store(store_dir, max_size=None, link='reflink', verbose=0):
+    """enable registration store for all registration functions"""
+    global _store
+    if store_dir is None:
+        _store = None
+    else:
+        _store = registration_store(store_dir, max_size=max_size, link=link, verbose=verbose)
+    return _store
+
+
+def get_registration_store():
+    """return active registration store or None,
+    store can be enabled with setup_registration_store or environment variables:
+    IPL_REGISTRATION_STORE - store directory
+    IPL_REGISTRATION_STORE_SIZE - size budget in Gb
+    """
+    global _store
+    if _store is None and os.environ.get('IPL_REGISTRATION_STORE', None):
+        _size = os.environ.get('IPL_REGISTRATION_STORE_SIZE', None)
+        if _size is not None:
+            _size = int(float(_size) * 1024 ** 3)
+        setup_registration_store(os.environ['IPL_REGISTRATION_STORE'], max_size=_size,
+                                 link=os.environ.get('IPL_RESULT_CACHE_LINK', 'reflink'))
+    return _store
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
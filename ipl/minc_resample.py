@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# In-process resampling of several volumes with a shared sampling plan
+
+from __future__ import print_function
+
+import os
+import sys
+
+import minc_cache
+import minc_calc
+import minc_header
+import minc_xfm
+
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+
+try:
+    import scipy.ndimage
+    from minc2_simple import minc2_file
+    HAVE_NUMPY_MINC = HAVE_NUMPY
+except ImportError:
+    HAVE_NUMPY_MINC = False
+
+
+class ResampleError(ValueError):
+    """Resampling can't be done in-process, caller should use minc tools"""
+    pass
+
+
+# number of output voxels processed at once, limits memory used by coordinates
+chunk_voxels = 1 << 20
+
+# fixed point iterations used to invert grid transformations
+grid_iterations = 20
+# convergence tolerance of grid inversion, in mm
+grid_tolerance = 0.01
+
+
+def _voxel_to_world(path):
+    """return 4x4 matrix mapping x,y,z voxel indices to world coordinates
+    and volume dimensions in numpy order (z,y,x)"""
+    dims = minc_header.read_header(path)['dims']
+    mat = np.identity(4)
+    shape = []
+    for (a, name) in enumerate(('xspace', 'yspace', 'zspace')):
+        if name not in dims:
+            raise ResampleError("Only 3D volumes are supported:{}".format(path))
+        (length, start, step, dir_cos) = dims[name]
+        d = np.array(dir_cos, dtype=np.float64)
+        d /= np.linalg.norm(d)
+        mat[0:3, a] = d * step
+        mat[0:3, 3] += d * start
+        shape.insert(0, int(length))
+    return (mat, tuple(shape))
+
+
+def _affine(mat, points):
+    return np.dot(points, mat[0:3, 0:3].T) + mat[0:3, 3]
+
+
+def _to_index(world_to_voxel, points):
+    """world coordinates -> continuous voxel indices in numpy order (z,y,x)"""
+    return _affine(world_to_voxel, points)[:, ::-1].T
+
+
+class _grid(object):
+    """displacement field of a grid transformation"""
+
+    def __init__(self, path):
+        (v2w, shape) = _voxel_to_world(path)
+        f = minc2_file(path)
+        f.setup_standard_order()
+        data = f.load_complete_volume(minc2_file.MINC2_DOUBLE)
+        f.close()
+        # vector dimension is the fastest varying one
+        if data.ndim != 4 or data.shape[0:3] != shape or data.shape[3] != 3:
+            raise ResampleError("Unsupported displacement volume:{}".format(path))
+        self.components = [np.ascontiguousarray(data[..., i]) for i in range(3)]
+        self.world_to_voxel = np.linalg.inv(v2w)
+
+    def displacement(self, points):
+        idx = _to_index(self.world_to_voxel, points)
+        return np.stack([scipy.ndimage.map_coordinates(c, idx, order=1, mode='nearest')
+                         for c in self.components], axis=1)
+
+    def forward(self, points):
+        return points + self.displacement(points)
+
+    def inverse(self, points):
+        out = points - self.displacement(points)
+        for _ in range(grid_iterations):
+            _out = points - self.displacement(out)
+            change = np.abs(_out - out).max() if out.size > 0 else 0.0
+            out = _out
+            if change < grid_tolerance:
+                return out
+        raise ResampleError("Grid transformation inversion did not converge")
+
+
+class sampling_plan(object):
+    """Mapping of output voxels into world coordinates of the input space,
+    shared by all volumes resampled with the same transformation and reference
+
+    transform        -- transformation file or None
+    like             -- reference volume defining output sampling
+    invert_transform -- apply inverse of the transformation
+    """
+
+    def __init__(self, transform, like, invert_transform=False):
+        if not HAVE_NUMPY_MINC:
+            raise ResampleError("numpy, scipy or minc2_simple is not available")
+        (self.voxel_to_world, self.shape) = _voxel_to_world(like)
+        self.steps = []
+        if transform is not None:
+            chain = minc_xfm.read_xfm(transform)
+            # resampling maps output points back into the input space:
+            # apply inverse transformations in reverse order
+            if not invert_transform:
+                chain = [(t, v, not inv) for (t, v, inv) in reversed(chain)]
+            for (_type, value, inverted) in chain:
+                if _type == 'linear':
+                    m = np.array(value).reshape(4, 4)
+                    self.steps.append(('linear', np.linalg.inv(m) if inverted else m))
+                elif _type == 'Grid_Transform' and value is not None:
+                    self.steps.append(('inverse' if inverted else 'forward', _grid(value)))
+                else:
+                    raise ResampleError("Unsupported transformation {} in:{}".format(_type, transform))
+        # merge consecutive linear transformations
+        steps = []
+        for s in self.steps:
+            if s[0] == 'linear' and len(steps) > 0 and steps[-1][0] == 'linear':
+                steps[-1] = ('linear', np.dot(s[1], steps[-1][1]))
+            else:
+                steps.append(s)
+        self.steps = steps
+
+    def chunks(self):
+        """iterate over (slab, world coordinates of input points) for slabs of output slices"""
+        (nz, ny, nx) = self.shape
+        slab = max(1, chunk_voxels // (ny * nx))
+        (y, x) = np.mgrid[0:ny, 0:nx]
+        for z0 in range(0, nz, slab):
+            z1 = min(nz, z0 + slab)
+            n = z1 - z0
+            idx = np.empty((n * ny * nx, 3))
+            idx[:, 0] = np.tile(x.ravel(), n)
+            idx[:, 1] = np.tile(y.ravel(), n)
+            idx[:, 2] = np.repeat(np.arange(z0, z1, dtype=np.float64), ny * nx)
+            points = _affine(self.voxel_to_world, idx)
+            for (kind, t) in self.steps:
+                if kind == 'linear':
+                    points = _affine(t, points)
+                elif kind == 'forward':
+                    points = t.forward(points)
+                else:
+                    points = t.inverse(points)
+            yield (slice(z0, z1), points)
+
+
+def _load(path):
+    f = minc2_file(path)
+    f.setup_standard_order()
+    data = f.load_complete_volume(minc2_file.MINC2_DOUBLE)
+    return (f, data)
+
+
+def _save(output, data, like, ref, datatype, default):
+    """write volume with sampling of like and metadata of ref"""
+    try:
+        store_type = minc_calc._datatype(datatype, default)
+    except minc_calc.CalcError as e:
+        raise ResampleError(str(e))
+    if minc_calc._integer_type(store_type):
+        data = np.rint(data)
+    _like = minc2_file(like)
+    out = minc2_file()
+    out.define(_like.store_dims(), store_type, minc2_file.MINC2_DOUBLE)
+    _like.close()
+    out.create(output)
+    out.copy_metadata(ref)
+    out.setup_standard_order()
+    out.save_complete_volume(np.ascontiguousarray(data))
+    out.close()
+
+
+class _source(object):
+    """input volume prepared for repeated sampling"""
+
+    def __init__(self, path, order, labels=False):
+        (self.file, data) = _load(path)
+        if data.ndim != 3:
+            raise ResampleError("Only 3D volumes are supported:{}".format(path))
+        (v2w, _) = _voxel_to_world(path)
+        self.world_to_voxel = np.linalg.inv(v2w)
+        self.order = order
+        self.shape = data.shape
+        self.labels = labels
+        if labels:
+            self.data = np.rint(data).astype(np.int32)
+        elif order > 1:
+            self.data = scipy.ndimage.spline_filter(data, order=order, mode='mirror')
+        else:
+            self.data = data
+
+    def index(self, points):
+        idx = _to_index(self.world_to_voxel, points)
+        # same rule as in ITK: continuous index within half a voxel from the edge
+        inside = np.ones(idx.shape[1], dtype=bool)
+        for a in range(3):
+            inside &= (idx[a] >= -0.5) & (idx[a] < self.shape[a] - 0.5)
+        return (idx, inside)
+
+    def sample(self, idx, inside):
+        if self.labels:
+            out = self._sample_labels(idx)
+        else:
+            out = scipy.ndimage.map_coordinates(self.data, idx, order=self.order,
+                                                mode='mirror', prefilter=False)
+        out[~inside] = 0
+        return out
+
+    def _corner(self, base, d):
+        return tuple(np.clip(base[a] + d[a], 0, self.shape[a] - 1).astype(np.intp) for a in range(3))
+
+    def _sample_labels(self, idx):
+        """nearest label, or label with the largest sum of trilinear weights
+        of the neighbouring voxels, same as interpolating each label separately"""
+        if self.order == 0:
+            return self.data[self._corner(np.rint(idx), (0, 0, 0))]
+        base = np.floor(idx)
+        frac = idx - base
+        n = idx.shape[1]
+        L = np.empty((n, 8), dtype=np.int32)
+        w = np.empty((n, 8))
+        for c in range(8):
+            d = ((c >> 2) & 1, (c >> 1) & 1, c & 1)
+            L[:, c] = self.data[self._corner(base, d)]
+            w[:, c] = np.prod([frac[a] if d[a] else 1.0 - frac[a] for a in range(3)], axis=0)
+        votes = np.zeros((n, 8))
+        for c in range(8):
+            votes += (L == L[:, c:c + 1]) * w[:, c:c + 1]
+        return L[np.arange(n), np.argmax(votes, axis=1)]
+
+
+def resample(smooth=None, labels=None, transform=None, like=None, order=4, label_order=None,
+             invert_transform=False, datatype=None, label_datatype=None):
+    """resample several volumes with the same transformation onto the sampling of like,
+    coordinates of the sampling points are computed once for all volumes
+
+    smooth         -- list of (input, output) pairs of intensity volumes, B-spline of order
+    labels         -- list of (input, output) pairs of label volumes, each label is
+                      interpolated with label_order (0 or 1, default 1) and
+                      the most likely one is kept
+    datatype       -- datatype of intensity outputs, default same as input
+    label_datatype -- datatype of label outputs, default byte
+
+    raises ResampleError if the inputs or the transformation can't be handled
+    """
+    smooth = smooth or []
+    labels = labels or []
+    if like is None:
+        raise ResampleError("Reference volume is required")
+    if label_order is None:
+        label_order = 1
+    if order is None:
+        order = 4
+    if not (0 <= order <= 5 and 0 <= label_order <= 1):
+        raise ResampleError("Unsupported interpolation order")
+    plan = sampling_plan(transform, like, invert_transform=invert_transform)
+
+    sources = [_source(i, order) for (i, _) in smooth] + \
+              [_source(i, label_order, labels=True) for (i, _) in labels]
+    outputs = [np.zeros(plan.shape) for _ in smooth] + \
+              [np.zeros(plan.shape, dtype=np.int32) for _ in labels]
+
+    for (sl, points) in plan.chunks():
+        # inputs usually share sampling, compute voxel coordinates once per geometry
+        indexes = {}
+        for (k, s) in enumerate(sources):
+            g = s.world_to_voxel.tobytes() + str(s.shape).encode()
+            if g not in indexes:
+                indexes[g] = s.index(points)
+            (idx, inside) = indexes[g]
+            outputs[k][sl] = s.sample(idx, inside).reshape(outputs[k][sl].shape)
+
+    for (k, (_, o)) in enumerate(smooth):
+        _save(o, outputs[k], like, sources[k].file, datatype, sources[k].file.data_type)
+    for (k, (_, o)) in enumerate(labels):
+        s = sources[len(smooth) + k]
+        _save(o, outputs[len(smooth) + k], like, s.file,
+              label_datatype if label_datatype is not None else 'byte', None)
+    for s in sources:
+        s.file.close()
+
+def same_grid(a, b, tolerance=1e-6):
+    """check if two volumes have the same dimensions and sampling"""
+    ha = minc_header.read_header(a)
+    hb = minc_header.read_header(b)
+    if ha['dimorder'] != hb['dimorder']:
+        return False
+    for name in ha['dimorder']:
+        (la, sa, ta, ca) = ha['dims'][name]
+        (lb, sb, tb, cb) = hb['dims'][name]
+        if la != lb or abs(sa - sb) > tolerance or abs(ta - tb) > tolerance:
+            return False
+        if (ca is None) != (cb is None):
+            return False
+        if ca is not None and max(abs(i - j) for (i, j) in zip(ca, cb)) > tolerance:
+            return False
+    return True
+
+
+def flip_shift(path, tolerance=1e-3):
+    """return k if flipping world x coordinate maps voxel i along x onto voxel k-i,
+    i.e k=n-1 for grids symmetric around x=0; None if the flip is not
+    a permutation of the voxels"""
+    hdr = minc_header.read_header(path)
+    if sorted(hdr['dimorder']) != ['xspace', 'yspace', 'zspace']:
+        return None
+    dims = hdr['dims']
+    (_, start, step, dir_cos) = dims['xspace']
+    # x axis of the voxel grid has to be the only one along world x
+    if abs(abs(dir_cos[0]) - 1.0) > 1e-6 or \
+       any(abs(dims[i][3][0]) > 1e-6 for i in ('yspace', 'zspace')):
+        return None
+    k = -2.0 * start / step
+    if abs(k - round(k)) > tolerance:
+        return None
+    return int(round(k))
+
+
+def exact_mapping(input, transform=None, like=None, tolerance=1e-9):
+    """check if resampling input with the linear transform onto the sampling of like
+    (or of input) doesn't need interpolation
+
+    returns 'identity', 'flip' for a flip of the x axis mapping voxels onto voxels,
+    or None; identity and flip are their own inverses
+    """
+    if not HAVE_NUMPY:
+        return None
+    kind = 'identity'
+    if transform is not None:
+        try:
+            m = minc_xfm.read_linear(transform)
+        except minc_xfm.XfmError:
+            return None
+        if np.abs(m - np.diag([-1.0, 1.0, 1.0, 1.0])).max() < tolerance:
+            kind = 'flip'
+        elif np.abs(m - np.identity(4)).max() >= tolerance:
+            return None
+    if like is not None and not same_grid(input, like):
+        return None
+    if kind == 'flip' and flip_shift(input) is None:
+        return None
+    return kind
+
+
+def copy_volume(input, output, flip=False, datatype=None):
+    """copy volume, optionally flipping it along x and converting datatype,
+    without interpolation; see exact_mapping
+
+    unchanged volumes are cloned (reflink or copy), never hardlinked because
+    some tools modify headers in place
+    """
+    if not flip and datatype is None:
+        minc_cache._clone_file(input, output)
+        return
+    if not HAVE_NUMPY_MINC:
+        raise ResampleError("numpy or minc2_simple is not available")
+    f = minc2_file(input)
+    try:
+        try:
+            store_type = minc_calc._datatype(datatype, f.data_type)
+        except minc_calc.CalcError as e:
+            raise ResampleError(str(e))
+        if not flip and store_type == f.data_type:
+            out = None
+        else:
+            f.setup_standard_order()
+            data = f.load_complete_volume(minc2_file.MINC2_DOUBLE)
+            out = data
+            if flip:
+                k = flip_shift(input)
+                if k is None or data.ndim != 3:
+                    raise ResampleError("Flip is not a permutation of voxels of:{}".format(input))
+                # output voxel i along x takes input voxel k-i, numpy order is z,y,x
+                n = data.shape[2]
+                i = np.arange(n)
+                sel = (k - i >= 0) & (k - i < n)
+                out = np.zeros_like(data)
+                out[:, :, i[sel]] = data[:, :, k - i[sel]]
+            _save(output, out, input, f, datatype, f.data_type)
+    finally:
+        f.close()
+    if out is None:
+        minc_cache._clone_file(input, output)
+
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
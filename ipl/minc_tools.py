@@ -15,9 +15,11 @@ import tempfile
 import subprocess
 import re
 import fcntl
+import threading
 import traceback
 import collections
 import math
+import hashlib
 
 import inspect
 
@@ -26,6 +28,15 @@ import registration
 import ants_registration
 import dd_registration
 import elastix_registration
+import minc_calc
+import minc_cache
+import minc_header
+import minc_trace
+import minc_async
+import minc_executor
+import minc_pyramid
+import minc_resample
+import minc_xfm
 
 # hack to make it work on Python 3
 try:
@@ -70,20 +81,70 @@ class mincError(Exception):
         return self.__repr__()
         
 
+# shared memory reserved by temporary files of this process, path -> bytes
+_shm_reserved={}
+_shm_lock=threading.Lock()
+
+# expected size of temporary files, in bytes, by size hint
+tmp_size_hints={
+    'small':  1024*1024,         # masks, transformations, text files
+    'volume': 16*1024*1024,      # a typical volume
+    'grid':   64*1024*1024,      # displacement grid of a non-linear transformation
+    'large':  None,              # always on disk
+}
+
+def _expected_size(name, size):
+    """expected size of a temporary file in bytes, None if it is large"""
+    if size is None:
+        # non-linear transformations come with displacement grids
+        size='grid' if name.endswith('.xfm') else 'volume'
+    if isinstance(size, str):
+        return tmp_size_hints[size]
+    return size
+
+def _shm_used():
+    """shared memory reserved or used by temporary files of this process,
+    files grown beyond their reservation are accounted with their real size"""
+    total=0
+    for (path, reserved) in _shm_reserved.items():
+        try:
+            total+=max(reserved, os.path.getsize(path))
+        except OSError:
+            total+=reserved
+    return total
+
 class temp_files(object):
-    """Class to keep track of temp files"""
+    """Class to keep track of temp files
+    
+    if shm_budget (Mb) is set, or IPL_SHM_BUDGET environment variable,
+    temporary files are allocated in shared memory (IPL_SHM_DIR, default /dev/shm)
+    while their expected sizes fit into the budget, the rest are spilled to TMPDIR;
+    files larger than shm_max_file (Mb), default IPL_SHM_MAX_FILE or 1/4 of the budget,
+    are always on disk
+    """
     
-    def __init__(self,tempdir=None,prefix=None):
+    def __init__(self,tempdir=None,prefix=None,shm_budget=None,shm_max_file=None):
         
         self.tempdir = tempdir
         self.clean_tempdir = False
         self.tempfiles = {}
+        self.shm_dir = None
+        if prefix is None:
+            prefix='iplMincTools'
         if not self.tempdir:
-            if prefix is None:
-                prefix='iplMincTools'
             self.tempdir = tempfile.mkdtemp(prefix=prefix,dir=os.environ.get('TMPDIR',None))
             self.clean_tempdir = True
             
+            if shm_budget is None and os.environ.get('IPL_SHM_BUDGET',None):
+                shm_budget = float(os.environ['IPL_SHM_BUDGET'])
+            _shm = os.environ.get('IPL_SHM_DIR','/dev/shm')
+            if shm_budget and os.path.isdir(_shm):
+                self.shm_dir = tempfile.mkdtemp(prefix=prefix,dir=_shm)
+        self.shm_budget = shm_budget
+        if shm_max_file is None and shm_budget:
+            shm_max_file = float(os.environ.get('IPL_SHM_MAX_FILE', shm_budget/4.0))
+        self.shm_max_file = shm_max_file
+            
         if not os.path.exists(self.tempdir):
             os.makedirs(self.tempdir)
 
@@ -106,23 +167,55 @@ class temp_files(object):
         if self.clean_tempdir and self.tempdir is not None:
             shutil.rmtree(self.tempdir)
             self.clean_tempdir=False
-
-    def temp_file(self, suffix='', prefix=''):
-        """create temporary file"""
+        if self.shm_dir is not None:
+            shutil.rmtree(self.shm_dir, ignore_errors=True)
+            with _shm_lock:
+                for k in [k for k in _shm_reserved if k.startswith(self.shm_dir+os.sep)]:
+                    del _shm_reserved[k]
+            self.shm_dir=None
+
+    def temp_file(self, suffix='', prefix='', size=None):
+        """create temporary file
+        size -- expected size in bytes, or hint: 'small', 'volume', 'grid' or 'large'
+        """
+        if self.shm_dir is not None:
+            _size=_expected_size(suffix, size)
+            if _size is not None and _size <= self.shm_max_file*1024*1024:
+                with _shm_lock:
+                    if _shm_used()+_size <= self.shm_budget*1024*1024:
+                        (h, name) = tempfile.mkstemp(suffix=suffix, prefix=prefix, dir=self.shm_dir)
+                        os.close(h)
+                        os.unlink(name)
+                        _shm_reserved[name]=_size
+                        return name
 
         (h, name) = tempfile.mkstemp(suffix=suffix, prefix=prefix,dir=self.tempdir)
         os.close(h)
         os.unlink(name)
         return name
 
-    def tmp(self, name):
-        """return path of a temp file named name"""
+    def tmp(self, name, size=None):
+        """return path of a temp file named name
+        size -- expected size in bytes, or hint: 'small', 'volume', 'grid' or 'large',
+                default - 'grid' for .xfm files, 'volume' otherwise
+        """
         try:
             return self.tempfiles[name]
         except KeyError:
-            self.tempfiles[name] = self.temp_file(suffix=name)
+            self.tempfiles[name] = self.temp_file(suffix=name, size=size)
             return self.tempfiles[name]
 
+    def free(self, *names):
+        """declare temp files named by tmp() dead: remove them
+        and release space for other temp files"""
+        for name in names:
+            path = self.tempfiles.pop(name, None)
+            if path is not None:
+                with _shm_lock:
+                    _shm_reserved.pop(path, None)
+                if os.path.exists(path):
+                    os.unlink(path)
+
     def temp_dir(self, suffix='', prefix=''):
         """ Create temporary directory for processing"""
 
@@ -222,11 +315,16 @@ class cache_files(temp_files):
 class mincTools(temp_files):
     """minc toolkit interface , mostly basic tools """
 
-    def __init__(self, tempdir=None, resample=None, verbose=0, prefix=None):
-        super(mincTools,self).__init__(tempdir=tempdir,prefix=prefix)
+    def __init__(self, tempdir=None, resample=None, verbose=0, prefix=None, engine=None, shm_budget=None):
+        super(mincTools,self).__init__(tempdir=tempdir,prefix=prefix,shm_budget=shm_budget)
         # TODO: add some options?
         self.resample = resample
         self.verbose  = verbose
+        # 'numpy' - evaluate calc and math in-process when possible
+        if engine is None:
+            engine = os.environ.get('IPL_CALC_ENGINE',None)
+        self.engine   = engine
+        self._futures = []
 
     def __enter__(self):
         return super(mincTools,self).__enter__()
@@ -237,6 +335,10 @@ class mincTools(temp_files):
         value,
         traceback,
         ):
+        # background functions may still use temporary files
+        for f in self._futures:
+            f.wait()
+        self._futures = []
         return super(mincTools,self).__exit__(type,value,traceback)
 
     @staticmethod
@@ -322,15 +424,15 @@ class mincTools(temp_files):
         if verbose>0:
             print(repr(cmds))
         try:
-
-            if verbose<2:
-                with open(os.devnull, "w") as fnull:
-                    p=subprocess.Popen(cmds, stdout=fnull, stderr=subprocess.PIPE)
-            else:
-                p=subprocess.Popen(cmds, stderr=subprocess.PIPE)
-            
-            (output,output_stderr)=p.communicate()
-            outvalue=p.wait()
+            with minc_async.slot(cmds) as slot, minc_trace.command_trace(slot.cmds, threads=slot.threads) as trace:
+                if verbose<2:
+                    with open(os.devnull, "w") as fnull:
+                        p=trace.process=slot.process=minc_trace.Popen(slot.cmds, stdout=fnull, stderr=subprocess.PIPE, env=slot.env)
+                else:
+                    p=trace.process=slot.process=minc_trace.Popen(slot.cmds, stderr=subprocess.PIPE, env=slot.env)
+                
+                (output,output_stderr)=p.communicate()
+                outvalue=trace.returncode=p.wait()
 
         except OSError:
             print("ERROR: command {} Error:{}!\nMessage: {}\n{}".format(str(cmds),str(outvalue),output_stderr,traceback.format_exc()), file=sys.stderr)
@@ -356,11 +458,12 @@ class mincTools(temp_files):
         if verbose>0:
             print(repr(cmds))
         try:
-            p=subprocess.Popen(cmds,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (output,outerr)=p.communicate()
-            if verbose>0:
-                print(output.decode())
-            outvalue=p.wait()
+            with minc_async.slot(cmds) as slot, minc_trace.command_trace(slot.cmds, threads=slot.threads) as trace:
+                p=trace.process=slot.process=minc_trace.Popen(slot.cmds,stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=slot.env)
+                (output,outerr)=p.communicate()
+                if verbose>0:
+                    print(output.decode())
+                outvalue=trace.returncode=p.wait()
         except OSError as e:
             print("ERROR: command {} Error:{}!\n{}".format(repr(cmds),str(e),traceback.format_exc()),file=sys.stderr)
             raise mincError("ERROR: command {} Error:{}!\n{}".format(repr(cmds),str(e),traceback.format_exc()))
@@ -397,19 +500,28 @@ class mincTools(temp_files):
                                     verbose=verbose,
                                     timecheck=timecheck):
             return 0
+
+        cache=minc_cache.get_cache()
+        cache_key=None
+        if cache is not None:
+            cache_key=cache.key(cmds, inputs=inputs, outputs=outputs)
+            if cache_key is not None and cache.fetch(cache_key, outputs):
+                return 0
+
         outvalue=0
         output_stderr=""
         output=""
         use_shell=not isinstance(cmds, list)
         try:
-            if verbose<2:
-                with open(os.devnull, "w") as fnull:
-                    p=subprocess.Popen(cmds, stdout=fnull, stderr=subprocess.PIPE,shell=use_shell)
-            else:
-                p=subprocess.Popen(cmds, stderr=subprocess.PIPE,shell=use_shell)
-            
-            (output,output_stderr)=p.communicate()
-            outvalue=p.wait()
+            with minc_async.slot(cmds) as slot, minc_trace.command_trace(slot.cmds, threads=slot.threads) as trace:
+                if verbose<2:
+                    with open(os.devnull, "w") as fnull:
+                        p=trace.process=slot.process=minc_trace.Popen(slot.cmds, stdout=fnull, stderr=subprocess.PIPE,shell=use_shell, env=slot.env)
+                else:
+                    p=trace.process=slot.process=minc_trace.Popen(slot.cmds, stderr=subprocess.PIPE,shell=use_shell, env=slot.env)
+                
+                (output,output_stderr)=p.communicate()
+                outvalue=trace.returncode=p.wait()
             
         except OSError:
             print("ERROR: command {} Error:{}!\nMessage: {}\n{}".format(str(cmds),str(outvalue),output_stderr,traceback.format_exc()), file=sys.stderr)
@@ -432,8 +544,21 @@ class mincTools(temp_files):
         if not outExists:
             raise mincError('ERROR: Command didn not produce output: {}!'.format(str(cmds)))
 
+        if cache_key is not None:
+            cache.store(cache_key, outputs, cmds=cmds)
+
         return outvalue
 
+    def submit(self, fun, *args, **kwargs):
+        """
+        Run fun(*args, **kwargs) in background, return future
+        commands executed by fun are limited by the node-wide governor,
+        see minc_async. Temporary files are kept until all submitted functions finish.
+        """
+        f=minc_async.submit(fun, *args, **kwargs)
+        self._futures.append(f)
+        return f
+
     @staticmethod
     def qsub(
         comm,
@@ -443,45 +568,11 @@ class mincTools(temp_files):
         depends=None,
         ):
         """ 
-        Send the job into the sge queue
-        TODO: improve dependencies and so on
+        Send the job into the sge queue,
+        or to another backend selected by IPL_EXECUTOR, see minc_executor
         """
-
-        if not name:
-            name = comm[0]
-        try:
-            qsub_comm = [
-                'qsub','-cwd',
-                '-N', name,
-                '-j', 'y',
-                '-V', '-q',
-                queue,
-                ]
-            path = ''
-            if logfile:
-                path = os.path.abspath(logfile)
-                qsub_comm.extend(['-o', path])
-            if depends:
-                qsub_comm.extend(['-hold_jid', depends])
-
-            print(' - Name    ' + name)
-            print(' - Queue   ' + queue)
-            print(' - Cmd     ' + ' '.join(comm))
-            print(' - logfile ' + path)
-
-            #qsub_comm.append(tmpscript)
-
-            cmds="#!/bin/bash\nhostname\n"
-            cmds+=' '.join(comm)+"\n"
-
-            p=subprocess.Popen(qsub_comm,
-                    stdin=subprocess.PIPE,
-                    stderr=subprocess.STDOUT)
-
-            p.communicate(cmds)
-            # TODO: check error code?
-        finally:
-            pass
+        return minc_executor.get_executor(queue=queue).submit(
+            [' '.join(comm)], name=name, logfile=logfile, depends=depends)
             
     @staticmethod
     def qsub_pe(
@@ -493,67 +584,28 @@ class mincTools(temp_files):
         depends=None,
         ):
         """ 
-        Send the job into the sge queue
-        TODO: improve dependencies and so on
+        Send the job into the sge queue using parallel environment,
+        or to another backend selected by IPL_EXECUTOR, see minc_executor
         """
-
-        if not name:
-            name = comm[0]
-        try:
-            qsub_comm = [
-                'qsub','-cwd',
-                '-N', name,
-                '-j', 'y',
-                '-V', '-pe',
-                pe,str(slots)
-                ]
-            path = ''
-            if logfile:
-                path = os.path.abspath(logfile)
-                qsub_comm.extend(['-o', path])
-            if depends:
-                qsub_comm.extend(['-hold_jid', depends])
-
-            print(' - Name    ' + name)
-            print(' - PE      ' + pe)
-            print(' - Slots   ' + str(slots))
-            print(' - Cmd     ' + ' '.join(comm))
-            print(' - logfile ' + path)
-
-            cmds="#!/bin/bash\nhostname\n"
-            cmds+=' '.join(comm)+"\n"
-
-            p=subprocess.Popen(qsub_comm,
-                    stdin=subprocess.PIPE,
-                    stderr=subprocess.STDOUT)
-
-            p.communicate(cmds)
-            # TODO: check error code?
-        finally:
-            pass
+        return minc_executor.get_executor(pe=pe).submit(
+            [' '.join(comm)], name=name, slots=slots, logfile=logfile, depends=depends)
 
     @staticmethod
     def query_dimorder(input):
         '''read a value of an attribute inside minc file'''
-
-        i = subprocess.Popen(['mincinfo', '-vardims', 'image', input],
-                             stdout=subprocess.PIPE).communicate()
-        return i[0].decode().rstrip('\n').split(' ')
+        return minc_header.dimorder(input)
     
     @staticmethod
     def query_attribute(input, attribute):
         '''read a value of an attribute inside minc file'''
-
-        i = subprocess.Popen(['mincinfo', '-attvalue', attribute,
-                             input],
-                             stdout=subprocess.PIPE).communicate()
-        return i[0].decode().rstrip('\n').rstrip(' ')
+        return minc_header.attribute(input, attribute)
         
     @staticmethod
     def set_attribute(input, attribute, value):
         '''set a value of an attribute inside minc file
         if value=None - delete the attribute
         '''
+        minc_header.invalidate(input)
         if value is None:
             mincTools.execute(['minc_modify_header', input, '-delete', attribute])
         elif isinstance(value, basestring):
@@ -571,30 +623,7 @@ class mincTools(temp_files):
             input -- input minc file
         Returns dict with entries per dimension
         """
-        # TODO: make this robust to errors!
-        _image_dims = subprocess.Popen(['mincinfo', '-vardims', 'image', input],
-                             stdout=subprocess.PIPE).communicate()[0].decode().rstrip('\n').rstrip(' ').split(' ')
-        
-        _req=['mincinfo']
-        for i in _image_dims:
-            _req.extend(['-dimlength',i,
-                         '-attvalue', '{}:start'.format(i),
-                         '-attvalue', '{}:step'.format(i), 
-                         '-attvalue', '{}:direction_cosines'.format(i)])
-        _req.append(input)
-        _info= subprocess.Popen(_req,
-                             stdout=subprocess.PIPE).communicate()[0].decode().rstrip('\n').rstrip(' ').split("\n")
-
-        diminfo=collections.namedtuple('dimension',['length','start','step','direction_cosines'])
-        
-        _result={}
-        for i,j in enumerate(_image_dims):
-            _result[j]=diminfo(length=int(_info[i*4]),
-                               start=float(_info[i*4+1]),
-                               step=float(_info[i*4+2]),
-                               direction_cosines=[float(k) for k in _info[i*4+3].rstrip(' ').split(' ') ])
-            
-        return _result
+        return minc_header.mincinfo(input)
         
     def ants_linear_register(
         self,
@@ -671,6 +700,23 @@ class mincTools(temp_files):
         """perform incremental non-linear registration"""
         return registration.non_linear_register_increment(source, target, output_xfm,** kwargs)
         
+    def _resample_exact(self, input, output, transform, like, datatype):
+        """copy or flip input without interpolation if the transformation is
+        an identity or an x flip mapping voxels of the sampling grid onto each other,
+        return True if the output was produced"""
+        try:
+            kind = minc_resample.exact_mapping(input, transform=transform, like=like)
+            if kind is None:
+                return False
+            minc_resample.copy_volume(input, output, flip=(kind == 'flip'), datatype=datatype)
+            if self.verbose>0:
+                print("Resampled without interpolation ({}):{}".format(kind, output))
+            return True
+        except minc_resample.ResampleError as e:
+            if self.verbose>0:
+                print("Can't resample without interpolation:{}".format(str(e)))
+            return False
+
     def resample_smooth(
         self,
         input,
@@ -705,6 +751,10 @@ class mincTools(temp_files):
         if os.path.exists(output):
             return
 
+        if not uniformize and not unistep and \
+           self._resample_exact(input, output, transform, like, datatype):
+            return
+
         if not resample:
             resample = self.resample
         if resample == 'sinc':
@@ -799,9 +849,16 @@ class mincTools(temp_files):
         unistep=None,
         ):
         """resample an image with discrete labels"""
+        if os.path.exists(output):
+            return
+
         if datatype is None:
             datatype='byte'
 
+        if remap is None and aa is None and not baa and not uniformize and not unistep and \
+           self._resample_exact(input, output, transform, like, datatype):
+            return
+
         cmd = ['itk_resample', input, output, '--labels']
         
         
@@ -837,6 +894,59 @@ class mincTools(temp_files):
             
         self.command(cmd, inputs=[input], outputs=[output], verbose=self.verbose)
 
+    def resample_batch(
+        self,
+        smooth=None,
+        labels=None,
+        transform=None,
+        like=None,
+        order=4,
+        label_order=None,
+        invert_transform=False,
+        datatype=None,
+        label_datatype=None,
+        ):
+        """resample several volumes with the same transformation and sampling
+        
+        Arguments:
+        smooth -- list of (input, output) pairs, resampled as with resample_smooth
+        labels -- list of (input, output) pairs, resampled as with resample_labels
+        transform -- (optional) transformation file
+        like -- reference file for sampling
+        order -- interpolation order for intensities, default 4
+        label_order -- interpolation order for labels
+        invert_transform -- invert input transform, default False
+        datatype -- data type of intensity outputs
+        label_datatype -- data type of label outputs, default byte
+        
+        With engine 'numpy' sampling coordinates are computed once for all volumes,
+        see minc_resample. Otherwise each volume is resampled by a separate command,
+        running in background.
+        """
+        smooth=[(i,o) for (i,o) in (smooth or []) if not os.path.exists(o)]
+        labels=[(i,o) for (i,o) in (labels or []) if not os.path.exists(o)]
+        if len(smooth)==0 and len(labels)==0:
+            return
+
+        if self.engine == 'numpy' and like is not None and self.resample not in ('sinc','linear','cubic','nearest'):
+            try:
+                minc_resample.resample(smooth, labels, transform=transform, like=like,
+                                       order=order, label_order=label_order,
+                                       invert_transform=invert_transform,
+                                       datatype=datatype, label_datatype=label_datatype)
+                return
+            except minc_resample.ResampleError as e:
+                if self.verbose>0:
+                    print("Can't run in-process:{}".format(str(e)))
+
+        jobs=[self.submit(self.resample_smooth, i, o, transform=transform, like=like,
+                          order=order, invert_transform=invert_transform, datatype=datatype)
+              for (i,o) in smooth]
+        jobs+=[self.submit(self.resample_labels, i, o, transform=transform, like=like,
+                           order=label_order, invert_transform=invert_transform, datatype=label_datatype)
+               for (i,o) in labels]
+        minc_async.wait(jobs)
+
 
     def resample_smooth_logspace(
         self,
@@ -894,9 +1004,29 @@ class mincTools(temp_files):
         self.command(cmd, inputs=[input], outputs=[output], verbose=self.verbose)
 
         
+    def _linear_xfm(self, fun, inputs, outputs, *args):
+        """try to run linear transform algebra in-process,
+        return False if minc tools have to be used instead"""
+        if not self.checkfiles(inputs=inputs, outputs=outputs,
+                               verbose=self.verbose):
+            return True
+        try:
+            fun(*args)
+        except minc_xfm.XfmError as e:
+            if self.verbose>0:
+                print("Can't run in-process:{}".format(str(e)))
+            for o in outputs:
+                if os.path.exists(o):
+                    os.unlink(o)
+            return False
+        return True
+
     def xfminvert(self, input, output):
         """invert transformation"""
 
+        if self._linear_xfm(minc_xfm.invert, [input], [output], input, output):
+            return
+
         self.command(['xfminvert', input, output], inputs=[input],
                      outputs=[output],verbose=self.verbose)
 
@@ -908,6 +1038,9 @@ class mincTools(temp_files):
         ):
         """average transformations"""
 
+        if not nl and self._linear_xfm(minc_xfm.average, inputs, [output], inputs, output):
+            return
+
         cmd = ['xfmavg']
         cmd.extend(inputs)
         cmd.append(output)
@@ -919,6 +1052,9 @@ class mincTools(temp_files):
     def xfmconcat(self, inputs, output):
         """concatenate transformations"""
 
+        if self._linear_xfm(minc_xfm.concat, inputs, [output], inputs, output):
+            return
+
         cmd = ['xfmconcat']
         cmd.extend(inputs)
         cmd.append(output)
@@ -985,6 +1121,11 @@ class mincTools(temp_files):
         ):
         """apply mathematical expression to image(s)"""
 
+        if self.engine == 'numpy' and \
+           self._inprocess(minc_calc.calc, inputs, expression, output,
+                           datatype=datatype, labels=labels):
+            return
+
         cmd = ['minccalc', '-copy_header','-q', '-clob', '-express', expression]
         
         if datatype:
@@ -996,6 +1137,24 @@ class mincTools(temp_files):
         cmd.append(output)
         
         self.command(cmd, inputs=inputs, outputs=[output], verbose=self.verbose)
+
+    def _inprocess(self, fun, inputs, expression, output, **kwargs):
+        """try to run calc or math in-process, 
+        return False if minc tools have to be used instead"""
+        if not self.checkfiles(inputs=inputs, outputs=[output],
+                               verbose=self.verbose):
+            return True
+        if self.verbose>0:
+            print("in-process: {} {} {}".format(repr(expression),repr(inputs),output))
+        try:
+            fun(inputs, expression, output, **kwargs)
+        except minc_calc.CalcError as e:
+            if self.verbose>0:
+                print("Can't run in-process:{}".format(str(e)))
+            if os.path.exists(output):
+                os.unlink(output)
+            return False
+        return True
         
     def math(
         self,
@@ -1006,6 +1165,11 @@ class mincTools(temp_files):
         ):
         """apply mathematical operation to image(s)"""
 
+        if self.engine == 'numpy' and \
+           self._inprocess(minc_calc.math, inputs, operation, output,
+                           datatype=datatype):
+            return
+
         cmd = ['mincmath', '-q', '-clob', '-copy_header', '-'+operation]
         
         if datatype:
@@ -1089,6 +1253,10 @@ class mincTools(temp_files):
 
 
     def param2xfm(self, output, scales=None, translation=None, rotations=None, shears=None):
+        if self._linear_xfm(minc_xfm.param2xfm, [], [output], output,
+                            scales, translation, rotations, shears):
+            return
+
         cmd = ['param2xfm','-clobber',output]
 
         if translation is not None:
@@ -1450,6 +1618,68 @@ class mincTools(temp_files):
         self.command(cmd, inputs=[input, like], outputs=[output], verbose=self.verbose)
 
 
+    def flatten_xfm(self, xfms, like, step=None):
+        """flatten chain of transformations into a single one, sampled on the grid of like,
+        so that resampling of multiple volumes evaluates the chain only once
+        
+        returns name of the transformation: the input if there is nothing to flatten,
+        linear transformation if all are linear, grid transformation otherwise;
+        grid transformations are kept in IPL_XFM_CACHE directory if it is set,
+        keyed by contents of the chain and of the sampling grid
+        """
+        if not isinstance(xfms, list):
+            xfms=[xfms]
+        if len(xfms)==1 and minc_xfm.chain_length(xfms)<=1:
+            return xfms[0]
+        
+        h=hashlib.sha1()
+        for i in xfms:
+            h.update(minc_cache.file_hash(i).encode())
+        h.update(minc_cache.content_hash(like).encode())
+        h.update(str(step).encode())
+        key=h.hexdigest()
+        
+        try:
+            output=self.tmp('flat_'+key+'.xfm')
+            if not os.path.exists(output):
+                minc_xfm.concat(xfms, output)
+            return output
+        except minc_xfm.XfmError:
+            pass
+        
+        store=os.environ.get('IPL_XFM_CACHE',None)
+        if store is None:
+            if not os.path.exists(output):
+                self._flatten_xfm(xfms, like, output, step)
+            return output
+        
+        _dir=os.path.join(store,key[0:2])
+        output=os.path.join(_dir,key+'.xfm')
+        if os.path.exists(output+'.done'):
+            return output
+        if not os.path.exists(_dir):
+            try:
+                os.makedirs(_dir)
+            except OSError:
+                pass
+        # only one process computes the transformation, others wait for it
+        with open(output+'.lock','a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(output+'.done'):
+                    self._flatten_xfm(xfms, like, output, step)
+                    open(output+'.done','w').close()
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        return output
+
+    def _flatten_xfm(self, xfms, like, output, step):
+        chain=xfms[0]
+        if len(xfms)>1:
+            chain=self.tmp(os.path.basename(output).rsplit('.xfm',1)[0]+'_chain.xfm')
+            self.xfmconcat(xfms, chain)
+        self.xfm_normalize(chain, like, output, step=step, exact=(step is None))
+
     def xfm_noscale(self, input, output, unscale=None):
         """remove scaling from linear part of XFM"""
 
@@ -1458,6 +1688,11 @@ class mincTools(temp_files):
         if unscale is None:
             _unscale = self.temp_file(suffix='unscale.xfm')
         try:
+            try:
+                minc_xfm.noscale(input, output, _unscale)
+                return
+            except minc_xfm.XfmError:
+                pass
             (out, err) = subprocess.Popen(['xfm2param', input],
                     stdout=subprocess.PIPE).communicate()
             scale_ = filter(lambda x: re.match('^\-scale', x),
@@ -1819,6 +2054,14 @@ class mincTools(temp_files):
                     median=False, 
                     mask=None):
         ''' calculate label statistics : label_id, volume, mx, my, mz,[mean/median] '''
+        if self.engine == 'numpy':
+            try:
+                return minc_calc.label_stats(input, bg=bg, label_defs=label_defs,
+                                             volume=volume, median=median, mask=mask)
+            except minc_calc.CalcError as e:
+                if self.verbose>0:
+                    print("Can't run in-process:{}".format(str(e)))
+        
         _label_file=label_defs
         cmd=['itk_label_stats',input]
         if bg: cmd.append('--bg')
@@ -2097,6 +2340,11 @@ class mincTools(temp_files):
     def xfm2param(self, input):
         """extract transformation parameters"""
 
+        try:
+            return minc_xfm.xfm2param(input)
+        except minc_xfm.XfmError:
+            pass
+
         out=self.execute_w_output(['xfm2param', input])
         
         params_=[ [ float(k) if s>0 else k for s,k in enumerate(re.split('\s+', l))] for l in out.decode().split('\n') if re.match('^\-', l) ]
@@ -2128,37 +2376,46 @@ class mincTools(temp_files):
         self.command(cmd, inputs=inputs,outputs=[output], verbose=self.verbose)
         
         
+    def downsample(self, input, step, output=None, labels=False):
+        """resample input to isotropic step, 
+        returns name of the precomputed file from the pyramid store if it is enabled,
+        output otherwise
+        """
+        pyramid = minc_pyramid.get_pyramid()
+        if pyramid is not None:
+            return pyramid.downsampled(self, input, step, labels=labels)
+        if output is None:
+            base=os.path.basename(input).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
+            output=self.tmp(base+'_'+str(step)+'.mnc')
+        if labels:
+            self.resample_labels(input,output,unistep=step,datatype='byte')
+        else:
+            self.resample_smooth(input,output,unistep=step)
+        return output
+
     def downsample_registration_files(self, sources, targets, source_mask, target_mask, downsample=None):
         
-        sources_lr=sources
-        targets_lr=targets
+        if downsample is None:
+            return (sources, targets, source_mask, target_mask)
+        
+        sources_lr=[]
+        targets_lr=[]
         
         source_mask_lr=source_mask
         target_mask_lr=target_mask
         
-        modalities=len(sources)
-
-        if downsample is not None:
-            for _s in range(modalities):
-                s_base=os.path.basename(sources[_s]).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
-                t_base=os.path.basename(targets[_s]).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
-                
-                source_lr=self.tmp(s_base+'_'+str(downsample)+'_'+str(_s)+'.mnc')
-                target_lr=self.tmp(t_base+'_'+str(downsample)+'_'+str(_s)+'.mnc')
-
-                self.resample_smooth(sources[_s],source_lr,unistep=downsample)
-                self.resample_smooth(targets[_s],target_lr,unistep=downsample)
-                
-                sources_lr.append(source_lr)
-                targets_lr.append(target_lr)
-                
-                if _s==0:
-                    if target_mask is not None:
-                        target_mask_lr=self.tmp(s_base+'_mask_'+str(downsample)+'.mnc')
-                        self.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
-                    if target_mask is not None:
-                        target_mask_lr=self.tmp(s_base+'_mask_'+str(downsample)+'.mnc')
-                        self.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
+        for _s in range(len(sources)):
+            s_base=os.path.basename(sources[_s]).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
+            t_base=os.path.basename(targets[_s]).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
+            
+            sources_lr.append(self.downsample(sources[_s],downsample,self.tmp(s_base+'_'+str(downsample)+'_'+str(_s)+'.mnc')))
+            targets_lr.append(self.downsample(targets[_s],downsample,self.tmp(t_base+'_'+str(downsample)+'_'+str(_s)+'.mnc')))
+            
+            if _s==0:
+                if source_mask is not None:
+                    source_mask_lr=self.downsample(source_mask,downsample,self.tmp(s_base+'_mask_'+str(downsample)+'.mnc'),labels=True)
+                if target_mask is not None:
+                    target_mask_lr=self.downsample(target_mask,downsample,self.tmp(t_base+'_mask_'+str(downsample)+'.mnc'),labels=True)
         
         return (sources_lr, targets_lr, source_mask_lr, target_mask_lr)
         
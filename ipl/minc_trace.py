@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# Execution telemetry for external commands
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import inspect
+import errno
+import resource
+import argparse
+import threading
+import subprocess
+
+# modules that only pass commands through, skipped when looking for the calling stage
+_plumbing = ('minc_tools', 'minc_trace', 'iplGeneral')
+
+# explicitly declared stages of each thread, innermost last
+_local = threading.local()
+
+
+def _stages():
+    if not hasattr(_local, 'stages'):
+        _local.stages = []
+    return _local.stages
+
+
+class stage(object):
+    """Declare pipeline stage for all commands executed inside
+
+    with minc_trace.stage('nl_registration'):
+        ...
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        _stages().append(self.name)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _stages().pop()
+
+
+def trace_dir():
+    """directory where trace records are collected, tracing is off if None"""
+    return os.environ.get('IPL_TRACE_DIR', None)
+
+
+def _caller_stage():
+    """name of the function that called the command wrapper"""
+    stages = _stages()
+    if stages:
+        return stages[-1]
+    for f in inspect.stack(0)[2:]:
+        module = os.path.basename(f[1]).rsplit('.py', 1)[0]
+        if module not in _plumbing:
+            return '{}.{}'.format(module, f[3])
+    return 'unknown'
+
+
+class Popen(subprocess.Popen):
+    """subprocess.Popen keeping resource usage of the child,
+    it is reaped with os.wait4, so that usage of other children
+    running concurrently is not included"""
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            # status of the child is lost, same as subprocess.Popen
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, sts)
+
+
+class command_trace(object):
+    """Measure resources used by a single command,
+    write a record into the trace directory when done
+
+    set process attribute to the Popen object of the command,
+    to measure resources used by it only"""
+
+    def __init__(self, cmds, threads=None):
+        self.cmds = cmds
+        self.threads = threads
+        self.enabled = trace_dir() is not None
+        self.returncode = None
+        self.process = None
+
+    def __enter__(self):
+        if self.enabled:
+            self.stage = _caller_stage()
+            self.start = time.time()
+            self.usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if not self.enabled:
+            return False
+        wall = time.time() - self.start
+        usage = getattr(self.process, 'rusage', None)
+        if usage is not None:
+            (user, _sys, max_rss, read, written) = (usage.ru_utime, usage.ru_stime, usage.ru_maxrss,
+                                                    usage.ru_inblock, usage.ru_oublock)
+        else:
+            # child was not reaped by minc_trace.Popen, all children waited for meanwhile are included
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            (user, _sys, max_rss, read, written) = (usage.ru_utime - self.usage.ru_utime,
+                                                    usage.ru_stime - self.usage.ru_stime,
+                                                    0,
+                                                    usage.ru_inblock - self.usage.ru_inblock,
+                                                    usage.ru_oublock - self.usage.ru_oublock)
+
+        if isinstance(self.cmds, list):
+            argv = [str(i) for i in self.cmds]
+        else:
+            argv = str(self.cmds).split()
+        record = {
+            'tool':    os.path.basename(argv[0]) if argv else '',
+            'argv_hash': hashlib.sha1(' '.join(argv).encode()).hexdigest(),
+            'stage':   self.stage,
+            'start':   self.start,
+            'wall':    wall,
+            'user':    user,
+            'sys':     _sys,
+            # threads assigned by the thread budget, see minc_async
+            'threads': self.threads if self.threads is not None else 1,
+            # peak resident memory of the command, in kb, 0 - unknown
+            'max_rss': max_rss,
+            # block I/O, in 512 byte units
+            'read':    read * 512,
+            'written': written * 512,
+            'failed':  type is not None or self.returncode not in (None, 0),
+            'host':    socket.gethostname(),
+            'pid':     os.getpid(),
+        }
+        try:
+            fname = os.path.join(trace_dir(), 'trace_{}_{}.jsonl'.format(record['host'], record['pid']))
+            with open(fname, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        except (IOError, OSError) as e:
+            print("Can't write trace record:{}".format(str(e)), file=sys.stderr)
+        return False
+
+
+def load_traces(path):
+    """load all trace records from a directory"""
+    records = []
+    for i in sorted(os.listdir(path)):
+        if i.startswith('trace_') and i.endswith('.jsonl'):
+            with open(os.path.join(path, i), 'r') as f:
+                for l in f:
+                    l = l.strip()
+                    if len(l) > 0:
+                        records.append(json.loads(l))
+    return records
+
+
+def aggregate(records, key):
+    """aggregate records by key ('tool' or 'stage'), sorted by total wall time"""
+    table = {}
+    for r in records:
+        t = table.setdefault(r[key], {key: r[key], 'calls': 0, 'failed': 0,
+                                      'wall': 0.0, 'user': 0.0, 'sys': 0.0,
+                                      'max_rss': 0, 'read': 0, 'written': 0,
+                                      'thread_time': 0.0})
+        t['calls']  += 1
+        t['failed'] += 1 if r['failed'] else 0
+        for k in ('wall', 'user', 'sys', 'read', 'written'):
+            t[k] += r[k]
+        t['max_rss'] = max(t['max_rss'], r['max_rss'])
+        t['thread_time'] += r['wall'] * r.get('threads', 1)
+    for t in table.values():
+        # achieved parallel efficiency: cpu time over wall time of all assigned threads
+        t['efficiency'] = (t['user'] + t['sys']) / t['thread_time'] if t['thread_time'] > 0 else 0.0
+    return sorted(table.values(), key=lambda s: s['wall'], reverse=True)
+
+
+def print_table(rows, key, top=None, out=sys.stdout):
+    total = sum(r['wall'] for r in rows)
+    print("{:<40} {:>8} {:>12} {:>6} {:>10} {:>12} {:>6} {:>10} {:>10} {:>10}".format(
+        key, 'calls', 'wall,s', '%', 'mean,s', 'cpu,s', 'eff', 'rss,Mb', 'read,Mb', 'write,Mb'), file=out)
+    for r in rows[0:top]:
+        print("{:<40} {:>8} {:>12.1f} {:>6.1f} {:>10.2f} {:>12.1f} {:>6.2f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            r[key][-40:], r['calls'], r['wall'],
+            100.0 * r['wall'] / total if total > 0 else 0.0,
+            r['wall'] / r['calls'], r['user'] + r['sys'], r['efficiency'],
+            r['max_rss'] / 1024.0, r['read'] / 1048576.0, r['written'] / 1048576.0), file=out)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                 description='Summarize command traces collected with IPL_TRACE_DIR')
+
+    parser.add_argument("trace_dir",
+                        help="Directory with trace records")
+
+    parser.add_argument("--top",
+                        type=int,
+                        default=20,
+                        help="Number of entries to show in each table")
+
+    parser.add_argument("--json",
+                        dest="json",
+                        default=None,
+                        help="Save aggregated tables in json format")
+
+    options = parser.parse_args()
+    return options
+
+if __name__ == '__main__':
+    options = parse_options()
+    records = load_traces(options.trace_dir)
+    print("Records: {}".format(len(records)))
+    tools  = aggregate(records, 'tool')
+    stages = aggregate(records, 'stage')
+    print("\nPer tool:")
+    print_table(tools, 'tool', top=options.top)
+    print("\nPer stage:")
+    print_table(stages, 'stage', top=options.top)
+    if options.json is not None:
+        with open(options.json, 'w') as f:
+            json.dump({'tool': tools, 'stage': stages}, f, indent=1)
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @author Vladimir S. FONOV
+# @date 18/10/2026
+#
+# Reading and writing of MNI .xfm files and algebra of linear transforms
+
+from __future__ import print_function
+
+import os
+import sys
+import re
+import math
+
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+
+
+class XfmError(ValueError):
+    """Transform can't be handled in-process, caller should use minc tools"""
+    pass
+
+
+def read_xfm(path):
+    """read transform file, return list of (type, value, inverted) tuples
+    type is 'linear' with 4x4 matrix as value, 'Grid_Transform' with the full path
+    of the displacement volume as value, or one of the other non-linear types
+    with None as value"""
+    with open(path, 'r') as f:
+        text = f.read()
+    lines = text.split('\n')
+    if len(lines) == 0 or not lines[0].strip().startswith('MNI Transform File'):
+        raise XfmError("Not an MNI transform file:{}".format(path))
+    # remove comments
+    text = '\n'.join(l for l in lines[1:] if not l.lstrip().startswith('%'))
+
+    transforms = []
+    _type = None
+    _value = None
+    _inverted = False
+    for statement in text.split(';'):
+        (key, _, value) = statement.partition('=')
+        key = key.strip()
+        value = value.strip()
+        if key == '':
+            continue
+        if key == 'Transform_Type':
+            if _type is not None and _type != 'Linear':
+                transforms.append((_type, _value, _inverted))
+            _type = value
+            _value = None
+            _inverted = False
+        elif key == 'Invert_Flag':
+            _inverted = value.lower() in ('true', '1')
+        elif key == 'Linear_Transform':
+            m = [float(i) for i in value.split()]
+            if len(m) != 12:
+                raise XfmError("Malformed linear transform in:{}".format(path))
+            transforms.append(('linear', m + [0.0, 0.0, 0.0, 1.0], _inverted))
+            _type = None
+        elif key == 'Displacement_Volume':
+            _value = os.path.join(os.path.dirname(os.path.abspath(path)), value)
+        # other keys describe non-linear transforms, only their presence matters
+    if _type is not None and _type != 'Linear':
+        transforms.append((_type, _value, _inverted))
+    return transforms
+
+
+def chain_length(xfms):
+    """number of individual transforms in a chain of files"""
+    return sum(len(read_xfm(i)) for i in xfms)
+
+
+def read_linear(path):
+    """read transform file, return 4x4 matrix of the combined linear transform
+    raises XfmError if the file contains non-linear transforms"""
+    if not HAVE_NUMPY:
+        raise XfmError("numpy is not available")
+    mat = np.identity(4)
+    for (_type, value, inverted) in read_xfm(path):
+        if _type != 'linear':
+            raise XfmError("Non-linear transform {} in:{}".format(_type, path))
+        m = np.array(value).reshape(4, 4)
+        if inverted:
+            m = np.linalg.inv(m)
+        # transforms in the file are applied in order
+        mat = np.dot(m, mat)
+    return mat
+
+
+def write_linear(path, mat, comment=None):
+    """write 4x4 matrix as linear transform file"""
+    with open(path, 'w') as f:
+        f.write("MNI Transform File\n")
+        if comment is not None:
+            f.write("%{}\n".format(comment))
+        f.write("\nTransform_Type = Linear;\nLinear_Transform =\n")
+        for i in range(3):
+            f.write(" {:.15g} {:.15g} {:.15g} {:.15g}".format(*mat[i]))
+            f.write(";\n" if i == 2 else "\n")
+
+
+def concat(inputs, output):
+    """in-process xfmconcat, for linear transforms only"""
+    mats = [read_linear(i) for i in inputs]
+    mat = np.identity(4)
+    for m in mats:
+        mat = np.dot(m, mat)
+    write_linear(output, mat, 'xfmconcat ' + ' '.join(inputs))
+
+
+def invert(input, output):
+    """in-process xfminvert, for linear transforms only"""
+    write_linear(output, np.linalg.inv(read_linear(input)), 'xfminvert ' + input)
+
+
+def _rotation(rx, ry, rz):
+    """rotation matrix R=Rz*Ry*Rx, angles in radians, same as in param2xfm"""
+    (cx, sx) = (math.cos(rx), math.sin(rx))
+    (cy, sy) = (math.cos(ry), math.sin(ry))
+    (cz, sz) = (math.cos(rz), math.sin(rz))
+    Rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    Ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    Rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return np.dot(Rz, np.dot(Ry, Rx))
+
+
+def params_to_matrix(center=None, translation=None, rotations=None, scales=None, shears=None):
+    """build transformation matrix M = T*C*SH*S*R*(-C), rotations in degrees"""
+    center      = center      if center      is not None else [0.0, 0.0, 0.0]
+    translation = translation if translation is not None else [0.0, 0.0, 0.0]
+    rotations   = rotations   if rotations   is not None else [0.0, 0.0, 0.0]
+    scales      = scales      if scales      is not None else [1.0, 1.0, 1.0]
+    shears      = shears      if shears      is not None else [0.0, 0.0, 0.0]
+
+    R = _rotation(*[math.radians(float(i)) for i in rotations])
+    S = np.diag([float(i) for i in scales])
+    SH = np.array([[1.0, float(shears[0]), float(shears[1])],
+                   [0.0, 1.0,              float(shears[2])],
+                   [0.0, 0.0,              1.0]])
+    A = np.dot(SH, np.dot(S, R))
+    c = np.array(center, dtype=np.float64)
+    mat = np.identity(4)
+    mat[0:3, 0:3] = A
+    mat[0:3, 3] = np.array(translation, dtype=np.float64) + c - np.dot(A, c)
+    return mat
+
+
+def matrix_to_params(mat, center=None):
+    """decompose matrix into parameters, inverse of params_to_matrix"""
+    c = np.array(center if center is not None else [0.0, 0.0, 0.0], dtype=np.float64)
+    A = np.array(mat)[0:3, 0:3]
+    # A = U*R with U=SH*S upper triangular, Gram-Schmidt starting from the last row
+    r = np.zeros((3, 3))
+    U = np.zeros((3, 3))
+    for i in (2, 1, 0):
+        v = A[i].copy()
+        for j in range(i + 1, 3):
+            U[i, j] = np.dot(A[i], r[j])
+            v -= U[i, j] * r[j]
+        U[i, i] = np.linalg.norm(v)
+        if U[i, i] == 0.0:
+            raise XfmError("Degenerate transformation matrix")
+        r[i] = v / U[i, i]
+    if np.linalg.det(r) < 0:
+        # reflection goes into the x scale
+        r[0] = -r[0]
+        U[:, 0] = -U[:, 0]
+    scales = [U[0, 0], U[1, 1], U[2, 2]]
+    shears = [U[0, 1] / scales[1], U[0, 2] / scales[2], U[1, 2] / scales[2]]
+    ry = math.asin(max(-1.0, min(1.0, -r[2, 0])))
+    rx = math.atan2(r[2, 1], r[2, 2])
+    rz = math.atan2(r[1, 0], r[0, 0])
+    translation = np.array(mat)[0:3, 3] - c + np.dot(A, c)
+    return {'center':      [float(i) for i in c],
+            'translation': [float(i) for i in translation],
+            'rotation':    [math.degrees(rx), math.degrees(ry), math.degrees(rz)],
+            'scale':       [float(i) for i in scales],
+            'shear':       [float(i) for i in shears]}
+
+
+def param2xfm(output, scales=None, translation=None, rotations=None, shears=None):
+    """in-process param2xfm"""
+    if not HAVE_NUMPY:
+        raise XfmError("numpy is not available")
+    write_linear(output, params_to_matrix(translation=translation, rotations=rotations,
+                                          scales=scales, shears=shears), 'param2xfm')
+
+
+def xfm2param(input):
+    """in-process xfm2param, for linear transforms only"""
+    return matrix_to_params(read_linear(input))
+
+
+def noscale(input, output, unscale):
+    """remove scaling from linear transform, same as mincTools.xfm_noscale"""
+    mat = read_linear(input)
+    p = matrix_to_params(mat)
+    _unscale = np.linalg.inv(params_to_matrix(scales=p['scale']))
+    write_linear(unscale, _unscale, 'unscale ' + input)
+    write_linear(output, np.dot(_unscale, mat), 'noscale ' + input)
+
+
+def _logm(m, terms=40):
+    """matrix logarithm of a transform close to identity, using inverse scaling and squaring"""
+    k = 0
+    while np.linalg.norm(m - np.identity(4)) > 0.25 and k < 20:
+        m = _sqrtm(m)
+        k += 1
+    x = m - np.identity(4)
+    out = np.zeros((4, 4))
+    p = np.identity(4)
+    for i in range(1, terms):
+        p = np.dot(p, x)
+        out += p * ((-1.0) ** (i + 1) / i)
+    return out * (2 ** k)
+
+
+def _sqrtm(m):
+    """Denman-Beavers iteration for matrix square root"""
+    y = m
+    z = np.identity(4)
+    for _ in range(50):
+        (y, z) = (0.5 * (y + np.linalg.inv(z)), 0.5 * (z + np.linalg.inv(y)))
+    return y
+
+
+def _expm(m, terms=20):
+    """matrix exponential, using scaling and squaring"""
+    k = 0
+    while np.linalg.norm(m) / (2 ** k) > 0.5 and k < 40:
+        k += 1
+    m = m / (2 ** k)
+    out = np.identity(4)
+    p = np.identity(4)
+    for i in range(1, terms):
+        p = np.dot(p, m) / i
+        out += p
+    for _ in range(k):
+        out = np.dot(out, out)
+    return out
+
+
+def average(inputs, output):
+    """in-process xfmavg for linear transforms, average in the matrix log domain"""
+    mats = [read_linear(i) for i in inputs]
+    if any(np.linalg.det(m[0:3, 0:3]) <= 0 for m in mats):
+        raise XfmError("Can't average transforms with reflections")
+    log = sum(_logm(m) for m in mats) / len(mats)
+    write_linear(output, _expm(log), 'xfmavg ' + ' '.join(inputs))
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
@@ -16,12 +16,16 @@ import tempfile
 import subprocess
 import re
 import fcntl
+import json
 import traceback
 import collections
 import math
 import argparse
 # local stuff
 import minc_tools
+import minc_pyramid
+import minc_registration_store
+import minc_grid
 
 
 # hack to make it work on Python 3
@@ -258,6 +262,39 @@ linear_registration_config={
         ]
     }
 
+def blur_registration_files(minc, tmp, base, originals, inputs, blur, fwhm, downsample=None):
+    """blur registration inputs, using shared pyramid store if it is enabled
+    
+    Args:
+        minc - mincTools instance
+        tmp - cache_files instance, used when pyramid store is not enabled
+        base - base name for the cached files
+        originals - original input files
+        inputs - files to blur, possibly downsampled versions of originals
+        blur - 'blur' or 'dxyz'
+        fwhm - blurring kernel
+        downsample - downsampling step of inputs
+    Returns:
+        list of blurred files
+    """
+    pyramid = minc_pyramid.get_pyramid()
+    outputs = []
+    for s_,_ in enumerate(inputs):
+        if pyramid is not None:
+            if s_<len(originals) and inputs[s_]!=originals[s_]:
+                outputs.append(pyramid.blurred(minc, originals[s_], fwhm, blur=blur,
+                                               downsample=downsample, source=inputs[s_]))
+            else:
+                outputs.append(pyramid.blurred(minc, inputs[s_], fwhm, blur=blur))
+        else:
+            tmp_blur = tmp.cache(base+'_'+blur+'_'+str(fwhm)+'_'+str(s_)+'.mnc')
+            if not os.path.exists(tmp_blur):
+                minc.blur(inputs[s_],tmp_blur,gmag=(blur=='dxyz'), fwhm=fwhm)
+            outputs.append(tmp_blur)
+    return outputs
+
+
+@minc_registration_store.memoize(outputs=lambda a: {'xfm': a['output_xfm']})
 def linear_register(
     source,
     target,
@@ -403,20 +440,10 @@ def linear_register(
 
                 
                 if c['blur_fwhm']>0:
-                    tmp_sources=[]
-                    tmp_targets=[]
-                    
-                    for s_,_ in enumerate(sources_lr):
-                        tmp_source = tmp.cache(s_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_source):
-                            minc.blur(sources_lr[s_],tmp_source,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
-                            
-                        tmp_target = tmp.cache(t_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_target):
-                            minc.blur(targets_lr[s_],tmp_target,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
-                            
-                        tmp_sources.append(tmp_source)
-                        tmp_targets.append(tmp_target)
+                    tmp_sources=blur_registration_files(minc, tmp, s_base, sources, sources_lr,
+                                                        c['blur'], c['blur_fwhm'], downsample)
+                    tmp_targets=blur_registration_files(minc, tmp, t_base, targets, targets_lr,
+                                                        c['blur'], c['blur_fwhm'], downsample)
                 
                 objective_=objective
                 
@@ -507,7 +534,7 @@ def linear_register(
 
                 # add files and run registration
                 args.append(tmp_xfm)
-                minc.command([str(ii) for ii in args],inputs=[tmp_source,tmp_target],outputs=[tmp_xfm])
+                minc.command([str(ii) for ii in args],inputs=tmp_sources+tmp_targets,outputs=[tmp_xfm])
                 
                 if _reverse:
                       inv_tmp_xfm =    tmp.tmp(s_base+'_'+t_base+'_'+str(i)+'_sol.xfm')
@@ -563,6 +590,59 @@ def linear_register_to_self(
 
 
 
+def nl_level_similarity(minc, tmp, source, target, xfm, target_mask=None):
+    """correlation coefficient between target and source resampled with xfm,
+    used to monitor convergence of the non-linear registration"""
+    resampled=tmp.tmp('similarity_'+os.path.basename(xfm).rsplit('.xfm',1)[0]+'.mnc') if xfm is not None \
+              else tmp.tmp('similarity_init.mnc')
+    if os.path.exists(resampled):
+        os.unlink(resampled)
+    minc.resample_smooth(source, resampled, transform=xfm, like=target, order=1)
+    return minc.similarity(target, resampled, ref_mask=target_mask, method='cc')
+
+
+# correlation coefficient of the initial alignment above which
+# coarse levels of registration are skipped
+warm_start_similarity=0.9
+
+def init_similarity(source, target, init_xfm, target_mask=None):
+    """correlation coefficient between target and source resampled with init_xfm,
+    measures how good initialization of the registration is"""
+    with minc_tools.mincTools() as minc:
+        return nl_level_similarity(minc, minc, source, target, init_xfm, target_mask)
+
+
+def warm_start_conf(conf, blur_fwhm=4):
+    """linear registration configuration without levels coarser than blur_fwhm,
+    for registration initialized close to the solution"""
+    if not isinstance(conf, list):
+        conf = linear_registration_config.get(conf, conf)
+    if not isinstance(conf, list):
+        # external program
+        return conf
+    return [c for c in conf if c['blur_fwhm'] <= blur_fwhm]
+
+
+def warm_start_xfm(source, target, candidates, target_mask=None):
+    """choose initial transformation from candidates, i.e results of registration
+    of other timepoints of the same subject
+
+    Returns:
+        tuple of (xfm,similarity) giving the best initial alignment or (None,None)
+    """
+    best=(None,None)
+    for xfm in candidates:
+        if xfm is None or not os.path.exists(xfm):
+            continue
+        similarity=init_similarity(source, target, xfm, target_mask=target_mask)
+        print("Warm start from {} similarity:{}".format(xfm,similarity))
+        if best[1] is None or similarity>best[1]:
+            best=(xfm,similarity)
+    return best
+
+
+@minc_registration_store.memoize(outputs=lambda a: {'xfm': a['output_xfm']})
+@minc_grid.compact_outputs(outputs=lambda a: [a['output_xfm']])
 def non_linear_register_full(
     source, target, output_xfm, 
     source_mask=None,
@@ -572,7 +652,8 @@ def non_linear_register_full(
     start=32,
     parameters=None,
     work_dir=None,
-    downsample=None
+    downsample=None,
+    checkpoint_dir=None
     ):
     """perform non-linear registration, multiple levels
     Args:
@@ -587,6 +668,14 @@ def non_linear_register_full(
         start - initial step size, default 32mm 
         level - final step size, default 4mm
         downsample - downsample initial files to this step size, default None
+        checkpoint_dir - directory where result of each level is kept, so that
+            interrupted registration resumes after the last completed level,
+            default IPL_CHECKPOINT_DIR, None - no checkpoints. Checkpoints are
+            full resolution grids of every level and are not removed
+        
+        parameters may contain 'early_stop' - minimal gain of the similarity 
+        (correlation coefficient, measured after each level) required to 
+        continue with the finer levels, default None - run all levels
 
     Returns:
         resulting XFM file
@@ -687,90 +776,150 @@ def non_linear_register_full(
       t_base=os.path.basename(targets[0]).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
 
       
+      if checkpoint_dir is None:
+          checkpoint_dir=os.environ.get('IPL_CHECKPOINT_DIR',None)
+      if checkpoint_dir is not None and not os.path.exists(checkpoint_dir):
+          try:
+              os.makedirs(checkpoint_dir)
+          except OSError:
+              pass
+      
+      early_stop=parameters.get('early_stop',None)
+      
       # figure out what to do here:
       with minc_tools.cache_files(work_dir=work_dir,context='reg') as tmp:
           # a fitting we shall go...
           (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources, targets, source_mask, target_mask, downsample)
           
+          # levels performed so far, define the checkpoint of each level
+          levels_done=[]
+          prev_similarity=None
+          if early_stop is not None:
+              prev_similarity=nl_level_similarity(minc, tmp, sources_lr[0], targets_lr[0], init_xfm, target_mask_lr)
+          
           for (i,c) in enumerate(parameters['conf']):
 
               if   c['step']>start:
                   continue
               elif c['step']<level:
                   break
+              
+              levels_done.append(c)
 
               # set up intermediate files
               tmp_=        tmp.tmp(s_base+'_'+t_base+'_'+str(i))
+              checkpoint=None
+              
+              if checkpoint_dir is not None:
+                  checkpoint=checkpoint_dir+os.sep+'nl_'+minc_registration_store.arguments_hash('non_linear_register_full',
+                      {'sources': sources, 'targets': targets,
+                       'source_mask': source_mask, 'target_mask': target_mask,
+                       'init_xfm': init_xfm, 'downsample': downsample,
+                       'parameters': {k:v for (k,v) in parameters.items() if k not in ('conf','early_stop')},
+                       'levels': levels_done})
+                  tmp_=checkpoint
               
               tmp_xfm =    tmp_+'.xfm'
               tmp_grid=    tmp_+'_grid_0.mnc'
-
-              tmp_sources=sources_lr
-              tmp_targets=targets_lr
-
-              if c['blur_fwhm']>0:
-                    tmp_sources=[]
-                    tmp_targets=[]
-                    
-                    for s_,_ in enumerate(sources_lr):
-                        tmp_source = tmp.cache(s_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_source):
-                            minc.blur(sources_lr[s_],tmp_source,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
-                        tmp_target = tmp.cache(t_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_target):
-                            minc.blur(targets_lr[s_],tmp_target,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
-                        tmp_sources.append(tmp_source)
-                        tmp_targets.append(tmp_target)
-
-
-              # set up registration
-              args =['minctracc', tmp_sources[0],tmp_targets[0],'-clobber', 
-                          '-nonlinear',  parameters['cost'],
-                          '-weight',     parameters['weight'],
-                          '-stiffness',  parameters['stiffness'],
-                          '-similarity', parameters['similarity'],
-                          '-sub_lattice',parameters['sub_lattice'],
-                      ]
-
-              args.extend(['-iterations',     c['iterations'] ] )
-              args.extend(['-lattice_diam',   c['step']*3.0, c['step']*3.0, c['step']*3.0 ] )
-              args.extend(['-step',           c['step'],     c['step'],     c['step'] ] )
-              
-              if c['step']<4: #TODO: check if it's 4*minc_step ?
-                  args.append('-no_super')
-              
-              for s_ in range(len(tmp_targets)-1):
-                  args.extend([ '-feature_vol',tmp_sources[s_+1],tmp_targets[s_+1],parameters['cost'],1.0])
               
-                  # Current transformation at this step
-              if prev_xfm is not None:
-                  args.extend(['-transformation', prev_xfm])
-              elif init_xfm is not None:
-                  args.extend(['-transformation', init_xfm])
-              else:
-                  args.append('-identity')
-
-              # masks (even if the blurred image is masked, it's still preferable
-              # to use the mask in minctracc)
-              if source_mask is not None:
-                  args.extend(['-source_mask',source_mask_lr])
-              if target_mask is not None:
-                  args.extend(['-model_mask',target_mask_lr])
-
-              # add files and run registration
-              args.append(tmp_xfm)
-
-              minc.command([str(ii) for ii in args],
-                              inputs=[tmp_source,tmp_target],
-                              outputs=[tmp_xfm] )
+              lock=None
+              if checkpoint is not None:
+                  # only one process computes the level, others wait for it
+                  lock=open(checkpoint+'.lock','a')
+                  fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+              try:
+                  info=None
+                  if checkpoint is not None and os.path.exists(checkpoint+'.done'):
+                      # level was completed by a previous run
+                      with open(checkpoint+'.done','r') as f:
+                          info=json.load(f)
+                      print("Resuming non-linear registration after step {}".format(c['step']))
+                  else:
+                      tmp_sources=sources_lr
+                      tmp_targets=targets_lr
+
+                      if c['blur_fwhm']>0:
+                            tmp_sources=blur_registration_files(minc, tmp, s_base, sources, sources_lr,
+                                                                c['blur'], c['blur_fwhm'], downsample)
+                            tmp_targets=blur_registration_files(minc, tmp, t_base, targets, targets_lr,
+                                                                c['blur'], c['blur_fwhm'], downsample)
+
+
+                      # set up registration
+                      args =['minctracc', tmp_sources[0],tmp_targets[0],'-clobber', 
+                                  '-nonlinear',  parameters['cost'],
+                                  '-weight',     parameters['weight'],
+                                  '-stiffness',  parameters['stiffness'],
+                                  '-similarity', parameters['similarity'],
+                                  '-sub_lattice',parameters['sub_lattice'],
+                              ]
+
+                      args.extend(['-iterations',     c['iterations'] ] )
+                      args.extend(['-lattice_diam',   c['step']*3.0, c['step']*3.0, c['step']*3.0 ] )
+                      args.extend(['-step',           c['step'],     c['step'],     c['step'] ] )
+                      
+                      if c['step']<4: #TODO: check if it's 4*minc_step ?
+                          args.append('-no_super')
+                      
+                      for s_ in range(len(tmp_targets)-1):
+                          args.extend([ '-feature_vol',tmp_sources[s_+1],tmp_targets[s_+1],parameters['cost'],1.0])
+                      
+                          # Current transformation at this step
+                      if prev_xfm is not None:
+                          args.extend(['-transformation', prev_xfm])
+                      elif init_xfm is not None:
+                          args.extend(['-transformation', init_xfm])
+                      else:
+                          args.append('-identity')
+
+                      # masks (even if the blurred image is masked, it's still preferable
+                      # to use the mask in minctracc)
+                      if source_mask is not None:
+                          args.extend(['-source_mask',source_mask_lr])
+                      if target_mask is not None:
+                          args.extend(['-model_mask',target_mask_lr])
+
+                      # add files and run registration
+                      args.append(tmp_xfm)
+
+                      minc.command([str(ii) for ii in args],
+                                      inputs=tmp_sources+tmp_targets,
+                                      outputs=[tmp_xfm] )
+                      
+                      info={'step':c['step']}
+                      if early_stop is not None:
+                          info['similarity']=nl_level_similarity(minc, tmp, sources_lr[0], targets_lr[0], tmp_xfm, target_mask_lr)
+                      if checkpoint is not None:
+                          with open(checkpoint+'.done','w') as f:
+                              json.dump(info,f)
+              finally:
+                  if lock is not None:
+                      fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+                      lock.close()
 
               prev_xfm  = tmp_xfm
               prev_grid = tmp_grid
+              
+              if early_stop is not None:
+                  similarity=info.get('similarity',None)
+                  if similarity is None:
+                      similarity=nl_level_similarity(minc, tmp, sources_lr[0], targets_lr[0], tmp_xfm, target_mask_lr)
+                  if similarity-prev_similarity<early_stop:
+                      print("Similarity gain {} at step {} is below {}, skipping finer levels".format(similarity-prev_similarity, c['step'], early_stop))
+                      break
+                  prev_similarity=similarity
 
           # done
           if prev_xfm is None:
               raise minc_tools.mincError("No iterations were performed!")
 
+          if checkpoint_dir is not None:
+              # don't modify checkpoints, they could be used by another process
+              shutil.copyfile(prev_xfm, tmp.tmp(os.path.basename(prev_xfm)))
+              shutil.copyfile(prev_grid,tmp.tmp(os.path.basename(prev_grid)))
+              prev_xfm =tmp.tmp(os.path.basename(prev_xfm))
+              prev_grid=tmp.tmp(os.path.basename(prev_grid))
+
           # STOP-gap measure to save space for now
           # TODO: fix minctracc?
           # TODO: fix mincreshape too!
@@ -84,30 +84,36 @@ def create_error_map(input_ground_truth,
                      label_list=[] ):
     try:
         with mincTools( verbose=2 ) as m:
-            # go over labels and calculate errors per label
-            #
-            for (i,l) in enumerate(label_list):
+            xfm=None
+            if lin_xfm is not None and nl_xfm is not None:
+                xfm=m.tmp('concat.xfm')
+                m.xfmconcat([lin_xfm,nl_xfm],xfm)
+            elif lin_xfm is not None:
+                xfm=lin_xfm
+            else:
+                xfm=nl_xfm
+
+            if xfm is not None and template is not None:
+                # evaluate transformation chain only once for all labels
+                xfm=m.flatten_xfm(xfm, template)
+
+            def _error_map(l, output_map):
                 # extract label error
                 out=m.tmp(str(l)+'.mnc')
-                xfm=None
-                
                 m.calc([input_segmentation, input_ground_truth],
                        "abs(A[0]-{})<0.5&&abs(A[1]-{})>0.5 || abs(A[0]-{})>0.5&&abs(A[1]-{})<0.5 ? 1:0".format(l,l,l,l),
                        out, datatype='-byte')
-                
-                if lin_xfm is not None and nl_xfm is not None:
-                    xfm=m.tmp(str(l)+'.xfm')
-                    m.xfmconcat([lin_xfm,nl_xfm],xfm)
-                elif lin_xfm is not None:
-                    xfm=lin_xfm
-                else:
-                    xfm=nl_xfm
-
-                m.resample_smooth(out,output_maps[i],
+                m.resample_smooth(out,output_map,
                                     transform=xfm,
                                     like=template,
                                     order=1,
                                     datatype='byte')
+                m.free(str(l)+'.mnc')
+
+            # go over labels and calculate errors per label, concurrently
+            results=[ m.submit(_error_map, l, output_maps[i]) for (i,l) in enumerate(label_list) ]
+            for r in results:
+                r.result()
                 
     except mincError as e:
         print("Exception in split_labels:{}".format(str(e)))
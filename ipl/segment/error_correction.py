@@ -19,6 +19,9 @@ except ImportError:
 import sys
 import json
 import csv
+import shutil
+import hashlib
+import threading
 # minc
 #import minc
 from minc2_simple import minc2_xfm,minc2_file
@@ -47,64 +50,119 @@ except ImportError:
 
 # MINC stuff
 from   ipl.minc_tools import mincTools,mincError
+from   ipl.minc_cache import content_hash
+from   ipl.minc_header import mincinfo
 import traceback
 
 
-def prepare_features(images, coords, mask=None, use_coord=True, use_joint=True, patch_size=1, primary_features=1 ):
-    features=[]
+# number of voxels processed at once by patch_features
+feature_chunk=16384
 
-    # add features dependant on coordinates
 
+def patch_features(images, coords, mask=None, use_coord=True, use_joint=True, patch_size=1, primary_features=1, out=None, chunk=None ):
+    '''
+    calculate features for each voxel in the mask, same as prepare_features,
+    patches are gathered directly at the masked voxels using flat offsets,
+    so that memory and time depend on the mask size and not on the volume size
+    
+    returns float32 matrix with one row per voxel
+    out   -- optional destination, array or name of .npy file to be memory mapped
+    chunk -- number of voxels processed at once
+    '''
     image_no=len(images)
     if primary_features > image_no or primary_features<0 :
         primary_features=image_no
-    # use with center at 0 and 1.0 at the edge, could have used preprocessing
-    image_idx=0
-    if use_coord:
-        image_idx=3
-        if coords is None:
-            c=np.mgrid[ 0:images[0].shape[0] ,
-                        0:images[0].shape[1] ,
-                        0:images[0].shape[2] ]
-                        
-            features.append( ( c[2]-images[0].shape[0]/2.0)/ (images[0].shape[0]/2.0) )
-            features.append( ( c[1]-images[0].shape[1]/2.0)/ (images[0].shape[1]/2.0) )
-            features.append( ( c[0]-images[0].shape[2]/2.0)/ (images[0].shape[2]/2.0) )
-            
-        else: # assume we have three sets of coords
-            features.append( coords[0] )
-            features.append( coords[1] )
-            features.append( coords[2] )
+    if chunk is None:
+        chunk=feature_chunk
 
+    shape=images[0].shape
+    stride=(shape[1]*shape[2], shape[2], 1)
 
-    # add apparance and context images (patch around each voxel)
+    if mask is not None:
+        idx=np.flatnonzero( mask>0 )
+    else:
+        idx=np.arange( images[0].size )
+
+    # same order as np.roll in prepare_features
     if patch_size>0:
-        for i in range(primary_features) :
-            for x in range(-patch_size,patch_size+1) :
-                for y in range (-patch_size,patch_size+1) :
-                    for z in range(-patch_size,patch_size+1) :
-                        features.append( np.roll( np.roll( np.roll( images[i], shift=x, axis=0 ), shift=y, axis=1), shift=z, axis=2 ) )
-                        
-        features.extend(images[primary_features:-1]) # add the rest
-        app_features=primary_features*(patch_size*2+1)*(patch_size*2+1)*(patch_size*2+1)+(image_no-primary_features)
-        primary_features=primary_features*(patch_size*2+1)*(patch_size*2+1)*(patch_size*2+1)
+        patch=[ (x,y,z) for x in range(-patch_size,patch_size+1)
+                        for y in range(-patch_size,patch_size+1)
+                        for z in range(-patch_size,patch_size+1) ]
+        offsets=np.array( [ -(x*stride[0]+y*stride[1]+z) for (x,y,z) in patch ] )
+        other=images[primary_features:-1]
+        joint_no=primary_features*len(patch)
     else:
-        features.extend(images)
-        app_features=image_no
-     
-    # add joint features
-    if use_joint and use_coord:
-        for i in range(primary_features):
-            # multiply apparance features by coordinate features 
+        patch=[]
+        offsets=np.zeros(0,dtype=int)
+        other=images
+        joint_no=primary_features
+
+    # flat images, copied only if not contiguous
+    flat=[ np.ravel(i) for i in images[0:primary_features] ] if patch_size>0 else []
+    flat_other=[ np.ravel(i) for i in other ]
+    flat_coords=[ np.ravel(i) for i in coords ] if use_coord and coords is not None else None
+
+    coord_no= 3 if use_coord else 0
+    app_no  = len(flat)*len(patch)+len(flat_other)
+    if not( use_joint and use_coord ):
+        joint_no=0
+    features_no=coord_no+app_no+joint_no*3
+
+    if out is None:
+        out=np.empty( (idx.size, features_no), dtype=np.float32 )
+    elif isinstance(out, str):
+        out=np.lib.format.open_memmap( out, mode='w+', dtype=np.float32, shape=(idx.size, features_no) )
+    elif out.shape!=(idx.size, features_no):
+        raise ValueError("Unexpected features shape:{} instead of {}".format(repr(out.shape),repr((idx.size, features_no))))
+
+    for beg in range(0, idx.size, chunk):
+        _idx=idx[beg:beg+chunk]
+        f=np.empty( (_idx.size, features_no), dtype=np.float32 )
+        c=np.unravel_index( _idx, shape )
+        # use with center at 0 and 1.0 at the edge
+        if use_coord:
+            if flat_coords is None:
+                f[:,0]=( c[2]-shape[0]/2.0)/ (shape[0]/2.0)
+                f[:,1]=( c[1]-shape[1]/2.0)/ (shape[1]/2.0)
+                f[:,2]=( c[0]-shape[2]/2.0)/ (shape[2]/2.0)
+            else:
+                for j in range(3):
+                    f[:,j]=flat_coords[j][_idx]
+        k=coord_no
+        if len(patch)>0:
+            if all( np.all(c[j]>=patch_size) and np.all(c[j]<shape[j]-patch_size) for j in range(3) ):
+                # neighbourhood inside the volume
+                n=_idx[:,None]+offsets[None,:]
+            else:
+                # wrap around like np.roll
+                n=np.column_stack( tuple( ((c[0]-x)%shape[0])*stride[0] + ((c[1]-y)%shape[1])*stride[1] + (c[2]-z)%shape[2]
+                                          for (x,y,z) in patch ) )
+            for i in flat:
+                f[:,k:k+len(patch)]=i[n]
+                k+=len(patch)
+        for i in flat_other:
+            f[:,k]=i[_idx]
+            k+=1
+        # multiply apparance features by coordinate features
+        for i in range(joint_no):
             for j in range(3):
-                # multiply apparance features by coordinate features 
-                features.append( features[i+image_idx] * features[j] )
+                f[:,k]=f[:,i+coord_no]*f[:,j]
+                k+=1
+        out[beg:beg+_idx.size,:]=f
+    return out
+
 
-    # extract only what's needed
+def prepare_features(images, coords, mask=None, use_coord=True, use_joint=True, patch_size=1, primary_features=1 ):
+    '''
+    calculate features for each voxel in the mask, returns list of features,
+    or list of volumes if mask is not specified
+    '''
+    features=patch_features(images, coords, mask=mask, use_coord=use_coord, use_joint=use_joint,
+                            patch_size=patch_size, primary_features=primary_features)
     if mask is not None:
-      return [  i[ mask>0 ] for i in features ]
+        return [ i for i in features.T ]
     else:
-      return [  i for i in features ]
+        return [ i.reshape(images[0].shape) for i in features.T ]
 
 
 def convert_image_list(images):
@@ -113,7 +171,10 @@ def convert_image_list(images):
     '''
     s=[]
     for (i,k) in enumerate(images):
-        s.append(np.column_stack( tuple( np.ravel( j ) for j in k ) ) )
+        if isinstance(k, np.ndarray) and k.ndim==2: # already a feature matrix
+            s.append(k)
+        else:
+            s.append(np.column_stack( tuple( np.ravel( j ) for j in k ) ) )
         print(s[-1].shape)
 
     return np.vstack( tuple( i for i in s ) )
@@ -188,6 +249,148 @@ def merge_segmentations(inputs, output, partition, parameters):
     out_i.save( name=output, imitate=inputs[0])
 
 
+class training_set(object):
+    '''
+    training samples accumulated subject by subject, without stacking
+    all feature matrices in memory
+    
+    max_samples -- keep at most this number of samples, each class gets up to 
+                   max_samples/classes samples, selected randomly with reservoir sampling,
+                   this changes the class prior of the samples
+    path        -- append samples to this file and use it as a memory mapped array,
+                   otherwise samples are kept in memory
+    random      -- random seed for sampling
+    '''
+    def __init__(self, max_samples=None, classes=2, path=None, random=None):
+        self.capacity=None
+        if max_samples is not None:
+            self.capacity=max(1, int(max_samples)//max(1,classes))
+        self.path=path
+        self.rng=np.random.RandomState(random)
+        self.X=[]
+        self.Y=[]
+        self.reservoir={}
+        self.rows=0
+        self.features_no=None
+        self._file=None
+
+    def add(self, X, Y):
+        '''add samples of one subject'''
+        X=np.asarray(X, dtype=np.float32)
+        Y=np.ravel(Y)
+        self.features_no=X.shape[1]
+        if self.capacity is not None:
+            self._sample(X, Y)
+        elif self.path is not None:
+            if self._file is None:
+                self._file=open(self.path,'wb')
+            X.tofile(self._file)
+            self.Y.append(Y)
+        else:
+            self.X.append(X)
+            self.Y.append(Y)
+        self.rows+=X.shape[0]
+
+    def _sample(self, X, Y):
+        for label in np.unique(Y):
+            sel=np.flatnonzero(Y==label)
+            if label not in self.reservoir:
+                self.reservoir[label]=[np.empty((self.capacity, X.shape[1]), dtype=np.float32), 0, Y[sel[0]]]
+            r=self.reservoir[label]
+            seen=r[1]
+            # fill up the reservoir first
+            free=max(0, min(sel.size, self.capacity-seen))
+            r[0][seen:seen+free]=X[sel[0:free]]
+            rest=sel[free:]
+            if rest.size>0:
+                # replace random elements, with decreasing probability
+                t=seen+free+np.arange(rest.size)
+                j=(self.rng.random_sample(rest.size)*(t+1)).astype(np.int64)
+                keep=j<self.capacity
+                r[0][j[keep]]=X[rest[keep]]
+            r[1]=seen+sel.size
+
+    def get(self):
+        '''
+        return (X, Y) of all samples
+        '''
+        if self.capacity is not None:
+            res=[ self.reservoir[k] for k in sorted(self.reservoir.keys()) ]
+            if len(res)==0:
+                return (np.zeros((0,0), dtype=np.float32), np.zeros(0))
+            X=np.concatenate( tuple( r[0][0:min(r[1],self.capacity)] for r in res ) )
+            Y=np.concatenate( tuple( np.repeat( r[2], min(r[1],self.capacity) ) for r in res ) )
+            return (X, Y)
+        elif self.path is not None:
+            if self._file is None:
+                return (np.zeros((0,0), dtype=np.float32), np.zeros(0))
+            self._file.close()
+            self._file=None
+            X=np.memmap(self.path, dtype=np.float32, mode='r', shape=(self.rows, self.features_no))
+            return (X, np.concatenate(tuple(self.Y)))
+        else:
+            if len(self.X)==0:
+                return (np.zeros((0,0), dtype=np.float32), np.zeros(0))
+            X=np.vstack(tuple(self.X))
+            # release per-subject blocks
+            self.X=[]
+            return (X, np.concatenate(tuple(self.Y)))
+
+    def cleanup(self):
+        '''remove memory mapped file'''
+        if self._file is not None:
+            self._file.close()
+            self._file=None
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class feature_cache(object):
+    '''
+    per-subject training features stored on disk, keyed by the contents of
+    input images, automatic segmentation, mask and ground truth, by the
+    sampling grid of the ground truth, which coordinate features are computed on,
+    and by the feature parameters, so that features are extracted only once for all
+    cross-validation folds and error correction variants
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir=cache_dir
+
+    def key(self, inp, parameters):
+        h=hashlib.sha1()
+        info=mincinfo(inp[-1])
+        h.update(json.dumps([ [ content_hash(i) if i is not None else None for i in inp ],
+                              sorted( (i,j.length,j.start,j.step) for (i,j) in info.items() ),
+                              sorted(parameters.items()) ]).encode())
+        return h.hexdigest()
+
+    def fetch(self, key):
+        '''return dict of memory mapped blocks, or None'''
+        path=self.cache_dir+os.sep+key
+        if not os.path.exists(path):
+            return None
+        try:
+            return { i.rsplit('.npy',1)[0]:np.load(path+os.sep+i, mmap_mode='r') for i in os.listdir(path) if i.endswith('.npy') }
+        except (IOError, OSError, ValueError):
+            return None
+
+    def store(self, key, blocks):
+        '''store dict of blocks'''
+        path=self.cache_dir+os.sep+key
+        tmp=self.cache_dir+os.sep+'.tmp_{}_{}_{}'.format(os.getpid(), threading.current_thread().ident, key)
+        try:
+            os.makedirs(tmp)
+            for (i,j) in blocks.items():
+                np.save(tmp+os.sep+i+'.npy', j)
+            # another process could have stored the same features, either one is fine
+            os.rename(tmp, path)
+        except OSError:
+            pass
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+
+
 def errorCorrectionTrain(input_images, 
                          output, 
                          parameters=None, 
@@ -195,6 +398,8 @@ def errorCorrectionTrain(input_images,
                          partition=None, 
                          part=None, 
                          multilabel=1):
+    training=None
+    training_direct=None
     try:
         use_coord  = parameters.get('use_coord',True)
         use_joint  = parameters.get('use_joint',True)
@@ -215,21 +420,59 @@ def errorCorrectionTrain(input_images,
         method_max_features=parameters.get('method_max_features','auto')
         method_n_jobs=parameters.get('method_n_jobs',1)
         primary_features=parameters.get('primary_features',1)
-
-        training_images = []
-        training_diff   = []
-        training_images_direct = []
-        training_direct = []
+        
+        # limit number of training samples per classifier, using class-balanced random sampling
+        # NOTE: each class gets the same number of samples, so the classifiers see
+        # a class prior different from the one in the training images
+        max_samples   = parameters.get('max_training_samples',None)
+        # keep training features in memory mapped files in this directory, True - next to the output
+        # ignored with max_training_samples, the reservoir is kept in memory
+        stream        = parameters.get('stream',False)
+        
+        stream_path=[None,None]
+        if stream and max_samples is not None:
+            print("errorCorrectionTrain: stream is ignored, max_training_samples={} samples are kept in memory".format(max_samples))
+        elif stream:
+            stream_dir=stream if isinstance(stream,str) else os.path.dirname(os.path.abspath(output))
+            stream_path=[ stream_dir+os.sep+'.{}_{}_features{}.bin'.format(os.path.basename(output),os.getpid(),j) for j in ('','_2') ]
+
+        training        = training_set(max_samples=max_samples, classes=2, path=stream_path[0], 
+                                       random=parameters.get('sample_random',method_random))
+        training_direct = training_set(max_samples=max_samples, classes=multilabel, path=stream_path[1],
+                                       random=parameters.get('sample_random',method_random))
 
         if debug:
             print("errorCorrectionTrain use_coord={} use_joint={} patch_size={} normalize_input={} method={} output={} partition={} part={}".\
                     format(repr(use_coord),repr(use_joint),repr(patch_size),repr(normalize_input),method,output,partition,part))
 
+        # per-subject features, shared between error correction variants
+        cache=None
+        if parameters.get('feature_cache',None):
+            cache=feature_cache(parameters['feature_cache'])
+        # everything that features and labels depend on, besides input files
+        feature_parameters={'use_coord':use_coord, 'use_joint':use_joint, 'patch_size':patch_size, 
+                            'primary_features':primary_features, 'multilabel':multilabel,
+                            'partition':partition, 'part':part}
+
         coords=None
+        coords_shape=None
         total_mask_size=0
         total_diff_mask_size=0
         
         for (i,inp) in enumerate(input_images):
+            if cache is not None:
+                key=cache.key(inp, feature_parameters)
+                blocks=cache.fetch(key)
+                if blocks is not None:
+                    if debug:
+                        print("Using cached features:{}".format(inp[0]))
+                    total_mask_size += blocks['labels'].size
+                    training.add( blocks['features'], blocks['labels'] )
+                    if multilabel>1:
+                        training_direct.add( blocks['direct_features'], blocks['direct_labels'] )
+                    blocks=None
+                    continue
+            
             mask=None
             diff=None
             mask_diff=None
@@ -245,9 +488,11 @@ def errorCorrectionTrain(input_images,
             auto   = extract_part(auto_data, partition, part, border)
             
             shape = ground_shape
-            if coords is None and use_coord:
+            if use_coord and coords_shape != shape:
+                # coordinates of each subject's own grid
                 c = np.mgrid[ 0:shape[0], 0:shape[1], 0: shape[2] ]
                 coords = [ extract_part( (c[j]-shape[j]/2.0)/(shape[j]/2.0),   partition, part, border ) for j in range(3) ]
+                coords_shape = shape
             
             features   = [ extract_part( minc.Image(k, dtype=np.float32).data, partition, part, border ) for k in inp[0:-3] ]
 
@@ -262,6 +507,16 @@ def errorCorrectionTrain(input_images,
                     print("Mask absent")
             total_mask_size += mask_size
             
+            sample_features=patch_features( 
+                                features, 
+                                coords, 
+                                mask=mask,
+                                use_coord=use_coord, 
+                                use_joint=use_joint,
+                                patch_size=patch_size, 
+                                primary_features=primary_features )
+            blocks={'features':sample_features}
+            
             if multilabel>1:
                 diff = (ground != auto)
                 total_diff_mask_size += np.sum(mask)
@@ -270,59 +525,47 @@ def errorCorrectionTrain(input_images,
                     mask_diff = diff & ( mask > 0 )
                     print("Sample {} mask_diff={} diff={}".format(i,np.sum(mask_diff),np.sum(diff)))
                     #print(mask_diff)
-                    training_diff.append( diff [ mask>0 ] ) 
-                    training_direct.append( ground[ mask_diff ] ) 
+                    blocks['labels']=diff [ mask>0 ]
                 else:
                     mask_diff = diff
-                    training_diff.append( diff ) 
-                    training_direct.append( ground[ diff ] ) 
+                    blocks['labels']=np.ravel( diff )
                 
-                training_images.append( prepare_features( 
-                                    features, 
-                                    coords, 
-                                    mask=mask,
-                                    use_coord=use_coord, 
-                                    use_joint=use_joint,
-                                    patch_size=patch_size, 
-                                    primary_features=primary_features ) )
-                
-                training_images_direct.append( prepare_features( 
+                blocks['direct_features']=patch_features( 
                                     features, 
                                     coords, 
                                     mask=mask_diff,
                                     use_coord=use_coord, 
                                     use_joint=use_joint,
                                     patch_size=patch_size, 
-                                    primary_features=primary_features ) )
+                                    primary_features=primary_features )
+                blocks['direct_labels']=ground[ mask_diff ]
                 
             else:
                 mask_diff=mask
                 if mask is not None:
-                    training_diff.append( ground[ mask>0 ] ) 
+                    blocks['labels']=ground[ mask>0 ]
                 else:
-                    training_diff.append( ground ) 
+                    blocks['labels']=np.ravel( ground )
 
-                
+            if cache is not None:
+                cache.store(key, blocks)
             
-                training_images.append( prepare_features( 
-                                    features, 
-                                    coords, 
-                                    mask=mask,
-                                    use_coord=use_coord, 
-                                    use_joint=use_joint,
-                                    patch_size=patch_size, 
-                                    primary_features=primary_features ) )
+            training.add( blocks['features'], blocks['labels'] )
+            if multilabel>1:
+                training_direct.add( blocks['direct_features'], blocks['direct_labels'] )
+            blocks=None
 
             if debug:
-                print("feature size:{}".format(len(training_images[-1])))
+                print("feature size:{}".format(sample_features.shape[1]))
             
             if i == 0 and parameters.get('dump',False):
                 print("Dumping feature images...")
-                for (j,k) in enumerate( training_images[-1] ):
+                for (j,k) in enumerate( sample_features.T ):
                     test=np.zeros_like( images[0] )
                     test[ mask>0 ]=k
                     out=minc.Image( data=test )
                     out.save( name="dump_{}.mnc".format(j), imitate=inp[0] )
+            sample_features=None
                     
         # calculate normalization coeffecients
         
@@ -332,8 +575,7 @@ def errorCorrectionTrain(input_images,
         clf2=None 
 
         if total_mask_size>0:
-            training_X = convert_image_list( training_images )
-            training_Y = np.ravel( np.concatenate( tuple(j for j in training_diff ) ) )
+            (training_X, training_Y) = training.get()
 
             if debug: print("Fitting 1st...")
             
@@ -396,8 +638,9 @@ def errorCorrectionTrain(input_images,
             if  multilabel>1 and method != 'dumb':
                 if debug: print("Fitting direct...")
                 
-                training_X = convert_image_list( training_images_direct )
-                training_Y = np.ravel( np.concatenate( tuple(j for j in training_direct ) ) )
+                # release samples of the first classifier
+                training_X = None
+                (training_X, training_Y) = training_direct.get()
                 
                 if method2   == "xgb":
                     clf2 = None
@@ -481,6 +724,12 @@ def errorCorrectionTrain(input_images,
         print("Exception in linear_registration:{}".format(sys.exc_info()[0]))
         traceback.print_exc(file=sys.stdout)
         raise
+    finally:
+        if training is not None:
+            training.cleanup()
+        if training_direct is not None:
+            training_direct.cleanup()
+
 
 def errorCorrectionApply(input_images, 
                          output, 
@@ -562,15 +811,14 @@ def errorCorrectionApply(input_images,
         out_cls  = None
         out_corr = None
 
-        test_x=convert_image_list ( [ prepare_features( 
+        test_x=patch_features( 
                                         features, 
                                         coords,
                                         mask=mask, 
                                         use_coord=use_coord, 
                                         use_joint=use_joint,
                                         patch_size=patch_size, 
-                                        primary_features=primary_features ) 
-                                  ] )
+                                        primary_features=primary_features )
 
         if input_auto is not None:
             out_corr = np.copy( extract_part( minc.Label( input_auto ).data, partition, part, border) ) # use input data
@@ -614,15 +862,14 @@ def errorCorrectionApply(input_images,
                 if debug:
                     print("Running classifier 2 ...")
 
-                test_x = convert_image_list ( [ prepare_features( 
+                test_x = patch_features( 
                                                 features, 
                                                 coords,
                                                 mask=mask , 
                                                 use_coord=use_coord, 
                                                 use_joint=use_joint,
                                                 patch_size=patch_size, 
-                                                primary_features=primary_features ) 
-                                        ] )
+                                                primary_features=primary_features )
                 if method2!='xgb':
                     pred = np.asarray( clf2.predict( test_x ), dtype=np.int32 ) 
                 else:
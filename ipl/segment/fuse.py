@@ -163,7 +163,12 @@ def fusion_segment( input_scan,
         
         library_preselect=        parameters.get('library_preselect', 10)
         library_preselect_step=   parameters.get('library_preselect_step', None)
+        # compare library only inside the local model mask
+        library_preselect_mask=   parameters.get('library_preselect_mask', False)
         library_preselect_method= parameters.get('library_preselect_method', 'MI')
+        # use embedding index of the library, if available, to compare only a short list
+        library_preselect_index=  parameters.get('library_preselect_index', True)
+        library_preselect_shortlist=parameters.get('library_preselect_shortlist', None)
         
 
         # if non-linear registraiton should be performed with ANTS
@@ -229,6 +234,7 @@ def fusion_segment( input_scan,
                                 )
 
         library = library_description['library']
+        library_index = library_description.get('preselect_index', []) if library_preselect_index else None
         
         sample_modalities=len(add)
         
@@ -537,7 +543,10 @@ def fusion_segment( input_scan,
                                             number=library_preselect,
                                             use_nl=library_nl_samples_avail,
                                             step=library_preselect_step,
-                                            lib_add_n=library_modalities) 
+                                            mask=local_model.mask if library_preselect_mask else None,
+                                            lib_add_n=library_modalities,
+                                    index=library_index,
+                                    shortlist=library_preselect_shortlist) 
                     if segment_symmetric:
                         if not loaded_f:
                             selected_library_f=preselect(nl_sample,
@@ -547,7 +556,10 @@ def fusion_segment( input_scan,
                                                     use_nl=library_nl_samples_avail,
                                                     flip=True,
                                                     step=library_preselect_step,
-                                                    lib_add_n=library_modalities)
+                                                    mask=local_model.mask if library_preselect_mask else None,
+                                                    lib_add_n=library_modalities,
+                                    index=library_index,
+                                    shortlist=library_preselect_shortlist)
                 else:
                     if not loaded:
                         selected_library=preselect(bbox_sample,
@@ -556,7 +568,10 @@ def fusion_segment( input_scan,
                                             number=library_preselect,
                                             use_nl=False,
                                             step=library_preselect_step,
-                                            lib_add_n=library_modalities)
+                                            mask=local_model.mask if library_preselect_mask else None,
+                                            lib_add_n=library_modalities,
+                                    index=library_index,
+                                    shortlist=library_preselect_shortlist)
                     if segment_symmetric:
                         if not loaded_f:
                             selected_library_f=preselect(bbox_sample, 
@@ -565,7 +580,10 @@ def fusion_segment( input_scan,
                                                     number=library_preselect,
                                                     use_nl=False,flip=True,
                                                     step=library_preselect_step,
-                                                    lib_add_n=library_modalities)
+                                                    mask=local_model.mask if library_preselect_mask else None,
+                                                    lib_add_n=library_modalities,
+                                    index=library_index,
+                                    shortlist=library_preselect_shortlist)
 
                 if not loaded:
                     with open(work_lib_dir+os.sep+'sel_library.json','w') as f:
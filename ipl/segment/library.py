@@ -10,6 +10,8 @@ import os
 import sys
 import traceback
 
+from ipl.minc_header import index_files,load_index
+
 def save_library_info(library_description, output,name='library.json'):
     """Save library information into directory, using predfined file structure
     Arguments:
@@ -50,8 +52,16 @@ def save_library_info(library_description, output,name='library.json'):
             for (k,t) in enumerate(i):
                 tmp_library_description['library'][j][k]=os.path.relpath(t, output)
 
+        for (j, i) in enumerate(tmp_library_description.get('preselect_index',[])):
+            tmp_library_description['preselect_index'][j]=os.path.relpath(i, output)
+
         with open(output+os.sep+name,'w') as f:
             json.dump(tmp_library_description,f,indent=1)
+
+        # headers of the library files, loaded with the library
+        files=[t for i in library_description['library'] for t in i if isinstance(t,basestring)]
+        files.extend([library_description.get(i,None) for i in ['model','model_mask','local_model','local_model_mask']])
+        index_files(output+os.sep+'headers.json', files, prefix=output)
     except :
         print "Error saving library information into:{} {}".format(output,sys.exc_info()[0])
         traceback.print_exc(file=sys.stderr)
@@ -71,6 +81,7 @@ def load_library_info(prefix, name='library.json'):
             library_description=json.load(f)
 
         library_description['prefix']=prefix
+        load_index(prefix+os.sep+'headers.json')
 
         for i in ['local_model','local_model_mask', 'local_model_flip',
                  'local_model_mask_flip','local_model_seg','gco_energy']:
@@ -89,6 +100,9 @@ def load_library_info(prefix, name='library.json'):
             for (k,t) in enumerate(i):
                 library_description['library'][j][k]=prefix+os.sep+t
 
+        for (j, i) in enumerate(library_description.get('preselect_index',[])):
+            library_description['preselect_index'][j]=prefix+os.sep+i
+
         for i in ['model','model_mask']:
             # if it starts with '/' assume it's absolute path
             if library_description[i] is not None and library_description[i][0]!=os.sep:
@@ -14,6 +14,7 @@ import json
 
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
+from ipl.minc_preselect import library_similarity,index_candidates,shortlist_factor,PreselectError
 
 # scoop parallel execution
 from scoop import futures, shared
@@ -34,22 +35,62 @@ def preselect(sample,
               use_nl=False,
               flip=False,
               step=None,
-              lib_add_n=0):
-    '''calculate requested similarity function and return top number of elements from the library'''
+              lib_add_n=0,
+              engine=None,
+              index=None,
+              shortlist=None):
+    '''calculate requested similarity function and return top number of elements from the library
+    if index files are given, only a short list of the nearest entries is compared exactly'''
     results=[]
     column=0
     
     # TODO: use multiple modalities for preselection?
     if use_nl:
         column=4+lib_add_n
+
+    if engine is None:
+        engine=os.environ.get('IPL_CALC_ENGINE',None)
+
+    keep=True
+    if index is not None and len(index)>0 and number<len(library):
+        if shortlist is None:
+            shortlist=shortlist_factor*number
+        try:
+            library=[library[i] for i in index_candidates(sample.scan_f if flip else sample.scan,
+                                                          [j[column] for j in library],
+                                                          index, max(number,shortlist))]
+            # short list is different for each sample
+            keep=False
+        except PreselectError as e:
+            print("Can't use preselection index:{}".format(str(e)))
+
+    cost=None
+    if engine=='numpy':
+        # compare with all library entries at once
+        try:
+            cost=library_similarity(sample.scan_f if flip else sample.scan,
+                                    [j[column] for j in library],
+                                    mask=mask, method=method, step=step, keep=keep)
+        except PreselectError as e:
+            print("Can't run in-process:{}".format(str(e)))
+
+    if cost is None:
+        if step is None:
+            # figure out step size once for all library entries, 
+            # minctracc works extremely slow when step size is smaller then file step size
+            info_sample=mincTools.mincinfo( sample.scan )
+            step= max( abs( info_sample['xspace'].step ) ,
+                       abs( info_sample['yspace'].step ) ,
+                       abs( info_sample['zspace'].step ) )
         
-    for (i,j) in enumerate(library):
-        results.append( futures.submit(
-            calculate_similarity, sample, MriDataset(scan=j[column]), method=method, mask=mask, flip=flip, step=step
-            ) )
-    futures.wait(results, return_when=futures.ALL_COMPLETED)
+        for (i,j) in enumerate(library):
+            results.append( futures.submit(
+                calculate_similarity, sample, MriDataset(scan=j[column]), method=method, mask=mask, flip=flip, step=step
+                ) )
+        futures.wait(results, return_when=futures.ALL_COMPLETED)
+        cost=[j.result() for j in results]
         
-    val=[ (j.result(), library[i] ) for (i,j) in enumerate(results)]
+    val=[ (j, library[i] ) for (i,j) in enumerate(cost)]
     
     val_sorted=sorted(val, key=lambda s: s[0] )
 
@@ -66,9 +107,6 @@ def calculate_similarity(sample1, sample2,
             if flip:
                 scan=sample1.scan_f
                 
-            # figure out step size, minctracc works extremely slow when step size is smaller then file step size
-            info_sample1=m.mincinfo( sample1.scan )
-            
             cmds=[ 'minctracc', scan, sample2.scan, '-identity' ]
             
             if method=='MI':
@@ -77,6 +115,8 @@ def calculate_similarity(sample1, sample2,
                 cmds.append( '-xcorr' )
 
             if step is None:
+                # figure out step size, minctracc works extremely slow when step size is smaller then file step size
+                info_sample1=m.mincinfo( sample1.scan )
                 step= max( abs( info_sample1['xspace'].step ) ,
                            abs( info_sample1['yspace'].step ) ,
                            abs( info_sample1['zspace'].step ) )
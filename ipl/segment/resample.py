@@ -39,39 +39,51 @@ def create_fake_mask(in_seg, out_mask, op=None ):
 
 def resample_file(input,output,xfm=None,like=None,order=4,invert_transform=False):
     '''resample input file using proveded transformation'''
+    resample_files([input],[output],xfm=xfm,like=like,order=order,invert_transform=invert_transform)
+
+
+def resample_files(inputs,outputs,xfm=None,like=None,order=4,invert_transform=False):
+    '''resample several files using the same transformation and sampling'''
     try:
         with mincTools() as m:
-            m.resample_smooth(input,output,xfm=xfm,like=like,order=order,invert_transform=invert_transform)
+            m.resample_batch(list(zip(inputs,outputs)),transform=xfm,like=like,order=order,invert_transform=invert_transform)
     except mincError as e:
-        print("Exception in resample_file:{}".format(str(e)))
+        print("Exception in resample_files:{}".format(str(e)))
         traceback.print_exc(file=sys.stdout)
         raise
     except :
-        print("Exception in resample_file:{}".format(sys.exc_info()[0]))
+        print("Exception in resample_files:{}".format(sys.exc_info()[0]))
         traceback.print_exc(file=sys.stdout)
         raise
 
 
 def resample_split_segmentations(input, output,xfm=None, like=None, order=4, invert_transform=False, symmetric=False):
-    '''resample individual segmentations, using parallel execution'''
+    '''resample individual segmentations, using parallel execution,
+    with numpy engine sampling coordinates are shared by all labels of each side'''
     results=[]
-    base=input.seg.rsplit('.mnc',1)[0]
-    for (i,j) in input.seg_split.items():
-        if not output.seg_split.has_key(i):
-            output.seg_split[i]='{}_{:03d}.mnc'.format(base,i)
-            
-        results.append(futures.submit(
-            resample_file,j,output.seg_split[i],xfm=xfm,like=like,order=order,invert_transform=invert_transform
-        ))
+    # one job per side, or one job per label for minc tools
+    batch=(os.environ.get('IPL_CALC_ENGINE',None)=='numpy')
+    sides=[(input.seg, input.seg_split, output.seg_split)]
     if symmetric:
-        base=input.seg_f.rsplit('.mnc',1)[0]
-        for (i,j) in input.seg_f_split.items():
-            if not output.seg_f_split.has_key(i):
-                output.seg_split[i]='{}_{:03d}.mnc'.format(base,i)
-
+        sides.append((input.seg_f, input.seg_f_split, output.seg_f_split))
+    
+    for (seg, seg_split, out_split) in sides:
+        base=seg.rsplit('.mnc',1)[0]
+        for (i,j) in seg_split.items():
+            if not out_split.has_key(i):
+                out_split[i]='{}_{:03d}.mnc'.format(base,i)
+        
+        keys=sorted(seg_split.keys())
+        if batch:
             results.append(futures.submit(
-                resample_file,j,output.seg_f_split[i],xfm=xfm,like=like,order=order,invert_transform=invert_transform
+                resample_files,[seg_split[i] for i in keys],[out_split[i] for i in keys],
+                xfm=xfm,like=like,order=order,invert_transform=invert_transform
             ))
+        else:
+            for i in keys:
+                results.append(futures.submit(
+                    resample_file,seg_split[i],out_split[i],xfm=xfm,like=like,order=order,invert_transform=invert_transform
+                ))
     futures.wait(results, return_when=futures.ALL_COMPLETED)
 
 
@@ -100,25 +112,35 @@ def warp_rename_seg( sample, model, output,
                 if symmetric:
                     xfm_f=transform.xfm_f
 
-            m.resample_labels(sample.seg, output.seg,
-                              transform=xfm,
-                              aa=resample_aa,
-                              order=resample_order,
-                              remap=lut,
-                              like=model.scan,
-                              invert_transform=invert_transform,
-                              datatype=datatype,
-                              baa=resample_baa)
-            
-            if create_mask:
-                create_fake_mask(output.seg, output.mask, op=op_mask)
-            elif sample.mask is not None:
-                m.resample_labels(sample.mask, output.mask,
-                                transform=xfm,
-                                order=resample_order,
-                                like=model.scan,
-                                invert_transform=invert_transform,
-                                datatype=datatype )
+            if lut is None and resample_aa is None and not resample_baa and \
+               not create_mask and sample.mask is not None:
+                # segmentation and mask share transformation and sampling
+                m.resample_batch(labels=[(sample.seg, output.seg), (sample.mask, output.mask)],
+                                 transform=xfm,
+                                 like=model.scan,
+                                 label_order=resample_order,
+                                 invert_transform=invert_transform,
+                                 label_datatype=datatype)
+            else:
+                m.resample_labels(sample.seg, output.seg,
+                                  transform=xfm,
+                                  aa=resample_aa,
+                                  order=resample_order,
+                                  remap=lut,
+                                  like=model.scan,
+                                  invert_transform=invert_transform,
+                                  datatype=datatype,
+                                  baa=resample_baa)
+                
+                if create_mask:
+                    create_fake_mask(output.seg, output.mask, op=op_mask)
+                elif sample.mask is not None:
+                    m.resample_labels(sample.mask, output.mask,
+                                    transform=xfm,
+                                    order=resample_order,
+                                    like=model.scan,
+                                    invert_transform=invert_transform,
+                                    datatype=datatype )
                 
             if symmetric:
 
@@ -185,30 +207,30 @@ def warp_sample( sample,
                 xfm=transform.xfm
                 if symmetric:
                     xfm_f=transform.xfm_f
+                if len(sample.add)>0:
+                    # evaluate transformation chain only once for all modalities
+                    xfm=m.flatten_xfm(xfm, model.scan)
 
             output_scan=output.scan
+            output_add=list(output.add)
             
             if filters is not None:
                 output_scan=m.tmp('sample.mnc')
+                output_add=[m.tmp('sample_{}.mnc'.format(i)) for (i,j) in enumerate(sample.add)]
             
-            m.resample_smooth(sample.scan, output_scan, transform=xfm, like=model.scan, order=resample_order)
+            # all modalities share transformation and sampling
+            m.resample_batch([(sample.scan, output_scan)]+list(zip(sample.add, output_add)),
+                             transform=xfm, like=model.scan, order=resample_order)
             
             if filters is not None:
                 # TODO: maybe move it to a separate stage?
                 # HACK: assuming that segmentation was already warped!
                 apply_filter(output_scan, output.scan, filters, model=model.scan, input_mask=output.mask, input_labels=seg_output, model_labels=model.seg)
             
-            for (i,j) in enumerate( sample.add ):
-                output_scan = output.add[i]
-                if filters is not None:
-                    output_scan=m.tmp('sample_{}.mnc').format(i)
-
-                m.resample_smooth(sample.add[i], output_scan, transform=xfm, like=model.scan, order=resample_order)
-                
-                if filters is not None:
+                for (i,j) in enumerate( sample.add ):
                     # TODO: maybe move it to a separate stage?
                     # TODO: apply segmentations for seg-based filtering
-                    apply_filter(output_scan, output.add[i], filters, model=model.scan, input_mask=output.mask, input_labels=seg_output, model_labels=model.seg)
+                    apply_filter(output_add[i], output.add[i], filters, model=model.scan, input_mask=output.mask, input_labels=seg_output, model_labels=model.seg)
 
             if symmetric:
                 scan_f=sample.scan
@@ -224,26 +246,25 @@ def warp_sample( sample,
                         m.xfmconcat( [m.tmp('flip_x.xfm'), transform.xfm_f ], m.tmp('transform_flip.xfm') )
                         xfm_f=m.tmp('transform_flip.xfm')
 
+                if xfm_f is not None and len(sample.add_f)>0:
+                    xfm_f=m.flatten_xfm(xfm_f, model.scan)
+
                 output_scan_f=output.scan_f
+                output_add_f=list(output.add_f)
                 
                 if filters is not None:
                     output_scan_f=m.tmp('sample_f.mnc')
+                    output_add_f=[m.tmp('sample_f_{}.mnc'.format(i)) for (i,j) in enumerate(sample.add_f)]
                     
-                m.resample_smooth(scan_f, output_scan_f, transform=xfm_f, like=model.scan, order=resample_order)
+                m.resample_batch([(scan_f, output_scan_f)]+list(zip(sample.add_f, output_add_f)),
+                                 transform=xfm_f, like=model.scan, order=resample_order)
                 
                 if filters is not None:
                     # TODO: maybe move it to a separate stage?
                     apply_filter(output_scan_f, output.scan_f, filters, model=model.scan, input_mask=output.mask_f, input_labels=seg_output_f, model_labels=model.seg)
 
-                for (i,j) in enumerate( sample.add_f ):
-                    output_scan_f = output.add_f[i]
-                    if filters is not None:
-                        output_scan_f=m.tmp('sample_f_{}.mnc').format(i)
-
-                    m.resample_smooth( sample.add_f[i], output_scan_f, transform=xfm_f, like=model.scan, order=resample_order)
-
-                    if filters is not None:
-                        apply_filter( output_scan_f, output.add_f[i], filters, model=model.scan, input_mask=output.mask_f, input_labels=seg_output_f, model_labels=model.seg)
+                    for (i,j) in enumerate( sample.add_f ):
+                        apply_filter( output_add_f[i], output.add_f[i], filters, model=model.scan, input_mask=output.mask_f, input_labels=seg_output_f, model_labels=model.seg)
 
             output.mask=None
             output.mask_f=None
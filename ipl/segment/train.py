@@ -26,6 +26,9 @@ from .error_correction import *
 from .model            import *
 from .library          import *
 
+from ipl.minc_pyramid  import get_pyramid
+from ipl.minc_preselect import build_index,PreselectError
+
 
 def inv_dict(d):
     return { v:k for (k,v) in d.items() }
@@ -88,6 +91,10 @@ def generate_library(parameters, output, debug=False,cleanup=False):
         # extent bounding box to reduce boundary effects
         extend_boundary           = parameters.get( 'extend_boundary',4)
 
+        # build embedding index for fast preselection in large libraries
+        # True or dict with 'dims', 'method' ('pca' or 'random') and 'step'
+        preselect_index           = parameters.get( 'preselect_index', False)
+        
         # extend maks 
         #dilate_mask               = parameters.get( 'dilate_mask',3)
         op_mask                    = parameters.get( 'op_mask','E[2] D[4]')
@@ -282,6 +289,12 @@ def generate_library(parameters, output, debug=False,cleanup=False):
             
             futures.wait(flip_all, return_when=futures.ALL_COMPLETED)
         
+        # precompute downsampled reference model, if pyramid store is enabled
+        if do_initial_register and inital_reg_downsample is not None and get_pyramid() is not None:
+            with mincTools() as m:
+                get_pyramid().precompute(m, [model.scan]+model.add, masks=[model.mask],
+                                         steps=[inital_reg_downsample])
+        
         # 1. run global linear registration if nedded
         if do_initial_register :
             for (j,i) in enumerate(filtered_samples):
@@ -645,6 +658,12 @@ def generate_library(parameters, output, debug=False,cleanup=False):
 
                 library_description['library'].append(ss)
 
+        if preselect_index:
+            library_description['preselect_index']=build_preselect_index(
+                library_description['library'], output, local_model.mask,
+                nl_column=4+modalities if do_nonlinear_register else None,
+                options=preselect_index if isinstance(preselect_index, dict) else {})
+
         save_library_info( library_description, output)
         # cleanup
         if cleanup:
@@ -660,6 +679,25 @@ def generate_library(parameters, output, debug=False,cleanup=False):
         raise
 
 
+def build_preselect_index(library, output, mask, nl_column=None, options={}):
+    """build embedding indexes of linear and non-linear library samples,
+    return list of index files"""
+    indexes=[]
+    columns=[(0,'preselect_index.npz')]
+    if nl_column is not None:
+        columns.append((nl_column,'preselect_index_nl.npz'))
+    for (column,name) in columns:
+        try:
+            indexes.append(build_index([j[column] for j in library], output+os.sep+name,
+                                       mask=mask,
+                                       step=options.get('step',None),
+                                       dims=options.get('dims',None),
+                                       method=options.get('method','pca')))
+        except PreselectError as e:
+            print("Can't build preselection index:{}".format(str(e)))
+    return indexes
+
+
 def estimate_gco_energy(samples,output,classes=2):
     with mincTools() as m:
         files=[f.seg for f in samples]
@@ -15,6 +15,9 @@ import subprocess
 from shutil import rmtree
 import tempfile
 
+from ipl.minc_trace import command_trace
+from ipl.minc_executor import get_executor
+
 
 class IplError(Exception):
     def __init__(self, value=''):
@@ -123,7 +126,8 @@ def execute(
     # else:
 
         print('Calling:' + ','.join(commandline) + '\n')
-        retv = call(cline)
+        with command_trace(cline) as trace:
+            retv = trace.returncode = call(cline)
     except OSError:
         raise IplError('ERROR: unable to find executable %s!'
                        % str(commandline))
@@ -154,7 +158,8 @@ def cmdWoutput(commandline, clfile=None, verbose=True):
     cline = commandline
     lines = []
     try:
-        lines = Popen(cline, stdout=PIPE).communicate()
+        with command_trace(cline):
+            lines = Popen(cline, stdout=PIPE).communicate()
     except OSError:
         raise IplError('ERROR: unable to find executable %s!'
                        % str(commandline))
@@ -351,47 +356,11 @@ def qsub_pe(
     queue=None
     ):
     """ 
-    Send the job into the sge queue using paralle environment
-    TODO: improve dependencies and so on
+    Send the job into the sge queue using paralle environment,
+    or to another backend selected by IPL_EXECUTOR, see ipl.minc_executor
     """
-
-    if not name:
-        name = comm[0]
-    try:
-        qsub_comm = [
-            'qsub','-cwd',
-            '-N', name,
-            '-j', 'y',
-            '-l', 'h_vmem=6G',
-            '-V', '-pe', pe, str(peslots)
-            ]
-        path = ''
-        
-        if logfile is not None:
-            path = os.path.abspath(logfile)
-            qsub_comm.extend(['-o', path])
-        if depends is not None:
-            qsub_comm.extend(['-hold_jid', depends])
-        if queue is not None:
-            qsub_comm.extend(['-q', queue])
-        
-        print(' - Name    ' + name)
-        print(' - PE      ' + pe)
-        print(' - PESLOTS ' + str(peslots))
-        print(' - Cmd     ' + ' '.join(comm))
-        print(' - logfile ' + path)
-
-        cmds="#!/bin/bash\nhostname\n"
-        cmds+="\n".join(comm)+"\n"
-        
-        p=subprocess.Popen(qsub_comm,
-                stdin=subprocess.PIPE,
-                stderr=subprocess.STDOUT)
-
-        p.communicate(cmds)
-        # TODO: check error code?
-    finally:
-        pass
+    return get_executor(pe=pe, queue=queue, resources=['h_vmem=6G']).submit(
+        comm, name=name, slots=peslots, logfile=logfile, depends=depends)
 
 
 def qsub(
@@ -402,51 +371,11 @@ def qsub(
     depends=None,
     ):
     """ 
-    Send the job into the sge queue
-    TODO: improve dependencies and so on
+    Send the job into the sge queue,
+    or to another backend selected by IPL_EXECUTOR, see ipl.minc_executor
   """
-
-    if not name:
-        name = comm[0]
-    try:
-        tmpscript = tempfile.mkstemp()[1]
-        p = open(tmpscript, 'w')
-        p.write('''#! /bin/bash
-hostname
-''')
-        p.write(' '.join(comm))
-        p.write('\n')  # added for compliance, SFE
-        p.close()
-        os.chmod(tmpscript, 777)
-
-        qsub_comm = [
-            'qsub',
-            '-cwd',
-            '-N',
-            name,
-            '-j',
-            'y',
-            '-V',
-            '-q',
-            queue,
-            ]
-        path = ''
-        if logfile:
-            path = os.path.abspath(logfile)
-            qsub_comm.extend(['-o', path])
-        if depends:
-            qsub_comm.extend(['-hold_jid', depends])
-        print(' - Name    ' + name)
-        print(' - Queue   ' + queue)
-        print(' - Cmd     ' + ' '.join(comm))
-        print(' - logfile ' + path)
-
-        qsub_comm.append(tmpscript)
-        if not execute(qsub_comm):
-            print(' -- Submitted job ' + name)
-    finally:
-
-        pass
+    return get_executor(queue=queue).submit(
+        [' '.join(comm)], name=name, logfile=logfile, depends=depends)
 
 
 if __name__ == '__main__':
@@ -22,6 +22,7 @@ import json
 import six
 
 from   ipl.minc_tools import mincTools,mincError
+from   ipl.minc_executor import get_executor
 
 
 # files storing all processing
@@ -94,6 +95,9 @@ def launchPipeline(options):
         if 'large_atrophy' in _opts:
             options.large_atrophy=_opts['large_atrophy']
             
+        if 'warm_start' in _opts:
+            options.warm_start=_opts['warm_start']
+            
         if 'manual' in _opts:
             options.manual=_opts['manual']
             
@@ -257,6 +261,7 @@ def launchPipeline(options):
                 patients[id].temporalregu = options.temporalregu
                 patients[id].skullreg = options.skullreg
                 patients[id].large_atrophy = options.large_atrophy
+                patients[id].warm_start = options.warm_start
                 patients[id].dobiascorr = options.dobiascorr
                 patients[id].linreg   = options.linreg
                 patients[id].add      = options.add
@@ -341,7 +346,7 @@ def launchPipeline(options):
             print('{} - {}'.format(id,visit) )
             # store patients in the pickle
         
-    if opts.pe is None: # use SCOOP to run all subjects in parallel
+    if opts.pe is None and opts.executor is None: # use SCOOP to run all subjects in parallel
         pickles = []
     
         for (id, i) in patients.iteritems():
@@ -354,8 +359,11 @@ def launchPipeline(options):
         futures.wait(jobs, return_when=futures.ALL_COMPLETED)
         print('All subjects finished:%d' % len(jobs))
         
-    else: # USE SGE to submit one job per subject, using required peslots 
+    else: # USE SGE (or another executor) to submit one job per subject, using required peslots 
         pickles = []
+        executor = get_executor(kind=opts.executor, pe=opts.pe,
+                                queue=opts.queue, batch=opts.batch,
+                                resources=['h_vmem=6G'])
         
         for (id, i) in patients.iteritems():
             # writing the pickle file
@@ -379,11 +387,14 @@ def launchPipeline(options):
             comm.extend(['export OMP_DYNAMIC=TRUE'])
             comm.extend(['python -m scoop -n {} {} -p {}'.format(str(slots),os.path.abspath(sys.argv[0]),i.pickle)])
             
-            qsub_pe(comm,opts.pe, 
-                    opts.peslots,
+            executor.submit(comm,
+                    slots=slots,
                     name='LNG_{}'.format(str(id)),
-                    logfile=i.patientdir+os.sep+str(id)+".sge.log",
-                    queue=opts.queue)
+                    logfile=i.patientdir+os.sep+str(id)+".sge.log")
+        
+        failed=executor.wait()
+        if len(failed)>0:
+            print('Failed jobs:{}'.format(' '.join(sorted(failed.keys()))))
 
 def runTimePoint_FirstStage(tp, patient):
     '''
@@ -571,7 +582,13 @@ def runPipeline(pickle, workdir=None):
         tps = patient.keys()
         tps.sort()
         jobs=[]
-        for tp in tps:
+        done=[]
+        if getattr(patient, 'warm_start', False) and len(tps) > 1:
+            # register first timepoint before the others, they will start from it
+            runTimePoint_FirstStage(tps[0], patient)
+            done=tps[0:1]
+        
+        for tp in tps[len(done):]:
             jobs.append(futures.submit(runTimePoint_FirstStage,tp, patient))
 
         futures.wait(jobs, return_when=futures.ALL_COMPLETED)
@@ -893,6 +910,15 @@ if __name__ == '__main__':
         default=False,
         )
 
+    group.add_option(
+        '',
+        '--warm_start',
+        dest='warm_start',
+        help='Initialize stx registration of each timepoint from other timepoints of the same subject, skip coarse levels when they are close',
+        action='store_true',
+        default=False,
+        )
+
     group.add_option('', '--manual', dest='manual',
                      help='Manual or alternative processing path to find auxiliary data (look info)'
                      )
@@ -967,6 +993,14 @@ if __name__ == '__main__':
                      help='Specify SGE queue for submission'
                      )
 
+    group.add_option('--executor', dest='executor',
+                     help='Submit one job per subject using executor: sge, local or batch [IPL_EXECUTOR]'
+                     )
+
+    group.add_option('--batch', dest='batch',
+                     help='Number of subjects processed by one array task with batch executor [IPL_EXECUTOR_BATCH]',
+                     type="int")
+
     parser.add_option_group(group)
 
     (opts, args) = parser.parse_args()
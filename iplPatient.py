@@ -75,6 +75,7 @@ class LngPatient(dict):
         self.run_skullreg = False  # default - do not attempt to run skull registration
         self.large_atrophy = False  # default - do not use the ventricle mask for the linear template creation
         self.geo_corr = False  # default - do not perform distortion correction
+        self.warm_start = False  # default - register each timepoint to stx space from scratch
         self.dodbm = False  #  default - do not create dbm files
         self.dovbm = False  #  default - do not create vbm files
         self.vbm_options = {} # VBM options
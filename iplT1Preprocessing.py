@@ -18,6 +18,7 @@ from optparse import OptionParser  # to change when python updates in the machin
 from optparse import OptionGroup  # to change when python updates in the machines for argparse
 
 from ipl.minc_tools import mincTools,mincError
+import ipl.registration as registration
 
 from iplGeneral import *
 from iplPatient import *
@@ -197,11 +198,28 @@ def t1preprocessing_v10(patient, tp):
                                   transform=patient[tp].geo['t1'] )
 
         if not os.path.exists( patient[tp].stx_xfm['t1']):
+            conf = patient.linreg
+            if init_xfm is None and getattr(patient, 'warm_start', False):
+                # start from the registration of the first timepoint,
+                # which is finished before the others start,
+                # or from the linear template of the same subject
+                # other timepoints may be still running
+                first = sorted(patient.keys())[0]
+                candidates = []
+                if first != tp:
+                    candidates.append(patient[first].stx_xfm['t1'])
+                for (i, j) in patient.iteritems():
+                    candidates.append(j.stx2_xfm.get('t1', None))
+                (init_xfm, similarity) = registration.warm_start_xfm( t1_corr, modelt1,
+                                                  candidates, target_mask=modelmask )
+                if similarity is not None and similarity >= registration.warm_start_similarity:
+                    conf = registration.warm_start_conf(conf)
+
             minc.linear_register( t1_corr, modelt1,
                                   patient[tp].stx_xfm['t1'],
                                   init_xfm=init_xfm,
                                   objective='-nmi', 
-                                  conf=patient.linreg)
+                                  conf=conf)
 
                                   # target_mask=modelmask
 
@@ -94,9 +94,12 @@ def VBM_v10(patient, tp, options):
         det=minc.tmp('det.mnc')
         minc.grid_determinant(minc.tmp('nl')+'_grid_0.mnc',det)
 
-        resample_modulate(cls, 1, xfm, det, patient[tp].vbm['csf'],modelmask, vbm_resolution, vbm_fwhm)
-        resample_modulate(cls, 2, xfm, det, patient[tp].vbm['gm'], modelmask,  vbm_resolution, vbm_fwhm)
-        resample_modulate(cls, 3, xfm, det, patient[tp].vbm['wm'], modelmask,  vbm_resolution, vbm_fwhm)
+        # evaluate transformation only once for all tissue classes
+        flat_xfm=minc.flatten_xfm(xfm, modelmask)
+        
+        resample_modulate(cls, 1, flat_xfm, det, patient[tp].vbm['csf'],modelmask, vbm_resolution, vbm_fwhm)
+        resample_modulate(cls, 2, flat_xfm, det, patient[tp].vbm['gm'], modelmask,  vbm_resolution, vbm_fwhm)
+        resample_modulate(cls, 3, flat_xfm, det, patient[tp].vbm['wm'], modelmask,  vbm_resolution, vbm_fwhm)
         
         # create determinant of inverse transform for DBM analysis
         minc.xfm_normalize(patient[tp].vbm['xfm'], patient[tp].vbm['csf'], minc.tmp('inl')+'.xfm', exact=True, invert=True)
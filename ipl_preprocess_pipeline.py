@@ -104,6 +104,58 @@ preprocessing_pipeline_parameters={
 
 
 
+def visit_dirs(s, output, manual):
+    output_dir=output+os.sep+s['subject']+os.sep+s['visit']
+    manual_dir=None
+    
+    if manual is not None:
+        manual_dir=manual+os.sep+s['subject']+os.sep+s['visit']
+    return (output_dir, manual_dir)
+
+
+def run_subject(visits, output, manual, pipeline_parameters):
+    """run first visit of a subject, then the other visits, 
+    starting their nonlinear registration from the first one
+    returns list of outputs, raises exception of the first failed visit"""
+    (output_dir, manual_dir)=visit_dirs(visits[0], output, manual)
+    results=[]
+    error=None
+    first_output=None
+    try:
+        first_output=standard_pipeline( visits[0], output_dir,
+                        options=pipeline_parameters,
+                        work_dir=output_dir,
+                        manual_dir=manual_dir)
+    except Exception as e:
+        print("Exception in first visit {} {}:{}".format(visits[0]['subject'],visits[0]['visit'],str(e)))
+        traceback.print_exc( file=sys.stdout)
+        error=e
+    
+    jobs=[]
+    for s in visits[1:]:
+        if first_output is not None and s.get('init_t1w_nl_xfm',None) is None:
+            s['init_t1w_nl_xfm']=first_output.get('nl_xfm',None)
+        (output_dir, manual_dir)=visit_dirs(s, output, manual)
+        jobs.append( futures.submit( 
+                    standard_pipeline, s, output_dir,
+                        options=pipeline_parameters,
+                        work_dir=output_dir,
+                        manual_dir=manual_dir ))
+    futures.wait(jobs, return_when=futures.ALL_COMPLETED)
+    
+    results.append(first_output)
+    for j in jobs:
+        if j.exception() is not None:
+            if error is None: error=j.exception()
+            results.append(None)
+        else:
+            results.append(j.result())
+    
+    if error is not None:
+        raise error
+    return results
+
+
 def parse_options():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                  description='Run pipeline')
@@ -257,29 +309,44 @@ if __name__ == '__main__':
                 print(repr(inputs))
             
             run_pipeline=[]
-            for (i, s) in enumerate(inputs):
-                output_dir=options.output+os.sep+s['subject']+os.sep+s['visit']
-                manual_dir=None
-                
-                if options.manual is not None:
-                    manual_dir=options.manual+os.sep+s['subject']+os.sep+s['visit']
+            if pipeline_parameters.get('nl_reg',{}).get('warm_start',None) is not None:
+                # run visits of each subject one after another, 
+                # other visits start nonlinear registration from the first one
+                subjects={}
+                for (i, s) in enumerate(inputs):
+                    subjects.setdefault(s['subject'],[]).append(i)
                 
-                
-                run_pipeline.append( futures.submit( 
-                    standard_pipeline,
-                        s,
-                        output_dir, 
-                        options=pipeline_parameters ,
-                        work_dir=output_dir,
-                        manual_dir=manual_dir
-                    ))
+                for idx in subjects.values():
+                    run_pipeline.append( (idx, futures.submit(
+                        run_subject, 
+                            [inputs[i] for i in idx],
+                            options.output,
+                            options.manual,
+                            pipeline_parameters
+                        )))
+            else:
+                for (i, s) in enumerate(inputs):
+                    (output_dir, manual_dir)=visit_dirs(s, options.output, options.manual)
+                    
+                    run_pipeline.append( (i, futures.submit( 
+                        standard_pipeline,
+                            s,
+                            output_dir, 
+                            options=pipeline_parameters ,
+                            work_dir=output_dir,
+                            manual_dir=manual_dir
+                        )))
             #
             # wait for all to finish
             #
-            futures.wait(run_pipeline, return_when=futures.ALL_COMPLETED)
-
-            for j,i in enumerate(run_pipeline):
-                inputs[j]['output']=i.result()
+            futures.wait([i[1] for i in run_pipeline], return_when=futures.ALL_COMPLETED)
+
+            for (idx, i) in run_pipeline:
+                if isinstance(idx, list): # all visits of a subject
+                    for (j,k) in zip(idx, i.result()):
+                        inputs[j]['output']=k
+                else:
+                    inputs[idx]['output']=i.result()
 
             save_pipeline_output(inputs,options.output+os.sep+'summary.json')
 